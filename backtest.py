@@ -0,0 +1,260 @@
+"""
+Backtest of the forecast models on the archived exports ('Reports history/<YYYY-MM-DD>', written
+by copy_and_clean.py).
+Every snapshot is forecast again as on its date, with the models and settings of the forecast
+(see utils/forecasting.py), and the forecast is compared with the 30d sales report of the snapshot
+taken about a month later (see utils/backtesting.py).
+
+The snapshots are parsed in a process pool, through the parsed report cache of main.py, so a
+second backtest (e.g. after changing 'data/forecast_config.csv') does not parse them again.
+
+Writes 'results/backtest.csv' (scores per model and snapshot, and overall) and
+'results/backtest_skus.csv' (scores per model and SKU over all snapshots).
+
+With --tune the WMA weights and the minimum forecast floor are tuned instead: every combination
+of TUNE_WEIGHT_VALUES and TUNE_FLOOR_VALUES is scored on the same snapshots in one batched
+computation (see grid_search_wma), the ranking is written to 'results/tuning.csv' and the best
+combination to 'data/forecast_config.csv'.
+
+Run from the project root:
+    python backtest.py [--models wma,ses,by_class] [--history "Reports history"] [--max-workers N]
+    python backtest.py --tune [--metric wape] [--no-write]
+"""
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+from main import create_data_frame_from_file, load_sales_cube, SELLER_SKU  # noqa: E402
+from utils.sales_cube import sales_cube_matrix, sales_cube_period  # noqa: E402
+from utils.forecast_models import FORECAST_PERIODS, FORECAST_MODELS  # noqa: E402
+from utils.forecasting import (FORECAST_SALES_RULE, MODEL_BY_CLASS_NAME, load_forecast_config,  # noqa: E402
+                               forecast_period_sales, save_forecast_config)
+from utils.backtesting import (list_snapshots, pair_snapshots, score_forecasts, score_by_key, SCORE_COLUMNS,  # noqa: E402
+                               weight_grid, grid_search_wma)
+
+# --- Backtest Configuration ---
+HISTORY_DIR = 'Reports history'
+# Number of snapshots parsed at the same time, each in its own worker process (None: one per CPU)
+BACKTEST_MAX_WORKERS = None
+BACKTEST_RESULT_PATH = './results/backtest.csv'
+BACKTEST_SKU_RESULT_PATH = './results/backtest_skus.csv'
+# ------------------------------------
+
+# --- Weight/Floor Tuning (--tune) ---
+# Each of WMA_WEIGHT_M1/M2/M3 takes every value of TUNE_WEIGHT_VALUES (about 1000 distinct
+# combinations for 0..10) and MIN_FORECAST_FLOOR_FRACTION every value of TUNE_FLOOR_VALUES.
+TUNE_WEIGHT_VALUES = range(0, 11)
+TUNE_FLOOR_VALUES = [round(0.01 * step, 2) for step in range(51)]
+# Score the combinations are ranked by, 'wape' or 'mae'; ties go to the smaller absolute bias
+TUNE_METRIC = 'wape'
+TUNE_RESULT_PATH = './results/tuning.csv'
+# ------------------------------------
+
+
+def load_snapshot(snapshot_dir):
+    """
+    Worker of load_backtest_data: reads the all listings and sales reports of one snapshot.
+
+    Returns:
+        dict: 'skus' (SKUs of the all listings report), 'period_sales' (their sales, shape (SKUs, 5)
+              in FORECAST_PERIODS order) and 'sales_30d' (pd.Series, 30d sales of every SKU of the
+              30d report), all with the sales rule of the forecast.
+    """
+    all_listings_df = create_data_frame_from_file(os.path.join(snapshot_dir, 'all_listings_report'))
+    if all_listings_df is None:
+        raise FileNotFoundError(f"Folder 'all_listings_report' not found in snapshot '{snapshot_dir}'.")
+    sales_cube = load_sales_cube(snapshot_dir)
+    skus = all_listings_df[SELLER_SKU].dropna().unique()
+    return {
+        'skus': skus,
+        'period_sales': sales_cube_matrix(sales_cube, skus, FORECAST_SALES_RULE, FORECAST_PERIODS),
+        'sales_30d': sales_cube_period(sales_cube, '30d', FORECAST_SALES_RULE).fillna(0),
+    }
+
+
+def load_backtest_data(history_dir=HISTORY_DIR, max_workers=BACKTEST_MAX_WORKERS):
+    """
+    Reads the snapshots of `history_dir` in a process pool and pairs each with the sales that followed.
+    Snapshots that cannot be read are reported and skipped.
+
+    Returns:
+        list: One dict per snapshot pair: 'forecast date', 'actual date', 'skus', 'period_sales'
+              (as in load_snapshot) and 'actual' (sales of the SKUs in the following month).
+    """
+    snapshots = list_snapshots(history_dir)
+    pairs = pair_snapshots([date for date, _ in snapshots])
+    if not pairs:
+        print(f"Found {len(snapshots)} snapshot(s) in '{history_dir}' but no two of them about a month apart, "
+              "nothing to backtest.")
+        return []
+
+    needed = sorted({index for pair in pairs for index in pair})
+    max_workers = max_workers or min(len(needed), os.cpu_count() or 1)
+    print(f"Reading {len(needed)} snapshots from '{history_dir}'...")
+    loaded = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {index: executor.submit(load_snapshot, snapshots[index][1]) for index in needed}
+        for index, future in futures.items():
+            try:
+                loaded[index] = future.result()
+            except Exception as e:
+                print(f"Skipping snapshot '{snapshots[index][1]}': {e}")
+
+    data = []
+    for forecast_index, actual_index in pairs:
+        if forecast_index not in loaded or actual_index not in loaded:
+            continue
+        snapshot = loaded[forecast_index]
+        actual = loaded[actual_index]['sales_30d'].reindex(snapshot['skus']).fillna(0).values
+        data.append({
+            'forecast date': snapshots[forecast_index][0],
+            'actual date': snapshots[actual_index][0],
+            'skus': snapshot['skus'],
+            'period_sales': snapshot['period_sales'],
+            'actual': actual,
+        })
+    return data
+
+
+def run_backtest(history_dir=HISTORY_DIR, models=None, max_workers=BACKTEST_MAX_WORKERS):
+    """
+    Backtests the forecast models on the archived snapshots and writes the scores.
+
+    Args:
+        history_dir (str): Folder holding the dated snapshot folders.
+        models (list, optional): Forecast models to score, all of them and 'by_class' by default.
+        max_workers (int, optional): Number of snapshots parsed at the same time.
+
+    Returns:
+        pd.DataFrame: Scores per model and snapshot pair, plus one 'all' row per model.
+    """
+    models = models or FORECAST_MODELS + [MODEL_BY_CLASS_NAME]
+    config = load_forecast_config()
+    data = load_backtest_data(history_dir, max_workers)
+    if not data:
+        return pd.DataFrame()
+
+    rows = []
+    sku_scores = []
+    for model in models:
+        forecasts = []
+        for pair in data:
+            forecast, _ = forecast_period_sales(pair['period_sales'], model, config)
+            forecasts.append(forecast)
+            rows.append({'model': model, 'forecast date': pair['forecast date'], 'actual date': pair['actual date'],
+                         'skus': len(forecast), 'forecast units': forecast.sum(), 'actual units': pair['actual'].sum(),
+                         **score_forecasts(forecast, pair['actual'])})
+
+        forecast = np.concatenate(forecasts)
+        actual = np.concatenate([pair['actual'] for pair in data])
+        rows.append({'model': model, 'forecast date': 'all', 'actual date': 'all',
+                     'skus': len(forecast), 'forecast units': forecast.sum(), 'actual units': actual.sum(),
+                     **score_forecasts(forecast, actual)})
+        scores = score_by_key(np.concatenate([pair['skus'] for pair in data]), forecast, actual)
+        sku_scores.append(scores.rename_axis('sku').reset_index().assign(model=model))
+
+    report = pd.DataFrame(rows)
+    os.makedirs(os.path.dirname(BACKTEST_RESULT_PATH), exist_ok=True)
+    report.to_csv(BACKTEST_RESULT_PATH, index=False)
+    sku_report = pd.concat(sku_scores, ignore_index=True)
+    sku_report = sku_report[['model', 'sku', 'forecasts', 'forecast units', 'actual units'] + SCORE_COLUMNS]
+    sku_report.to_csv(BACKTEST_SKU_RESULT_PATH, index=False)
+
+    overall = report[report['forecast date'] == 'all'].sort_values('wape')
+    print(f"Backtest over {len(data)} snapshot(s), scores over all of them:")
+    print(overall[['model'] + SCORE_COLUMNS].to_string(index=False))
+    print(f"Scores saved to '{BACKTEST_RESULT_PATH}' and '{BACKTEST_SKU_RESULT_PATH}'")
+    return report
+
+
+def run_tuning(history_dir=HISTORY_DIR, max_workers=BACKTEST_MAX_WORKERS, metric=TUNE_METRIC, write_config=True):
+    """
+    Scores every WMA weight and floor combination on the archived snapshots, writes the ranking to
+    TUNE_RESULT_PATH and, with `write_config`, the best combination to 'data/forecast_config.csv'.
+
+    Returns:
+        pd.DataFrame: The combinations, best first, columns 'wma_weight_m1'..'m3',
+                      'min_forecast_floor_fraction' and SCORE_COLUMNS.
+    """
+    if metric not in ['wape', 'mae']:
+        raise ValueError(f"Unknown tuning metric '{metric}'. Use 'wape' or 'mae'.")
+    data = load_backtest_data(history_dir, max_workers)
+    if not data:
+        return pd.DataFrame()
+    period_sales = np.concatenate([pair['period_sales'] for pair in data])
+    actual = np.concatenate([pair['actual'] for pair in data])
+
+    weights = weight_grid(TUNE_WEIGHT_VALUES)
+    floors = np.array(TUNE_FLOOR_VALUES, dtype=float)
+    print(f"Scoring {len(weights) * len(floors)} weight/floor combinations on {len(period_sales)} SKU forecasts...")
+    scores = grid_search_wma(period_sales, actual, weights, floors)
+
+    ranking = pd.DataFrame({
+        'wma_weight_m1': np.repeat(weights[:, 0], len(floors)),
+        'wma_weight_m2': np.repeat(weights[:, 1], len(floors)),
+        'wma_weight_m3': np.repeat(weights[:, 2], len(floors)),
+        'min_forecast_floor_fraction': np.tile(floors, len(weights)),
+        **{name: values.ravel() for name, values in scores.items()},
+    })
+    ranking['abs_bias'] = ranking['bias'].abs()
+    ranking = ranking.sort_values([metric, 'abs_bias'], kind='stable').drop(columns='abs_bias').reset_index(drop=True)
+    os.makedirs(os.path.dirname(TUNE_RESULT_PATH), exist_ok=True)
+    ranking.to_csv(TUNE_RESULT_PATH, index=False)
+
+    config = load_forecast_config()
+    current = grid_search_wma(period_sales, actual,
+                              [[config['WMA_WEIGHT_M1'], config['WMA_WEIGHT_M2'], config['WMA_WEIGHT_M3']]],
+                              [config['MIN_FORECAST_FLOOR_FRACTION']])
+    best = ranking.iloc[0]
+    print(f"Current settings: weights {config['WMA_WEIGHT_M1']:g}/{config['WMA_WEIGHT_M2']:g}/{config['WMA_WEIGHT_M3']:g}, "
+          f"floor {config['MIN_FORECAST_FLOOR_FRACTION']:g}, {metric} {current[metric][0, 0]:.4f}")
+    print(f"Best settings:    weights {best['wma_weight_m1']:g}/{best['wma_weight_m2']:g}/{best['wma_weight_m3']:g}, "
+          f"floor {best['min_forecast_floor_fraction']:g}, {metric} {best[metric]:.4f}")
+    print(f"Ranking saved to '{TUNE_RESULT_PATH}'")
+
+    if write_config:
+        save_forecast_config({
+            'WMA_WEIGHT_M1': float(best['wma_weight_m1']),
+            'WMA_WEIGHT_M2': float(best['wma_weight_m2']),
+            'WMA_WEIGHT_M3': float(best['wma_weight_m3']),
+            'MIN_FORECAST_FLOOR_FRACTION': float(best['min_forecast_floor_fraction']),
+        })
+        print("Best settings saved to 'data/forecast_config.csv'")
+    return ranking
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Backtest the forecast models on the archived exports.")
+    parser.add_argument('--history', default=HISTORY_DIR, help="Folder holding the dated snapshot folders.")
+    parser.add_argument('--models', help="Comma separated models to score, e.g. wma,ses,by_class. All by default.")
+    parser.add_argument('--max-workers', type=int, default=BACKTEST_MAX_WORKERS,
+                        help="Number of snapshots parsed at the same time.")
+    parser.add_argument('--tune', action='store_true',
+                        help="Tune the WMA weights and the minimum forecast floor instead of scoring the models.")
+    parser.add_argument('--metric', choices=['wape', 'mae'], default=TUNE_METRIC,
+                        help="Score the tuning ranks the combinations by.")
+    parser.add_argument('--no-write', action='store_true',
+                        help="Only rank the combinations, leave './data/forecast_config.csv' unchanged.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.tune:
+        run_tuning(args.history, args.max_workers, args.metric, write_config=not args.no_write)
+        sys.exit(0)
+    models = [model.strip() for model in args.models.split(',') if model.strip()] if args.models else None
+    invalid_models = [model for model in models or [] if model not in FORECAST_MODELS + [MODEL_BY_CLASS_NAME]]
+    if invalid_models:
+        print(f"Invalid model(s) {invalid_models}. Allowed values are {FORECAST_MODELS + [MODEL_BY_CLASS_NAME]}.")
+        sys.exit(1)
+    run_backtest(args.history, models, args.max_workers)
@@ -0,0 +1,111 @@
+"""
+Benchmark of the CSV parsing engines used by main.read_file.
+Generates synthetic all listings and 2 year sales exports in a temporary folder and times
+reading them with pandas' C parser and with the PyArrow reader.
+
+Run from the project root:
+    python benchmarks/csv_engines.py [number of listings]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import main  # noqa: E402
+
+
+ALL_LISTINGS_COLUMNS = [
+    'item-name', 'item-description', 'listing-id', 'seller-sku', 'price', 'quantity', 'open-date',
+    'image-url', 'item-is-marketplace', 'product-id-type', 'zshop-shipping-fee', 'item-note',
+    'item-condition', 'zshop-category1', 'zshop-browse-path', 'zshop-storefront-feature', 'asin1',
+    'asin2', 'asin3', 'will-ship-internationally', 'expedited-shipping', 'zshop-boldface',
+    'product-id', 'bid-for-featured-placement', 'add-delete', 'pending-quantity',
+    'fulfillment-channel', 'merchant-shipping-group', 'status',
+]
+
+SALES_COLUMNS = [
+    '(Parent) ASIN', '(Child) ASIN', 'Title', 'SKU', 'Sessions - Total', 'Sessions - Total - B2B',
+    'Session Percentage - Total', 'Page Views - Total', 'Featured Offer (Buy Box) Percentage',
+    'Units Ordered', 'Units Ordered - B2B', 'Unit Session Percentage', 'Ordered Product Sales',
+    'Ordered Product Sales - B2B', 'Total Order Items', 'Total Order Items - B2B',
+]
+
+
+def write_all_listings(path, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\t'.join(ALL_LISTINGS_COLUMNS) + '\n')
+        for i in range(rows):
+            values = {column: 'x' for column in ALL_LISTINGS_COLUMNS}
+            values['item-name'] = f'10 1/2 in x 15 ft Prepasted Wallpaper Border - Garden Wall Paper {i}'
+            values['item-description'] = 'Peel and stick wallpaper border, easy to apply, removable ' * 3
+            values['seller-sku'] = f'{random.randint(0, 99):02d}-{i:06d}-XY'
+            values['price'] = f'{random.uniform(5, 40):.2f}'
+            values['asin1'] = f'B0{random.randint(10 ** 7, 10 ** 8 - 1)}'
+            values['fulfillment-channel'] = random.choice(['DEFAULT', 'AMAZON_NA'])
+            values['status'] = random.choice(['Active', 'Inactive'])
+            values['open-date'] = '2023-05-01 10:00:00 PDT'
+            f.write('\t'.join(values[column] for column in ALL_LISTINGS_COLUMNS) + '\n')
+
+
+def write_sales(path, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(','.join(SALES_COLUMNS) + '\n')
+        for i in range(rows):
+            units = random.randint(0, 3000)
+            values = ['B0PARENT', f'B0{i:08d}', '"Wallpaper Border, Garden"', f'{i:06d}-XY',
+                      f'"{units * 12:,}"', '0', '1.5%', '"1,234"', '95%', f'"{units:,}"', '1', '2%',
+                      f'"${units * 13.5:,.2f}"', '$0.00', str(units), '0']
+            f.write(','.join(values) + '\n')
+
+
+def time_read(file_path, schema, engine, repeat=3):
+    main.CSV_ENGINE = engine
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = main.read_file(file_path, schema=schema)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, df
+
+
+def run(rows):
+    temp_dir = tempfile.mkdtemp(prefix='csv_engines_')
+    try:
+        all_listings_path = os.path.join(temp_dir, 'all_listings.txt')
+        sales_path = os.path.join(temp_dir, 'sales_2yr.csv')
+        write_all_listings(all_listings_path, rows)
+        write_sales(sales_path, rows)
+
+        engines = ['c', 'pyarrow'] if main.PYARROW_AVAILABLE else ['c']
+        if not main.PYARROW_AVAILABLE:
+            print("pyarrow is not installed, only the C parser is benchmarked")
+
+        for name, path, schema in [
+            ('all listings', all_listings_path, main.REPORT_SCHEMAS['all_listings_report']),
+            ('2yr sales', sales_path, main.REPORT_SCHEMAS['2yr']),
+        ]:
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            results = {engine: time_read(path, schema, engine) for engine in engines}
+            line = f"{name:<13} {rows} rows, {size_mb:.0f} MB:"
+            for engine, (elapsed, _) in results.items():
+                line += f"  {engine} {elapsed:.2f}s"
+            if len(results) == 2:
+                line += f"  speedup x{results['c'][0] / results['pyarrow'][0]:.1f}"
+                if not results['c'][1].equals(results['pyarrow'][1]):
+                    line += "  (WARNING: results differ)"
+            print(line)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -0,0 +1,58 @@
+"""
+Benchmark of the forecasting models of utils/forecast_models.py and the demand quantiles of
+utils/demand_quantiles.py.
+Generates random cumulative sales windows (30d/60d/90d/12m/2yr, many SKUs without sales as
+in the real catalog) and times every model and quantile method over all SKUs at once.
+
+Run from the project root:
+    python benchmarks/forecast_models.py [number of SKUs]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+from utils.forecast_models import FORECAST_MODELS, classify_demand  # noqa: E402
+from utils.demand_quantiles import QUANTILE_METHODS, demand_variance, demand_quantiles  # noqa: E402
+from utils.forecasting import MODEL_BY_CLASS_NAME, compute_forecast, load_forecast_config  # noqa: E402
+
+
+def make_period_sales(sku_count, seed=7):
+    rng = np.random.default_rng(seed)
+    # Monthly demand: a third of the SKUs do not sell, the others sell intermittently
+    rate = rng.gamma(0.5, 4.0, sku_count) * (rng.random(sku_count) > 0.33)
+    months = rng.poisson(rate[:, None], (sku_count, 24)).astype(float)
+    cumulative = np.cumsum(months[:, ::-1], axis=1)
+    return cumulative[:, [0, 1, 2, 11, 23]]
+
+
+def main():
+    sku_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    period_sales = make_period_sales(sku_count)
+    config = load_forecast_config()
+    print(f"{sku_count} SKUs")
+
+    start = time.perf_counter()
+    classify_demand(period_sales)
+    print(f"{'classify_demand':<12} {time.perf_counter() - start:.3f}s")
+    for model in FORECAST_MODELS + [MODEL_BY_CLASS_NAME]:
+        start = time.perf_counter()
+        forecast = compute_forecast(period_sales, model, config)
+        print(f"{model:<12} {time.perf_counter() - start:.3f}s")
+
+    variance = demand_variance(period_sales, forecast)
+    for method in QUANTILE_METHODS:
+        start = time.perf_counter()
+        demand_quantiles(forecast, variance, [0.5, 0.9, config['SERVICE_LEVEL']], method=method,
+                         samples=int(config['QUANTILE_SAMPLES']))
+        print(f"{'quantiles ' + method:<22} {time.perf_counter() - start:.3f}s")
+
+
+if __name__ == '__main__':
+    main()
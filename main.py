@@ -1,8 +1,23 @@
+import argparse
 import pandas as pd
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from utils.template_update_generator import preper_new_template_csv
 import numpy as np
-from utils.forecasting import generate_wma_forecast
+from utils.forecasting import (generate_wma_forecast, generate_demand_quantiles, load_forecast_config, compute_forecast,
+                               FORECAST_MODELS, MODEL_BY_CLASS_NAME, FORECAST_SALES_RULE)
+from utils.forecast_models import FORECAST_PERIODS
+from utils.scenarios import build_scenarios, scenario_forecasts, scenario_shipments
+from utils.sales_cube import build_sales_cube, sales_cube_period, sales_cube_matrix
+from utils.fba_merchant_mapping import merchant_segment_sum
+from utils.sku_codes import add_key_ids
+from utils.helpers import MAPPING_REGIONS, load_sku_mapping_table
+from utils.update_resources import update_resources, start_update_resources
+from utils.report_schema import build_report_schemas, build_report_constants, schema_usecols, apply_schema_dtypes, SCHEMA_VERSION, SALES_FOLDERS, WEEKLY_FOLDERS
+from utils.report_cache import compute_cache_key, load_cached_report, store_cached_report
+from utils.file_sniffer import sniff_file, read_header, use_fallback_encoding, FALLBACK_ENCODING
+from utils.arrow_reader import read_csv_arrow, PYARROW_AVAILABLE
+from utils.preflight import preflight_exports, list_report_files
 import traceback
 
 # Read constants from 'config.csv' and map 'const name' to 'column name'
@@ -86,6 +101,64 @@ M_12M = constants['M_12M']
 WMA_FORECAST_COL = constants['WMA_FORECAST']
 REC_SHIP = constants['REC_SHIP']
 
+# Columns (and their types) the pipeline reads from each export folder
+try:
+    REPORT_SCHEMAS = build_report_schemas(config)
+    REPORT_CONSTANTS = build_report_constants(config)
+except KeyError as e:
+    print(f"Error building report schemas from config file: {e}")
+    exit(1)
+
+# --- Parallel Ingestion Configuration ---
+# Number of export subfolders read at the same time. Set to 1 to read them one after another.
+INGESTION_MAX_WORKERS = os.cpu_count() or 1
+# Threads share memory and start instantly; processes avoid the GIL for the
+# CPU-heavy parsing of the big 2yr/all listings files at the cost of copying
+# each parsed DataFrame back to the main process.
+INGESTION_USE_PROCESSES = False
+# ------------------------------------
+
+# --- Parsed Report Cache ---
+# Keep parsed reports in 'data/cache', keyed by file content and schema, so unchanged
+# exports are not parsed again on the next run. Set to False to always parse from scratch.
+REPORT_CACHE_ENABLED = True
+# ------------------------------------
+
+# --- CSV Parsing Engine ---
+# 'auto' parses whole files with the multithreaded PyArrow CSV reader when pyarrow is installed
+# and with pandas' C parser otherwise; 'pyarrow' and 'c' force one of them.
+# Chunked reads (weekly shipments, CHUNKED_SALES_FOLDERS) always use pandas' C parser.
+CSV_ENGINE = 'auto'
+# ------------------------------------
+
+# --- Marketplace Regions ---
+# Region of a plain `python main.py` run: selects the status_<REGION>/fulfillment_<REGION> columns
+# of the SKU mapping and the FBA fulfillment channel (AMAZON_NA or AMAZON_EU).
+DEFAULT_REGION = 'US'
+# Multi-region mode (`python main.py --regions US,UK,DE` or `--all-regions`) reads the exports of each
+# region from '<REGION_EXPORTS_ROOT>/<REGION>' (same folder layout as 'amazon exports') and writes
+# 'data/template_<REGION>.csv' and 'results/result_<REGION>.csv'. A folder of its own: 'amazon exports'
+# may only hold the report folders of the plain run.
+REGION_EXPORTS_ROOT = 'region exports'
+# Number of regions processed at the same time, each in its own worker process (None: one per CPU)
+REGION_MAX_WORKERS = None
+# ------------------------------------
+
+# Number of rows parsed at a time by the streaming readers (weekly shipments, chunked sales reports)
+REPORT_CHUNK_SIZE = 100000
+
+# Sales report folders reduced to one row per SKU while reading, instead of being loaded whole.
+# Peak memory for these reports is bounded by the number of SKUs, not the number of rows.
+CHUNKED_SALES_FOLDERS = ['12m', '2yr']
+# Column added to the reduced sales reports: the largest single-row UNITS_ORDERED + UNITS_ORDERED_B2B
+# of the SKU, so the sales cube can keep its "max over duplicate rows" rule after the reduction.
+SALES_MAX_TOTAL = '_max_total_units'
+
+# How duplicate SKU rows of a sales report are combined for the C30..C2YR and M_30/M_12M columns:
+# 'max_total' (largest single-row units + B2B units), 'sum_total' or 'sum_units' (see utils/sales_cube.py).
+# The forecast uses its own rule, FORECAST_SALES_RULE in utils/forecasting.py.
+TEMPLATE_SALES_RULE = 'max_total'
+
 def columns_to_lower_case(df):
     """
     Convert all column names in a DataFrame to lower case.
@@ -97,13 +170,16 @@ def create_data_frame_from_file(directory):
     """
     Reads files from the specified directory and returns a DataFrame.
     For '1_W', '2_W', '3_W', '4_W' directories, combines multiple files.
-    Supports CSV, TXT, and TSV files.
+    Supports CSV, TXT, and TSV files, optionally compressed as .gz or .zip.
+    The parsed result is cached by file content (see REPORT_CACHE_ENABLED).
     """
     base_dir_name = os.path.basename(os.path.normpath(directory))
     is_weekly_data = base_dir_name in ['1_W', '2_W', '3_W', '4_W']
+    is_chunked_sales = base_dir_name in CHUNKED_SALES_FOLDERS
+    schema = REPORT_SCHEMAS.get(base_dir_name)
 
     try:
-        files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)) and f != '.gitkeep' and f != '.DS_Store']
+        files = list_report_files(directory)
     except FileNotFoundError:
         print(f"Directory '{directory}' not found.")
         return None
@@ -115,43 +191,121 @@ def create_data_frame_from_file(directory):
         else:
             raise ValueError(f"No valid files found in directory '{directory}'")
 
+    if not is_weekly_data and len(files) > 1:
+        raise ValueError(f"More than one valid file found in directory '{directory}'")
+
+    file_paths = [os.path.join(directory, file) for file in files]
+    skip_lines = 7 if is_weekly_data else 0  # summary lines at the top of shipment exports
+
+    cache_key = None
+    if REPORT_CACHE_ENABLED:
+        # Chunked reads always use pandas' C parser, whole files the engine selected by CSV_ENGINE
+        csv_engine = 'c' if is_weekly_data or is_chunked_sales or not _use_arrow_engine() else 'pyarrow'
+        cache_key = compute_cache_key(file_paths, is_weekly_data, is_chunked_sales, skip_lines, schema, SCHEMA_VERSION,
+                                      csv_engine)
+        cached_df = load_cached_report(cache_key)
+        if cached_df is not None:
+            return cached_df
+
     if is_weekly_data:
-        combined_df = pd.DataFrame(columns=[MERCHANT_SKU_W, SHIPPED_W])
-        for file in files:
-            file_path = os.path.join(directory, file)
-            df = read_file(file_path, skip_lines=7)
-            if df is not None:
-                df = df[[MERCHANT_SKU_W, SHIPPED_W]]
-                combined_df = pd.concat([combined_df, df], ignore_index=True)
-
-        # Group by MERCHANT_SKU_W and sum SHIPPED_W
-        combined_df = combined_df.groupby(MERCHANT_SKU_W, as_index=False)[SHIPPED_W].sum()
-        return columns_to_lower_case(combined_df)
+        result_df, all_files_read = aggregate_weekly_shipments(file_paths, schema=schema, skip_lines=skip_lines)
+        # Don't cache a week with unreadable files, the error has to show up again next run
+        if not all_files_read:
+            return result_df
+    elif is_chunked_sales:
+        result_df = reduce_sales_report(file_paths[0], schema=schema)
     else:
-        if len(files) > 1:
-            raise ValueError(f"More than one valid file found in directory '{directory}'")
-        file_path = os.path.join(directory, files[0])
-        return read_file(file_path)
+        result_df = read_file(file_paths[0], schema=schema)
+
+    if cache_key is not None and result_df is not None:
+        store_cached_report(cache_key, result_df)
+    return result_df
+
+def reduce_sales_report(file_path, schema=None, chunksize=None):
+    """
+    Reads a sales report in chunks and keeps one row per SKU with the summed UNITS_ORDERED and
+    UNITS_ORDERED_B2B (used by the forecast) and SALES_MAX_TOTAL, the largest single-row total
+    (used by the sales cube).
+
+    Returns:
+        pd.DataFrame: Reduced report, or None if the file could not be read.
+    """
+    def fold(reduced, chunk):
+        for col in [SKU, UNITS_ORDERED, UNITS_ORDERED_B2B]:
+            if col not in chunk.columns:
+                raise KeyError(f"Column '{col}' not found in sales report '{file_path}'.")
+        chunk = chunk[[SKU, UNITS_ORDERED, UNITS_ORDERED_B2B]].copy()
+        chunk[SALES_MAX_TOTAL] = chunk[UNITS_ORDERED] + chunk[UNITS_ORDERED_B2B]
+        if reduced is not None:
+            chunk = pd.concat([reduced, chunk], ignore_index=True)
+        return chunk.groupby(SKU, as_index=False).agg(
+            {UNITS_ORDERED: 'sum', UNITS_ORDERED_B2B: 'sum', SALES_MAX_TOTAL: 'max'}
+        )
+
+    return fold_file_chunks(file_path, fold, schema=schema, chunksize=chunksize)
+
+def _use_arrow_engine():
+    if CSV_ENGINE == 'pyarrow' and not PYARROW_AVAILABLE:
+        raise ImportError("CSV_ENGINE is 'pyarrow' but pyarrow is not installed (pip install pyarrow)")
+    return CSV_ENGINE in ('auto', 'pyarrow') and PYARROW_AVAILABLE
+
+def _read_csv_with_arrow(file_path, file_format, skip_lines=0, schema=None):
+    """
+    Parses a whole file with the PyArrow reader. Returns None if Arrow can't parse it,
+    so the caller falls back to pandas' C parser (which also reports encoding errors).
+    """
+    usecols = None
+    if schema is not None:
+        usecols = [column for column in read_header(file_path, skip_lines) if column.lower() in schema]
+    try:
+        return read_csv_arrow(file_path, file_format, skip_lines, usecols=usecols, as_strings=schema is not None)
+    except Exception as e:
+        print(f"PyArrow could not parse '{file_path}' ({e}), using the default parser")
+        return None
 
-def read_file(file_path, skip_lines=0):
+def _open_csv(file_path, file_format, skip_lines=0, schema=None, chunksize=None):
+    """
+    Parses a file with the encoding, separator and compression detected by sniff_file.
+    Returns a DataFrame, or an iterator of DataFrames when chunksize is given.
+    """
+    if chunksize is None and _use_arrow_engine():
+        df = _read_csv_with_arrow(file_path, file_format, skip_lines, schema)
+        if df is not None:
+            return df
+
+    read_kwargs = dict(file_format)
+    read_kwargs['skiprows'] = skip_lines
+    if schema is not None:
+        read_kwargs['usecols'] = schema_usecols(schema)
+        read_kwargs['dtype'] = str
+    if chunksize is not None:
+        read_kwargs['chunksize'] = chunksize
+
+    return pd.read_csv(file_path, **read_kwargs)
+
+def _normalize_data_frame(df, schema=None):
+    """
+    Lowercases the headers of a freshly read DataFrame and applies the schema types.
+    """
+    df = columns_to_lower_case(df)
+    if schema is not None:
+        df = apply_schema_dtypes(df, schema)
+    return df
+
+def read_file(file_path, skip_lines=0, schema=None):
     """
     Reads a file and returns a DataFrame.
+    The encoding, separator and compression (.gz/.zip) are detected from the start of the file,
+    so the file is parsed once.
+    If a schema ({lower case column name: column type}) is given, only those columns are loaded
+    and they are parsed with the declared types. Otherwise all columns are loaded with inferred dtypes.
     """
-    file_extension = os.path.splitext(file_path)[1].lower()
-    
     try:
-        if file_extension == '.csv':
-            df = pd.read_csv(file_path, encoding='utf-8', skiprows=skip_lines)
-        elif file_extension in ['.txt', '.tsv']:
-            df = pd.read_csv(file_path, sep='\t', encoding='utf-8', skiprows=skip_lines)
-        else:
-            raise ValueError(f"Unsupported file extension '{file_extension}' in file '{file_path}'")
+        df = _open_csv(file_path, sniff_file(file_path, skip_lines), skip_lines, schema)
     except UnicodeDecodeError:
+        # Only happens when the invalid bytes are past the sniffed prefix
         try:
-            if file_extension == '.csv':
-                df = pd.read_csv(file_path, encoding='ISO-8859-1', skiprows=skip_lines)
-            elif file_extension in ['.txt', '.tsv']:
-                df = pd.read_csv(file_path, sep='\t', encoding='ISO-8859-1', skiprows=skip_lines)
+            df = _open_csv(file_path, use_fallback_encoding(file_path, skip_lines), skip_lines, schema)
         except Exception as e:
             print(f"Failed to read file '{file_path}': {e}")
             return None
@@ -159,14 +313,100 @@ def read_file(file_path, skip_lines=0):
         print(f"Failed to read file '{file_path}': {e}")
         return None
 
-    return columns_to_lower_case(df)
+    return _normalize_data_frame(df, schema)
+
+def fold_file_chunks(file_path, fold, skip_lines=0, schema=None, chunksize=None):
+    """
+    Reads a file in chunks of `chunksize` rows and folds every normalized chunk into an
+    accumulator with acc = fold(acc, chunk), starting from acc = None.
+    Only the accumulator and one chunk are held in memory at a time.
+
+    Returns:
+        The final accumulator, or None if the file could not be read.
+        KeyErrors raised by fold (missing columns) are propagated.
+    """
+    if chunksize is None:
+        chunksize = REPORT_CHUNK_SIZE
+
+    try:
+        file_format = sniff_file(file_path, skip_lines)
+    except Exception as e:
+        print(f"Failed to read file '{file_path}': {e}")
+        return None
+
+    while True:
+        acc = None
+        try:
+            with _open_csv(file_path, file_format, skip_lines, schema, chunksize=chunksize) as reader:
+                for chunk in reader:
+                    acc = fold(acc, _normalize_data_frame(chunk, schema))
+            return acc
+        except UnicodeDecodeError as e:
+            # Invalid bytes past the sniffed prefix: start over with the fallback encoding,
+            # the partial accumulator is discarded
+            if file_format['encoding'] != FALLBACK_ENCODING:
+                file_format = use_fallback_encoding(file_path, skip_lines)
+                continue
+            print(f"Failed to read file '{file_path}': {e}")
+            return None
+        except KeyError:
+            raise
+        except Exception as e:
+            print(f"Failed to read file '{file_path}': {e}")
+            return None
+
+def aggregate_weekly_shipments(file_paths, schema=None, skip_lines=7, chunksize=None):
+    """
+    Streams the shipment files of a weekly folder and sums SHIPPED_W per MERCHANT_SKU_W.
+    Memory stays bounded by the number of distinct SKUs, not by the number of files or rows.
 
-def create_data_frames_from_directories(directory):
+    Returns:
+        tuple: (DataFrame with MERCHANT_SKU_W and SHIPPED_W columns, True if every file could be read)
+    """
+    def fold(totals, chunk):
+        chunk_totals = chunk.groupby(MERCHANT_SKU_W)[SHIPPED_W].sum()
+        return chunk_totals if totals is None else totals.add(chunk_totals, fill_value=0)
+
+    totals = None
+    all_files_read = True
+    for file_path in file_paths:
+        file_totals = fold_file_chunks(file_path, fold, skip_lines=skip_lines, schema=schema, chunksize=chunksize)
+        if file_totals is None:
+            all_files_read = False
+            continue
+        totals = file_totals if totals is None else totals.add(file_totals, fill_value=0)
+
+    if totals is None:
+        return pd.DataFrame(columns=[MERCHANT_SKU_W, SHIPPED_W]), all_files_read
+
+    # Aligning SKUs across chunks turns the counts into floats
+    if pd.api.types.is_float_dtype(totals) and (totals % 1 == 0).all():
+        totals = totals.astype('int64')
+    totals = totals.sort_index()
+    totals.index.name = MERCHANT_SKU_W
+    return totals.reset_index(name=SHIPPED_W), all_files_read
+
+def create_data_frames_from_directories(directory, max_workers=None, use_processes=None):
     """
     Reads files from subdirectories of the specified directory and creates a dictionary of DataFrames.
     Each subdirectory is expected to contain one file.
+
+    The subdirectories are read concurrently in a thread or process pool.
+
+    Args:
+        directory (str): Directory containing one subfolder per report.
+        max_workers (int, optional): Number of folders read at the same time.
+                                     Defaults to INGESTION_MAX_WORKERS; 1 reads sequentially.
+        use_processes (bool, optional): Use a process pool instead of a thread pool.
+                                        Defaults to INGESTION_USE_PROCESSES.
+
+    Returns:
+        dict: A dictionary mapping subfolder name to its DataFrame, in directory listing order.
     """
-    data_frames = {}
+    if max_workers is None:
+        max_workers = INGESTION_MAX_WORKERS
+    if use_processes is None:
+        use_processes = INGESTION_USE_PROCESSES
 
     try:
         subdirectories = os.listdir(directory)
@@ -174,217 +414,226 @@ def create_data_frames_from_directories(directory):
         print(f"Directory '{directory}' not found.")
         raise FileNotFoundError(f"Directory '{directory}' not found.")
 
+    subdir_paths = {}
     for subdir in subdirectories:
         subdir_path = os.path.join(directory, subdir)
         if os.path.isdir(subdir_path):
-            try:
-                df = create_data_frame_from_file(subdir_path)
-                if df is not None:
-                    data_frames[subdir] = df
-            except ValueError as e:
-                print(f"Error in directory '{subdir_path}': {e}")
-                raise e
-            except Exception as e:
-                print(f"An error occurred while processing directory '{subdir_path}': {e}")
-                raise e
+            subdir_paths[subdir] = subdir_path
+
+    data_frames = {}
+    if not subdir_paths:
+        return data_frames
+
+    max_workers = max(1, min(max_workers, len(subdir_paths)))
+    if max_workers == 1:
+        for subdir, subdir_path in subdir_paths.items():
+            _store_data_frame(data_frames, subdir, subdir_path, lambda: create_data_frame_from_file(subdir_path))
+        return data_frames
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers) as executor:
+        futures = {subdir: executor.submit(create_data_frame_from_file, subdir_path)
+                   for subdir, subdir_path in subdir_paths.items()}
+        try:
+            for subdir, future in futures.items():
+                _store_data_frame(data_frames, subdir, subdir_paths[subdir], future.result)
+        except Exception:
+            # Don't start folders that are still queued, the run is going to fail anyway
+            for future in futures.values():
+                future.cancel()
+            raise
 
     return data_frames
 
-def update_template_with_price_data(template_df, all_listings_report_df):
+def load_sales_cube(exports_dir):
     """
-    Updates the 'PRICE' column in the template DataFrame using data from the 'all_listings_report_df'.
-    If FBA_SKU is '-', it tries to find the price using the M_SKU.
+    Reads only the sales reports (30d..2yr) of an exports folder, through the parsed report cache,
+    and returns their sales cube (see utils/sales_cube.py).
     """
-    # Check if required columns exist
-    if SELLER_SKU not in all_listings_report_df.columns or PRICE not in all_listings_report_df.columns:
-        raise KeyError(f"Required columns '{SELLER_SKU}' or '{PRICE}' not found in 'all_listings_report_df'.")
-
-    if FBA_SKU not in template_df.columns or M_SKU not in template_df.columns:
-        raise KeyError(f"Required columns '{FBA_SKU}' or '{M_SKU}' not found in 'template_df'.")
-
-    # Create a mapping from SELLER_SKU to PRICE
-    # Ensure index is string type for reliable lookup
-    all_listings_report_df[SELLER_SKU] = all_listings_report_df[SELLER_SKU].astype(str)
-    price_map = all_listings_report_df.set_index(SELLER_SKU)[PRICE].to_dict()
-
-    # Define a function to get the price based on FBA_SKU or M_SKU
-    def get_price(row):
-        fba_sku = str(row[FBA_SKU]).strip()
-        m_sku = str(row[M_SKU]).strip() # Renamed variable for clarity
-
-        # Default price if not found
-        price_to_set = np.nan
-
-        # Try FBA_SKU first (unless it's '-')
-        if fba_sku != '-' and fba_sku in price_map:
-            price_to_set = price_map[fba_sku]
-        # If FBA_SKU is '-', try the single M_SKU
-        elif fba_sku == '-' and pd.notna(m_sku) and m_sku != '' and m_sku in price_map:
-            price_to_set = price_map[m_sku]
-        # As a fallback, if FBA SKU exists but wasn't found initially (e.g., data type issues resolved by map creation)
-        elif fba_sku != '-' and fba_sku in price_map:
-            price_to_set = price_map[fba_sku]
-
-        return price_to_set
-
-    # Apply the function to update the PRICE column
-    template_df[PRICE] = template_df.apply(get_price, axis=1)
-
-    # Optional: Print SKUs that were not found in the price_map (might need adjustment based on new logic)
-    # Consider how to report missing SKUs now (e.g., rows where PRICE is still NaN)
-    missing_price_rows = template_df[template_df[PRICE].isnull()]
-    if not missing_price_rows.empty:
-        print(f"Could not find price for {len(missing_price_rows)} rows. Example FBA/M SKUs:")
-        print(missing_price_rows[[FBA_SKU, M_SKU]].head())
-
-    return template_df
-
-def update_template_with_availability_data(template_df, FBA_inventory_report_df, restock_report_df):
+    sales_dfs = {}
+    for period in FORECAST_PERIODS:
+        df = create_data_frame_from_file(os.path.join(exports_dir, period))
+        if df is None:
+            raise FileNotFoundError(f"Folder '{period}' not found in '{exports_dir}'.")
+        sales_dfs[period] = df
+    return build_sales_cube(sales_dfs, sku_col=SKU, units_col=UNITS_ORDERED, units_b2b_col=UNITS_ORDERED_B2B,
+                            max_total_col=SALES_MAX_TOTAL)
+
+def _store_data_frame(data_frames, subdir, subdir_path, load):
     """
-    Updates the 'INV' column in the template DataFrame using availability data from FBA inventory and restock reports.
+    Calls load() and stores the resulting DataFrame under subdir, reporting errors the same way for
+    sequential and parallel ingestion.
     """
-    # Check if required columns exist in the data frames
-    required_columns_fba = [SKU, AVAILABLE]
-    required_columns_restock = [MERCHANT_SKU, AVAILABLE]
-    required_columns_template = [FBA_SKU]
-
-    for col in required_columns_fba:
-        if col not in FBA_inventory_report_df.columns:
-            raise KeyError(f"Column '{col}' not found in 'FBA_inventory_report_df'.")
+    try:
+        df = load()
+        if df is not None:
+            data_frames[subdir] = df
+    except ValueError as e:
+        print(f"Error in directory '{subdir_path}': {e}")
+        raise e
+    except Exception as e:
+        print(f"An error occurred while processing directory '{subdir_path}': {e}")
+        raise e
 
-    for col in required_columns_restock:
-        if col not in restock_report_df.columns:
-            raise KeyError(f"Column '{col}' not found in 'restock_report_df'.")
+# Columns of the SKU fact table built by build_sku_fact_table
+FACT_PRICE = 'price'
+FACT_FBA_AVAILABLE = 'fba_available'
+FACT_RESTOCK_AVAILABLE = 'restock_available'
+FACT_FBA_INBOUND = 'fba_inbound'
+FACT_RESTOCK_INBOUND = 'restock_inbound'
+WEEK_COLUMNS = ['1_w', '2_w', '3_w', '4_w']
 
-    for col in required_columns_template:
-        if col not in template_df.columns:
-            raise KeyError(f"Column '{col}' not found in 'template_df'.")
+def _check_columns(df, required_columns, df_name):
+    for col in required_columns:
+        if col not in df.columns:
+            raise KeyError(f"Column '{col}' not found in '{df_name}'.")
 
-    # Create mappings of SKU to available quantity
-    FBA_available_map = FBA_inventory_report_df.set_index(SKU)[AVAILABLE].to_dict()
-    restock_available_map = restock_report_df.set_index(MERCHANT_SKU)[AVAILABLE].to_dict()
+def _sku_column(df, sku_col, value_col):
+    """
+    Returns value_col of df indexed by sku_col. For duplicated SKUs the last row wins,
+    like set_index(...).to_dict() did.
+    """
+    values = df[[sku_col, value_col]].dropna(subset=[sku_col])
+    values = values.drop_duplicates(subset=[sku_col], keep='last')
+    return values.set_index(sku_col)[value_col]
 
-    # Update the 'INV' column in template_df
-    def get_inventory(sku):
-        if sku in FBA_available_map and FBA_available_map[sku] > 0:
-            return FBA_available_map[sku]
-        elif sku in restock_available_map and restock_available_map[sku] > 0:
-            return restock_available_map[sku]
-        else:
-            return 0
+def _as_int_if_integral(values):
+    """Casts a float Series without missing values back to int64 if it holds whole numbers."""
+    if pd.api.types.is_float_dtype(values) and values.notna().all() and (values % 1 == 0).all():
+        return values.astype('int64')
+    return values
 
-    template_df[INV] = template_df[FBA_SKU].apply(get_inventory)
+def build_sku_fact_table(all_listings_report_df=None, FBA_inventory_report_df=None, restock_report_df=None, weekly_dfs=None):
+    """
+    Builds one SKU-indexed table holding the per-SKU facts of all reports:
+    FACT_PRICE (all listings), FACT_FBA_AVAILABLE / FACT_FBA_INBOUND (FBA inventory),
+    FACT_RESTOCK_AVAILABLE / FACT_RESTOCK_INBOUND (restock report) and the shipped units
+    of each week in WEEK_COLUMNS. Reports that are not given are left out.
 
-    return template_df
+    Args:
+        all_listings_report_df (pd.DataFrame, optional): All listings report.
+        FBA_inventory_report_df (pd.DataFrame, optional): FBA inventory report.
+        restock_report_df (pd.DataFrame, optional): Restock inventory report.
+        weekly_dfs (list, optional): The 1_W, 2_W, 3_W and 4_W shipment DataFrames.
 
-def update_template_with_inbound_quantity_data(template_df, FBA_inventory_report_df, restock_report_df):
+    Returns:
+        pd.DataFrame: Fact table indexed by SKU.
     """
-    Updates the 'INBOUND' column in the template DataFrame using inbound quantity data from FBA inventory and restock reports.
+    fact_columns = {}
+
+    if all_listings_report_df is not None:
+        _check_columns(all_listings_report_df, [SELLER_SKU, PRICE], 'all_listings_report_df')
+        # Keys are strings for reliable lookup
+        prices = all_listings_report_df[[SELLER_SKU, PRICE]].copy()
+        prices[SELLER_SKU] = prices[SELLER_SKU].astype(str)
+        fact_columns[FACT_PRICE] = _sku_column(prices, SELLER_SKU, PRICE)
+
+    if FBA_inventory_report_df is not None and restock_report_df is not None:
+        _check_columns(FBA_inventory_report_df, [SKU, AVAILABLE, INBOUND_QUANTITY], 'FBA_inventory_report_df')
+        _check_columns(restock_report_df, [MERCHANT_SKU, AVAILABLE, INBOUND], 'restock_report_df')
+
+        # Check for duplicates in SKU columns
+        if FBA_inventory_report_df[SKU].duplicated().any():
+            duplicates = FBA_inventory_report_df[FBA_inventory_report_df[SKU].duplicated()][SKU].unique()
+            print(f"FBA_inventory_report_df has duplicates in the '{SKU}' column: {duplicates}")
+
+        if restock_report_df[MERCHANT_SKU].duplicated().any():
+            duplicates = restock_report_df[restock_report_df[MERCHANT_SKU].duplicated()][MERCHANT_SKU].unique()
+            print(f"restock_report_df has duplicates in the '{MERCHANT_SKU}' column: {duplicates}")
+
+        fact_columns[FACT_FBA_AVAILABLE] = _sku_column(FBA_inventory_report_df, SKU, AVAILABLE)
+        fact_columns[FACT_FBA_INBOUND] = _sku_column(FBA_inventory_report_df, SKU, INBOUND_QUANTITY)
+        fact_columns[FACT_RESTOCK_AVAILABLE] = _sku_column(restock_report_df, MERCHANT_SKU, AVAILABLE)
+        fact_columns[FACT_RESTOCK_INBOUND] = _sku_column(restock_report_df, MERCHANT_SKU, INBOUND)
+
+    if weekly_dfs is not None:
+        for df, week in zip(weekly_dfs, WEEK_COLUMNS):
+            for col in [MERCHANT_SKU_W, SHIPPED_W]:
+                if col not in df.columns:
+                    raise KeyError(f"Column '{col}' not found in data for '{week}'.")
+            fact_columns[week] = _sku_column(df, MERCHANT_SKU_W, SHIPPED_W)
+
+    if not fact_columns:
+        return pd.DataFrame()
+    return pd.concat(fact_columns, axis=1)
+
+def fill_template_from_sku_facts(template_df, sku_facts):
     """
-    # Check for duplicates in SKU columns
-    if FBA_inventory_report_df[SKU].duplicated().any():
-        duplicates = FBA_inventory_report_df[FBA_inventory_report_df[SKU].duplicated()][SKU].unique()
-        print(f"FBA_inventory_report_df has duplicates in the '{SKU}' column: {duplicates}")
-
-    if restock_report_df[MERCHANT_SKU].duplicated().any():
-        duplicates = restock_report_df[restock_report_df[MERCHANT_SKU].duplicated()][MERCHANT_SKU].unique()
-        print(f"restock_report_df has duplicates in the '{MERCHANT_SKU}' column: {duplicates}")
-
-    # Check if required columns exist
-    required_columns_fba = [SKU, INBOUND_QUANTITY]
-    required_columns_restock = [MERCHANT_SKU, INBOUND]
-    required_columns_template = [FBA_SKU]
+    Fills the PRICE, INV, INBOUND and weekly shipment columns of the template from the SKU fact table
+    with a vectorized lookup per row key. Only the columns present in the fact table are filled.
+
+    Rules:
+    - PRICE: the price of FBA_SKU; for standalone merchant rows (FBA_SKU '-') the price of M_SKU.
+    - INV / INBOUND: the FBA inventory value of FBA_SKU if positive, else the restock report value
+      if positive, else 0.
+    - 1_w..4_w: the units shipped for FBA_SKU that week, empty if none.
+    """
+    if FBA_SKU not in template_df.columns or M_SKU not in template_df.columns:
+        raise KeyError(f"Required columns '{FBA_SKU}' or '{M_SKU}' not found in 'template_df'.")
 
-    for col in required_columns_fba:
-        if col not in FBA_inventory_report_df.columns:
-            raise KeyError(f"Column '{col}' not found in 'FBA_inventory_report_df'.")
+    fba_skus = template_df[FBA_SKU]
+    facts_by_fba_sku = sku_facts.reindex(fba_skus.values)
 
-    for col in required_columns_restock:
-        if col not in restock_report_df.columns:
-            raise KeyError(f"Column '{col}' not found in 'restock_report_df'.")
+    if FACT_PRICE in sku_facts.columns:
+        # Price lookups use the stripped SKU strings
+        fba_keys = fba_skus.astype(str).str.strip()
+        merchant_keys = template_df[M_SKU].astype(str).str.strip()
+        price_keys = fba_keys.where(fba_keys != '-', merchant_keys)
+        template_df[PRICE] = sku_facts[FACT_PRICE].reindex(price_keys.values).values
 
-    for col in required_columns_template:
-        if col not in template_df.columns:
-            raise KeyError(f"Column '{col}' not found in 'template_df'.")
+        missing_price_rows = template_df[template_df[PRICE].isnull()]
+        if not missing_price_rows.empty:
+            print(f"Could not find price for {len(missing_price_rows)} rows. Example FBA/M SKUs:")
+            print(missing_price_rows[[FBA_SKU, M_SKU]].head())
 
-    # Create mappings of SKU to inbound quantity
-    FBA_inbound_map = FBA_inventory_report_df.set_index(SKU)[INBOUND_QUANTITY].to_dict()
-    restock_inbound_map = restock_report_df.set_index(MERCHANT_SKU)[INBOUND].to_dict()
+    def coalesce_positive(primary_col, fallback_col):
+        primary = facts_by_fba_sku[primary_col]
+        fallback = facts_by_fba_sku[fallback_col]
+        values = primary.where(primary > 0, fallback.where(fallback > 0, 0))
+        return _as_int_if_integral(values).values
 
-    # Update the 'INBOUND' column in template_df
-    def get_inbound_quantity(sku):
-        if sku in FBA_inbound_map and FBA_inbound_map[sku] > 0:
-            return FBA_inbound_map[sku]
-        elif sku in restock_inbound_map and restock_inbound_map[sku] > 0:
-            return restock_inbound_map[sku]
-        else:
-            return 0
+    if FACT_FBA_AVAILABLE in sku_facts.columns:
+        template_df[INV] = coalesce_positive(FACT_FBA_AVAILABLE, FACT_RESTOCK_AVAILABLE)
+        template_df[INBOUND] = coalesce_positive(FACT_FBA_INBOUND, FACT_RESTOCK_INBOUND)
 
-    template_df[INBOUND] = template_df[FBA_SKU].apply(get_inbound_quantity)
+    for week in WEEK_COLUMNS:
+        if week in sku_facts.columns:
+            template_df[week] = _as_int_if_integral(facts_by_fba_sku[week]).fillna('').values
 
     return template_df
 
-def sales_to_dict(sales_report_df):
-    """
-    Converts sales data into a dictionary mapping SKU to total units ordered.
-    """
-    # Check if required columns exist
-    required_columns = [SKU, UNITS_ORDERED, UNITS_ORDERED_B2B]
-    for col in required_columns:
-        if col not in sales_report_df.columns:
-            raise KeyError(f"Column '{col}' not found in 'sales_report_df'.")
-
-    # Convert columns to numeric, handling commas and missing values
-    sales_report_df[UNITS_ORDERED] = pd.to_numeric(sales_report_df[UNITS_ORDERED].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-    sales_report_df[UNITS_ORDERED_B2B] = pd.to_numeric(sales_report_df[UNITS_ORDERED_B2B].astype(str).str.replace(',', ''), errors='coerce').fillna(0)
-
-    # Calculate total units ordered per SKU
-    sales_data = {}
-    for index, row in sales_report_df.iterrows():
-        sku = row[SKU]
-        units_ordered = row[UNITS_ORDERED]
-        units_ordered_b2b = row[UNITS_ORDERED_B2B]
-        total_units_ordered = units_ordered + units_ordered_b2b
-        if sku in sales_data:
-            sales_data[sku] = max(sales_data[sku], total_units_ordered)
-        else:
-            sales_data[sku] = total_units_ordered
-
-    return sales_data
-
-def update_template_with_sales_data(template_df, df_30, df_60, df_90, df_12_m, df_2yr):
+def update_template_with_sales_data(template_df, sales_cube, fba_merchant_graph=None):
     """
-    Updates the template DataFrame with sales data for 30, 60, 90 days, and 12 months.
-    Also processes merchant SKU sales for M_30 and M_12M columns.
+    Updates the template DataFrame with sales data for 30, 60, 90 days, 12 months and 2 years
+    from the sales cube, combining duplicate report rows with TEMPLATE_SALES_RULE.
+    Also processes merchant SKU sales for M_30 and M_12M columns: for FBA rows the sales of
+    their merchant SKUs in fba_merchant_graph are summed, standalone merchant rows use their
+    own M_SKU. Without a graph the comma separated M_SKU strings are split instead.
     """
-    # Generate sales data dictionaries
-    sales_30 = sales_to_dict(df_30)
-    sales_60 = sales_to_dict(df_60)
-    sales_90 = sales_to_dict(df_90)
-    sales_12_m = sales_to_dict(df_12_m)
-    sales_2yr = sales_to_dict(df_2yr)
-
     # Update the template DataFrame with FBA SKU sales
-    template_df[C30] = template_df[FBA_SKU].map(sales_30).fillna(0)
-    template_df[C60] = template_df[FBA_SKU].map(sales_60).fillna(0)
-    template_df[C90] = template_df[FBA_SKU].map(sales_90).fillna(0)
-    template_df[C12M] = template_df[FBA_SKU].map(sales_12_m).fillna(0)
-    template_df[C2YR] = template_df[FBA_SKU].map(sales_2yr).fillna(0)
-    
-    # Process merchant SKU sales
-    def get_merchant_sales(merchant_sku_str, sales_dict):
-        if pd.isna(merchant_sku_str) or merchant_sku_str == '':
-            return 0
-        # Split merchant SKUs by comma and remove whitespace
-        merchant_skus = [sku.strip() for sku in str(merchant_sku_str).split(',')]
-        # Sum up sales for all merchant SKUs
-        total_sales = sum(sales_dict.get(sku, 0) for sku in merchant_skus)
-        return total_sales
-
-    # Update merchant sales columns
-    template_df[M_30] = template_df[M_SKU].apply(lambda x: get_merchant_sales(x, sales_30))
-    template_df[M_12M] = template_df[M_SKU].apply(lambda x: get_merchant_sales(x, sales_12_m))
-    
+    for col, period in [(C30, '30d'), (C60, '60d'), (C90, '90d'), (C12M, '12m'), (C2YR, '2yr')]:
+        period_sales = sales_cube_period(sales_cube, period, TEMPLATE_SALES_RULE)
+        values = period_sales.reindex(template_df[FBA_SKU].values)
+        template_df[col] = _as_int_if_integral(values).fillna(0).values
+
+    if fba_merchant_graph is not None:
+        # Rows of FBA SKUs in the graph are summed over the graph, the others hold at most one merchant SKU
+        graph_rows = fba_merchant_graph['fba_skus'].get_indexer(template_df[FBA_SKU].values)
+        in_graph = graph_rows >= 0
+        merchant_skus = template_df[M_SKU].where(~in_graph, '').fillna('').astype(str).str.strip()
+    else:
+        merchant_skus = template_df[M_SKU].fillna('').astype(str).str.split(',').explode().str.strip()
+
+    for col, period in [(M_30, '30d'), (M_12M, '12m')]:
+        period_sales = sales_cube_period(sales_cube, period, TEMPLATE_SALES_RULE)
+        values = pd.Series(period_sales.reindex(merchant_skus.values).fillna(0).values, index=merchant_skus.index)
+        values = values.groupby(level=0).sum().reindex(template_df.index)
+        if fba_merchant_graph is not None:
+            merchant_values = period_sales.reindex(fba_merchant_graph['merchant_skus']).fillna(0).values
+            graph_sums = merchant_segment_sum(fba_merchant_graph, merchant_values)
+            values[in_graph] = graph_sums[graph_rows[in_graph]]
+        template_df[col] = _as_int_if_integral(values).values
+
     return template_df
 
 def pre_clean(template_df):
@@ -408,6 +657,28 @@ def pre_clean(template_df):
 
     return template_df
 
+def add_report_key_ids(data_frames):
+    """
+    Adds the run-wide SKU (and for the all listings report ASIN) id columns to every report
+    (see utils/sku_codes.py).
+    """
+    listing_asin_col = {const: col for col, const in REPORT_CONSTANTS['all_listings_report'].items()}['ASIN1']
+    key_columns = {
+        'all_listings_report': (SELLER_SKU, listing_asin_col),
+        'FBA_Inventory': (SKU, None),
+        'restock_report': (MERCHANT_SKU, None),
+    }
+    for folder in SALES_FOLDERS:
+        key_columns[folder] = (SKU, None)
+    for folder in WEEKLY_FOLDERS:
+        key_columns[folder] = (MERCHANT_SKU_W, None)
+
+    for name, df in data_frames.items():
+        if name in key_columns:
+            sku_col, asin_col = key_columns[name]
+            add_key_ids(df, sku_col, asin_col)
+    return data_frames
+
 def print_data_frame_headers(data_frames):
     """
     Prints the column names of each DataFrame in the provided dictionary.
@@ -417,50 +688,37 @@ def print_data_frame_headers(data_frames):
         print(df.columns.tolist())
         print("\n")
 
-def update_template_with_last_shipments_data(template_df, df_1_W, df_2_W, df_3_W, df_4_W):
+def _forecast_keys(template_df):
+    """SKU the forecast of each template row belongs to: FBA_SKU, or M_SKU for merchant rows (FBA_SKU '-')."""
+    return template_df[FBA_SKU].where(template_df[FBA_SKU] != '-', template_df[M_SKU])
+
+def _counted_1w(template_df, inbound):
     """
-    Updates the template DataFrame with the last shipments data from the given DataFrames.
+    Returns (numeric 1_w, bool array of the rows whose 1_w is added to INBOUND): a numeric 1_w
+    greater than INBOUND is a shipment the inbound report does not show yet. Empty or non
+    numeric 1_w values are not counted. Both are None without a 1_w column.
     """
-    # Check if required columns exist
-    required_columns = [MERCHANT_SKU_W, SHIPPED_W]
-    for df, week in zip([df_1_W, df_2_W, df_3_W, df_4_W], ['1_w', '2_w', '3_w', '4_w']):
-        for col in required_columns:
-            if col not in df.columns:
-                raise KeyError(f"Column '{col}' not found in data for '{week}'.")
-
-    # Create mappings from MERCHANT_SKU_W to SHIPPED_W
-    last_shipped_map_1_w = df_1_W.set_index(MERCHANT_SKU_W)[SHIPPED_W].to_dict()
-    last_shipped_map_2_w = df_2_W.set_index(MERCHANT_SKU_W)[SHIPPED_W].to_dict()
-    last_shipped_map_3_w = df_3_W.set_index(MERCHANT_SKU_W)[SHIPPED_W].to_dict()
-    last_shipped_map_4_w = df_4_W.set_index(MERCHANT_SKU_W)[SHIPPED_W].to_dict()
-
-    # Update the template DataFrame
-    template_df['1_w'] = template_df[FBA_SKU].map(last_shipped_map_1_w).fillna('')
-    template_df['2_w'] = template_df[FBA_SKU].map(last_shipped_map_2_w).fillna('')
-    template_df['3_w'] = template_df[FBA_SKU].map(last_shipped_map_3_w).fillna('')
-    template_df['4_w'] = template_df[FBA_SKU].map(last_shipped_map_4_w).fillna('')
-
-    return template_df
+    if '1_w' not in template_df.columns:
+        return None, None
+    numeric_1w = pd.to_numeric(template_df['1_w'], errors='coerce').to_numpy()
+    adds_1w = ~np.isnan(numeric_1w.astype(float)) & (numeric_1w > inbound)
+    return numeric_1w, adds_1w
 
 def update_template_with_forecast(template_df, wma_forecast_dict):
     """
     Updates the template DataFrame with the WMA forecast data.
+    Rows are matched on FBA_SKU, or on M_SKU for merchant rows (FBA_SKU '-').
+    Rows without a forecast keep their current value.
     """
     # Verify the forecast column exists
     if WMA_FORECAST_COL not in template_df.columns:
         return template_df
-    
-    for index, row in template_df.iterrows():
-        try:
-            if row[FBA_SKU] == '-':
-                if row[M_SKU] in wma_forecast_dict:
-                    template_df.at[index, WMA_FORECAST_COL] = wma_forecast_dict[row[M_SKU]]
-            else:
-                if row[FBA_SKU] in wma_forecast_dict:
-                    template_df.at[index, WMA_FORECAST_COL] = wma_forecast_dict[row[FBA_SKU]]
-        except Exception as e:
-            template_df.at[index, WMA_FORECAST_COL] = 0
-            
+
+    forecast_keys = _forecast_keys(template_df)
+    has_forecast = forecast_keys.isin(wma_forecast_dict.keys()) & forecast_keys.notna()
+    if has_forecast.any():
+        template_df.loc[has_forecast, WMA_FORECAST_COL] = forecast_keys[has_forecast].map(wma_forecast_dict)
+
     return template_df
 
 def calculate_recommended_shipment(template_df):
@@ -488,37 +746,23 @@ def calculate_recommended_shipment(template_df):
         template_df[INBOUND] = pd.to_numeric(template_df[INBOUND], errors='coerce').fillna(0)
         template_df[INV] = pd.to_numeric(template_df[INV], errors='coerce').fillna(0)
         template_df[WMA_FORECAST_COL] = pd.to_numeric(template_df[WMA_FORECAST_COL], errors='coerce').fillna(0)
-        
-        # Check if 1_w column exists
-        if '1_w' in template_df.columns:
-            # Create a copy of 1_w to preserve original values
-            original_1w = template_df['1_w'].copy()
-            
-            # Convert 1_w to numeric for calculation, but don't fillna yet
-            numeric_1w = pd.to_numeric(template_df['1_w'], errors='coerce')
-            
-            # Define a function to calculate REC_SHIP considering 1_w
-            def calculate_rec_ship(row):
-                # If 1_w is empty or not numeric, use just INBOUND
-                if pd.isna(numeric_1w[row.name]) or original_1w[row.name] == '':
-                    return max(0, row[WMA_FORECAST_COL] - (row[INBOUND] + row[INV]))
-                else:
-                    # If 1_w has numeric value and is greater than INBOUND, add it to INBOUND
-                    one_w_value = numeric_1w[row.name]
-                    if one_w_value > row[INBOUND]:
-                        return max(0, row[WMA_FORECAST_COL] - ((row[INBOUND] + one_w_value) + row[INV]))
-                    else:
-                        return max(0, row[WMA_FORECAST_COL] - (row[INBOUND] + row[INV]))
-            
-            # Apply the function
-            template_df[REC_SHIP] = template_df.apply(calculate_rec_ship, axis=1)
-        else:
-            # Original calculation if 1_w doesn't exist
-            template_df[REC_SHIP] = template_df.apply(
-                lambda row: max(0, row[WMA_FORECAST_COL] - (row[INBOUND] + row[INV])),
-                axis=1
-            )
-        
+
+        inbound = template_df[INBOUND].to_numpy()
+        shortfall = template_df[WMA_FORECAST_COL].to_numpy() - (inbound + template_df[INV].to_numpy())
+        is_float = np.zeros(len(template_df), dtype=bool) | (shortfall.dtype.kind == 'f')
+
+        # If 1_w has numeric value and is greater than INBOUND, add it to INBOUND (1_w stays as it is)
+        numeric_1w, adds_1w = _counted_1w(template_df, inbound)
+        if adds_1w is not None:
+            shortfall = np.where(adds_1w, shortfall - numeric_1w, shortfall)
+            is_float |= adds_1w & (numeric_1w.dtype.kind == 'f')
+
+        rec_ship = np.maximum(shortfall, 0)
+        # Like max(0, x) row by row: the column is float only if a positive float shortfall occurs
+        if not (is_float & (shortfall > 0)).any():
+            rec_ship = rec_ship.astype('int64')
+        template_df[REC_SHIP] = pd.Series(rec_ship, index=template_df.index)
+
         return template_df
         
     except Exception as e:
@@ -526,25 +770,146 @@ def calculate_recommended_shipment(template_df):
         traceback.print_exc()
         raise e
 
-def main():
+def build_demand_quantiles_report(template_df, quantiles_df):
+    """
+    Builds the demand quantiles report of the template rows: P50/P90 of next month's demand,
+    the service level quantile and the shipment that reaches it,
+    max(0, quantile - (INBOUND + INV)) with 1_w counted as for REC_SHIP.
+
+    Args:
+        template_df (pd.DataFrame): Template after calculate_recommended_shipment.
+        quantiles_df (pd.DataFrame): Quantiles per SKU from generate_demand_quantiles.
+
+    Returns:
+        pd.DataFrame: One row per template row, in template order.
+    """
+    forecast_keys = _forecast_keys(template_df)
+    report = template_df[[FBA_SKU, M_SKU, WMA_FORECAST_COL]].copy()
+    for column in quantiles_df.columns:
+        report[column] = forecast_keys.map(quantiles_df[column]).values
+
+    inbound = template_df[INBOUND].to_numpy()
+    stock = inbound + template_df[INV].to_numpy()
+    numeric_1w, adds_1w = _counted_1w(template_df, inbound)
+    if adds_1w is not None:
+        stock = np.where(adds_1w, stock + numeric_1w, stock)
+    service_level_column = quantiles_df.columns[-1]
+    report[INV] = template_df[INV]
+    report[INBOUND] = template_df[INBOUND]
+    report[REC_SHIP] = template_df[REC_SHIP]
+    report[f'{REC_SHIP} {service_level_column}'] = np.maximum(report[service_level_column].to_numpy() - stock, 0)
+    return report
+
+def write_demand_quantiles(template_df, all_listings_df, sales_cube, forecast_model=None, file_suffix=''):
+    """
+    Writes the demand quantiles report to './results/demand_quantiles{file_suffix}.csv'.
+    A separate file, so the columns of the result file imported into Google Sheets stay as they are.
+    Errors are printed and do not stop the run.
+    """
+    try:
+        print('Calculating demand quantiles...')
+        quantiles_df = generate_demand_quantiles(all_listings_df, SELLER_SKU, sales_cube, model=forecast_model)
+        report = build_demand_quantiles_report(template_df, quantiles_df)
+        output_file_path = f'./results/demand_quantiles{file_suffix}.csv'
+        report.to_csv(output_file_path, index=False)
+        print(f"Demand quantiles saved to '{output_file_path}'")
+    except Exception as e:
+        print(f"Error calculating demand quantiles: {e}")
+        traceback.print_exc()
+
+def evaluate_scenarios(template_df, sales_cube, scenarios, config=None, forecast_model=None):
+    """
+    Computes the WMA forecast and REC_SHIP of every what-if scenario for the template rows,
+    all scenarios in one vectorized pass (see utils/scenarios.py).
+
+    Args:
+        template_df (pd.DataFrame): Template after calculate_recommended_shipment (or the result file).
+        sales_cube (dict): Sales cube of the same exports.
+        scenarios (list | pd.DataFrame): One dict (or row) per scenario: 'name' and any of 'coverage',
+            'wma_weight_m1'..'m3', 'min_forecast_floor_fraction', 'count_1w'.
+        config (dict, optional): Forecast settings the scenarios start from, load_forecast_config() by default.
+        forecast_model (str, optional): Forecast model of the run the template comes from, config['MODEL']
+            by default. Scenarios without weights use it, scenarios that set weights use WMA.
+
+    Returns:
+        pd.DataFrame: One row per template row, in template order: the SKUs, stock, current forecast
+                      and REC_SHIP, then '<forecast> <name>' and '<rec ship> <name>' per scenario.
+    """
+    config = config or load_forecast_config()
+    scenarios = build_scenarios(scenarios, config)
+    period_sales = sales_cube_matrix(sales_cube, _forecast_keys(template_df), FORECAST_SALES_RULE, FORECAST_PERIODS)
+    model = forecast_model or config['MODEL']
+    model_forecast = None
+    if not scenarios['wma'].all():
+        model_forecast = compute_forecast(period_sales, model, config)
+    if model != 'wma' and scenarios['wma'].any():
+        print(f"Scenario(s) {scenarios['name'][scenarios['wma']].tolist()} set WMA weights and are forecast with "
+              f"WMA, the other scenarios with the '{model}' model of the run.")
+
+    inbound = pd.to_numeric(template_df[INBOUND], errors='coerce').fillna(0).to_numpy()
+    stock = inbound + pd.to_numeric(template_df[INV], errors='coerce').fillna(0).to_numpy()
+    numeric_1w, adds_1w = _counted_1w(template_df, inbound)
+    extra_1w = np.zeros(len(template_df)) if adds_1w is None else np.where(adds_1w, numeric_1w, 0).astype(float)
+
+    forecasts = scenario_forecasts(period_sales, scenarios, model_forecast)
+    shipments = scenario_shipments(forecasts, scenarios, stock, extra_1w)
+
+    columns = [FBA_SKU, M_SKU, INV, INBOUND] + (['1_w'] if adds_1w is not None else []) + [WMA_FORECAST_COL, REC_SHIP]
+    report = template_df[[col for col in columns if col in template_df.columns]].copy()
+    scenario_columns = {}
+    for index, name in enumerate(scenarios['name']):
+        scenario_columns[f'{WMA_FORECAST_COL} {name}'] = forecasts[index]
+        scenario_columns[f'{REC_SHIP} {name}'] = shipments[index]
+    return pd.concat([report, pd.DataFrame(scenario_columns, index=template_df.index)], axis=1)
+
+def check_exports(exports_dir):
+    """
+    Checks the headers of all exports of a folder and raises ValueError listing the problems.
+    """
+    problems = preflight_exports(exports_dir, REPORT_SCHEMAS, REPORT_CONSTANTS, region_exports_root=REGION_EXPORTS_ROOT)
+    if problems:
+        print(f"The exports in '{exports_dir}' have problems:")
+        for problem in problems:
+            print(f" - {problem}")
+        raise ValueError(f"Preflight check found {len(problems)} problem(s) in '{exports_dir}'")
+
+def main(region=DEFAULT_REGION, exports_dir='amazon exports', file_suffix='', update_mapping=True, forecast_model=None):
     """
     Main function to orchestrate the data processing and updating the template DataFrame.
+
+    Args:
+        region (str): Marketplace region of the exports.
+        exports_dir (str): Folder holding the export subfolders.
+        file_suffix (str): Added to the template and result file names, e.g. '_UK'.
+        update_mapping (bool): Download the SKU mapping (in the background, while the exports are parsed).
+        forecast_model (str, optional): Forecast model of the run (see utils/forecasting.py),
+                                        the configured model by default.
     """
     print("Starting the program")
 
+    # Check the headers of all exports before parsing them or contacting Google Sheets
+    check_exports(exports_dir)
+
+    # Download the SKU mapping in the background while the exports are parsed
+    mapping_fetch = start_update_resources(regions=[region]) if update_mapping else None
+
     # Create data frames from directories
-    data_frames = create_data_frames_from_directories('amazon exports')
+    data_frames = create_data_frames_from_directories(exports_dir)
+    # Intern SKUs/ASINs once so the classification and mapping steps join on integer ids
+    add_report_key_ids(data_frames)
 
     try:
-        preper_new_template_csv(data_frames['all_listings_report'], data_frames['FBA_Inventory'])
+        fba_merchant_graph = preper_new_template_csv(data_frames['all_listings_report'], data_frames['FBA_Inventory'],
+                                                     region=region, file_suffix=file_suffix, update_mapping=False,
+                                                     mapping_fetch=mapping_fetch)
     except Exception as e:
         print(f'error in preper_new_template_csv {e}')
         raise e     
 
     # Check if 'template.csv' exists
-    template_file_path = './data/template.csv'
+    template_file_path = f'./data/template{file_suffix}.csv'
     try:
-        template_df = pd.read_csv(template_file_path)
+        template_df = _open_csv(template_file_path, sniff_file(template_file_path))
     except FileNotFoundError:
         print(f"Template file not found at '{template_file_path}'.")
         raise FileNotFoundError(f"Template file not found at '{template_file_path}'.")  
@@ -557,36 +922,40 @@ def main():
 
     try:
         print('Processing reports data')
-        # Update template with price data
-        if 'all_listings_report' in data_frames:
-            template_df = update_template_with_price_data(template_df, data_frames['all_listings_report'])
-        else:
+        # Collect price, inventory, inbound and shipment facts per SKU from all reports
+        if 'all_listings_report' not in data_frames:
             print("Data frame for 'all_listings_report' not found.")
-
-        # Update template with availability data
-        if 'FBA_Inventory' in data_frames and 'restock_report' in data_frames:
-            template_df = update_template_with_availability_data(template_df, data_frames['FBA_Inventory'], data_frames['restock_report'])
-        else:
+        if 'FBA_Inventory' not in data_frames or 'restock_report' not in data_frames:
             print("Data frames for 'FBA_Inventory' or 'restock_report' not found.")
+        has_weekly_data = all(key in data_frames for key in ['1_W', '2_W', '3_W', '4_W'])
+        if not has_weekly_data:
+            print("One or more shipment data frames ('1_W', '2_W', '3_W', '4_W') not found.")
 
-        # Update template with inbound quantity data
-        if 'FBA_Inventory' in data_frames and 'restock_report' in data_frames:
-            template_df = update_template_with_inbound_quantity_data(template_df, data_frames['FBA_Inventory'], data_frames['restock_report'])
-        else:
-            print("Data frames for 'FBA_Inventory' or 'restock_report' not found.")
+        sku_facts = build_sku_fact_table(
+            data_frames.get('all_listings_report'),
+            data_frames.get('FBA_Inventory'),
+            data_frames.get('restock_report'),
+            [data_frames[key] for key in ['1_W', '2_W', '3_W', '4_W']] if has_weekly_data else None,
+        )
+
+        # Update template with price, availability, inbound quantity and last shipments data
+        template_df = fill_template_from_sku_facts(template_df, sku_facts)
+
+        # Reduce all sales reports once; the template sales columns and the forecast both read from it
+        sales_cube = build_sales_cube(
+            {period: data_frames.get(period) for period in ['30d', '60d', '90d', '12m', '2yr']},
+            sku_col=SKU,
+            units_col=UNITS_ORDERED,
+            units_b2b_col=UNITS_ORDERED_B2B,
+            max_total_col=SALES_MAX_TOTAL,
+        )
 
         # Update template with sales data
         if all(key in data_frames for key in ['30d', '60d', '90d', '12m', '2yr']):
-            template_df = update_template_with_sales_data(template_df, data_frames['30d'], data_frames['60d'], data_frames['90d'], data_frames['12m'], data_frames['2yr'])
+            template_df = update_template_with_sales_data(template_df, sales_cube, fba_merchant_graph)
         else:
             print("One or more sales data frames ('30d', '60d', '90d', '12m', '2yr') not found.")
 
-        # Update template with last shipments data
-        if all(key in data_frames for key in ['1_W', '2_W', '3_W', '4_W']):
-            template_df = update_template_with_last_shipments_data(template_df, data_frames['1_W'], data_frames['2_W'], data_frames['3_W'], data_frames['4_W'])
-        else:
-            print("One or more shipment data frames ('1_W', '2_W', '3_W', '4_W') not found.")
-
         # Generate WMA forecast using the previously created function
         try:
             print('Calculating WMA forecast...')
@@ -599,7 +968,9 @@ def main():
                 data_frames.get('2yr'),  # Use .get() for safety
                 sku_col_listings=SELLER_SKU,  # SKU column in all_listings_report
                 sku_col_sales=SKU,           # SKU column in sales reports
-                units_col=UNITS_ORDERED      # Units ordered column name
+                units_col=UNITS_ORDERED,     # Units ordered column name
+                sales_cube=sales_cube,       # Sales already reduced above
+                model=forecast_model         # None: model configured in 'data/forecast_config.csv'
             )
 
             # Check if forecast generation was successful before proceeding
@@ -621,11 +992,15 @@ def main():
                 )
 
                 # Save the result
-                output_file_path = './results/result.csv'
+                output_file_path = f'./results/result{file_suffix}.csv'
                 os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
                 template_df.to_csv(output_file_path, index=False)
                 print(f"Data processing completed, results saved to '{output_file_path}'")
 
+                # P50/P90 and the service level shipment, in their own file
+                write_demand_quantiles(template_df, data_frames['all_listings_report'], sales_cube,
+                                       forecast_model, file_suffix)
+
         except Exception as e:
             print(f"Error generating WMA forecast or calculating recommended shipment: {e}")
             traceback.print_exc()
@@ -640,5 +1015,84 @@ def main():
         print(f"An unexpected error occurred:\n{e}")
         raise  e
 
+def _run_region(region, exports_root, forecast_model=None):
+    """Worker of run_regions: the full pipeline for one region, the SKU mapping is already downloaded."""
+    main(region=region, exports_dir=os.path.join(exports_root, region), file_suffix=f'_{region}', update_mapping=False,
+         forecast_model=forecast_model)
+    return f'./results/result_{region}.csv'
+
+def run_regions(regions, exports_root=REGION_EXPORTS_ROOT, max_workers=REGION_MAX_WORKERS, forecast_model=None):
+    """
+    Runs the pipeline for several marketplace regions in one go.
+    The SKU mapping is downloaded and parsed once, then every region is processed in its own
+    worker process, so the run takes about as long as the slowest region.
+
+    Args:
+        regions (list): Region codes, e.g. ['US', 'UK', 'DE'].
+        exports_root (str): Folder holding one exports folder per region.
+        max_workers (int, optional): Number of regions processed at the same time.
+        forecast_model (str, optional): Forecast model of the run, the configured model by default.
+
+    Returns:
+        dict: {region: result file path} of the regions that succeeded.
+
+    Raises:
+        ValueError: If a region is unknown or its exports have problems.
+        RuntimeError: If the pipeline failed for one or more regions.
+    """
+    invalid_regions = [region for region in regions if region not in MAPPING_REGIONS]
+    if invalid_regions:
+        raise ValueError(f"Invalid region(s) {invalid_regions}. Allowed values are {MAPPING_REGIONS}.")
+
+    # Check every region before downloading anything
+    for region in regions:
+        check_exports(os.path.join(exports_root, region))
+
+    # Download the SKU mapping and parse it once; the workers load the stored copy (see utils/helpers.py)
+    try:
+        print("Retrieving current SKU mapping data")
+        update_resources(regions=regions)
+        load_sku_mapping_table()
+        print("SKU mapping data successfully updated")
+    except Exception as e:
+        print(f"Error retrieving current SKU mapping data: {e}")
+        raise
+
+    max_workers = max_workers or min(len(regions), os.cpu_count() or 1)
+    results = {}
+    failed_regions = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_region, region, exports_root, forecast_model): region for region in regions}
+        for future, region in futures.items():
+            try:
+                results[region] = future.result()
+            except Exception as e:
+                failed_regions[region] = e
+
+    for region in regions:
+        if region in results:
+            print(f"{region}: results saved to '{results[region]}'")
+        else:
+            print(f"{region}: failed ({failed_regions[region]})")
+    if failed_regions:
+        raise RuntimeError(f"Report generation failed for region(s): {', '.join(failed_regions)}")
+    return results
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the Amazon FBA borders report.")
+    parser.add_argument('--regions', help="Comma separated regions to process in one run, e.g. US,UK,DE. "
+                                          f"The exports of each region are read from '{REGION_EXPORTS_ROOT}/<REGION>'.")
+    parser.add_argument('--all-regions', action='store_true', help="Process every region of the SKU mapping.")
+    parser.add_argument('--forecast-model', choices=FORECAST_MODELS + [MODEL_BY_CLASS_NAME],
+                        help="Forecast model of this run, overrides MODEL in './data/forecast_config.csv'.")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    main()
+    args = parse_arguments()
+    if args.all_regions:
+        run_regions(MAPPING_REGIONS, forecast_model=args.forecast_model)
+    elif args.regions:
+        run_regions([region.strip().upper() for region in args.regions.split(',') if region.strip()],
+                    forecast_model=args.forecast_model)
+    else:
+        main(forecast_model=args.forecast_model)
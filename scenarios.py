@@ -0,0 +1,87 @@
+"""
+What-if scenarios of the recommended shipment, e.g. "what if we cover 6 weeks instead of 4" or
+"what if the 1_w shipment does not count as in transit", without running the whole report again.
+
+Reads the result of the last run ('results/result.csv'), the sales reports of the exports (through
+the parsed report cache of main.py) and the scenarios ('data/scenarios.csv': a 'name' per row and
+any of 'coverage', 'wma_weight_m1'..'m3', 'min_forecast_floor_fraction', 'count_1w'; empty cells
+keep the current settings). Every scenario is computed in one vectorized pass
+(see main.evaluate_scenarios) and written to 'results/scenarios.csv', one forecast and one
+recommended shipment column per scenario.
+
+Run from the project root after main.py:
+    python scenarios.py [--scenarios data/scenarios.csv] [--region UK] [--forecast-model croston]
+Pass the same --forecast-model as the main.py run: scenarios without weights use that model.
+"""
+
+import argparse
+import os
+import sys
+
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+from main import evaluate_scenarios, load_sales_cube, FBA_SKU, M_SKU, REC_SHIP, REGION_EXPORTS_ROOT  # noqa: E402
+from utils.forecasting import FORECAST_MODELS, MODEL_BY_CLASS_NAME  # noqa: E402
+from utils.helpers import a_ph, MAPPING_REGIONS  # noqa: E402
+from utils.scenarios import SCENARIOS_PATH  # noqa: E402
+
+
+def run_scenarios(scenarios_path=None, region=None, forecast_model=None):
+    """
+    Evaluates the scenarios of `scenarios_path` on the last result and writes them.
+
+    Args:
+        scenarios_path (str, optional): CSV file with the scenarios, 'data/scenarios.csv' by default.
+        region (str, optional): Region of a multi-region run (reads 'results/result_<REGION>.csv' and
+                                the exports in '<REGION_EXPORTS_ROOT>/<REGION>'); the plain run by default.
+        forecast_model (str, optional): Forecast model of the main.py run, the configured model by default.
+
+    Returns:
+        pd.DataFrame: The scenarios report.
+    """
+    if region is not None and region not in MAPPING_REGIONS:
+        raise ValueError(f"Invalid region '{region}'. Allowed values are {MAPPING_REGIONS}.")
+    file_suffix = f'_{region}' if region else ''
+    exports_dir = os.path.join(REGION_EXPORTS_ROOT, region) if region else 'amazon exports'
+    scenarios_path = scenarios_path or a_ph(SCENARIOS_PATH)
+
+    result_file_path = f'./results/result{file_suffix}.csv'
+    try:
+        template_df = pd.read_csv(result_file_path, dtype={FBA_SKU: str, M_SKU: str})
+    except FileNotFoundError:
+        print(f"Result file not found at '{result_file_path}'. Run main.py first.")
+        raise
+    try:
+        scenarios = pd.read_csv(scenarios_path)
+    except FileNotFoundError:
+        print(f"Scenarios file not found at '{scenarios_path}'.")
+        raise
+
+    sales_cube = load_sales_cube(exports_dir)
+    report = evaluate_scenarios(template_df, sales_cube, scenarios, forecast_model=forecast_model)
+
+    output_file_path = f'./results/scenarios{file_suffix}.csv'
+    report.to_csv(output_file_path, index=False)
+    for name in scenarios['name'].astype(str).str.strip():
+        shipments = report[f'{REC_SHIP} {name}']
+        print(f"{name}: {shipments.sum():g} units to ship for {(shipments > 0).sum()} SKUs")
+    print(f"Scenarios saved to '{output_file_path}'")
+    return report
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Recommended shipments of what-if scenarios.")
+    parser.add_argument('--scenarios', help="CSV file with the scenarios, './data/scenarios.csv' by default.")
+    parser.add_argument('--region', help="Region of a multi-region run, e.g. UK.")
+    parser.add_argument('--forecast-model', choices=FORECAST_MODELS + [MODEL_BY_CLASS_NAME],
+                        help="Forecast model of the main.py run, overrides MODEL in './data/forecast_config.csv'.")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    run_scenarios(args.scenarios, args.region.strip().upper() if args.region else None, args.forecast_model)
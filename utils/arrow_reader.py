@@ -0,0 +1,110 @@
+"""
+Utility module for parsing report files with the multithreaded PyArrow CSV reader.
+pyarrow is optional: check PYARROW_AVAILABLE before calling read_csv_arrow and use
+pd.read_csv otherwise.
+
+pandas' own engine='pyarrow' is not used because it converts dtype=str columns after
+type inference (missing values become the string 'nan', SKUs like '00123' lose their
+leading zeros) and does not accept a callable usecols.
+"""
+
+import contextlib
+import zipfile
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# The strings pd.read_csv treats as missing values by default
+NA_VALUES = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null',
+]
+
+
+@contextlib.contextmanager
+def _open_source(file_path, compression):
+    if compression == 'zip':
+        with zipfile.ZipFile(file_path) as archive:
+            member = [name for name in archive.namelist() if not name.endswith('/')][0]
+            with archive.open(member) as source:
+                yield source
+    else:
+        with pa.input_stream(file_path, compression=compression) as source:
+            yield source
+
+
+def _read_table(file_path, file_format, skip_lines, convert_kwargs):
+    read_options = pa_csv.ReadOptions(
+        encoding=file_format['encoding'],
+        skip_rows=skip_lines,
+        use_threads=True,
+    )
+    parse_options = pa_csv.ParseOptions(
+        delimiter=file_format['sep'],
+        newlines_in_values=True,
+    )
+    convert_options = pa_csv.ConvertOptions(
+        null_values=NA_VALUES,
+        strings_can_be_null=True,
+        quoted_strings_can_be_null=True,
+        **convert_kwargs,
+    )
+    with _open_source(file_path, file_format.get('compression')) as source:
+        return pa_csv.read_csv(
+            source,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options,
+        )
+
+
+def read_csv_arrow(file_path, file_format, skip_lines=0, usecols=None, as_strings=False):
+    """
+    Read a report with pyarrow.csv and return a pandas DataFrame.
+
+    Args:
+        file_path (str): Path of the report.
+        file_format (dict): 'encoding', 'sep' and 'compression' as returned by sniff_file.
+        skip_lines (int): Number of lines before the header line.
+        usecols (list, optional): Exact header names of the columns to load.
+        as_strings (bool): Load every column as text (like dtype=str) instead of inferring types.
+
+    Returns:
+        pd.DataFrame: Same values pd.read_csv would produce for these options.
+    """
+    convert_kwargs = {}
+    if usecols is not None:
+        convert_kwargs['include_columns'] = list(usecols)
+    if as_strings:
+        if usecols is None:
+            raise ValueError("as_strings requires the list of columns to load")
+        convert_kwargs['column_types'] = {column: pa.string() for column in usecols}
+
+    table = _read_table(file_path, file_format, skip_lines, convert_kwargs)
+
+    # pd.read_csv does not parse dates unless asked to, Arrow always does: read those columns again as text
+    date_columns = [field.name for field in table.schema if pa.types.is_temporal(field.type)]
+    if date_columns:
+        text_table = _read_table(file_path, file_format, skip_lines, {
+            'include_columns': date_columns,
+            'column_types': {column: pa.string() for column in date_columns},
+        })
+        for column in date_columns:
+            table = table.set_column(table.schema.get_field_index(column), column, text_table.column(column))
+
+    # Columns without any value have the null type; pandas reads them as float NaN
+    for index, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(index, field.name, table.column(index).cast(pa.float64()))
+
+    df = table.to_pandas()
+    # Arrow gives None for missing text, pd.read_csv gives NaN
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].fillna(np.nan)
+    return df
@@ -0,0 +1,209 @@
+"""
+Utility module for the backtest (backtest.py): finds the archived export snapshots, pairs every
+snapshot with the one holding the sales of the month that followed, and scores forecasts
+against those sales.
+
+A snapshot is a 'Reports history/<YYYY-MM-DD>' folder written by copy_and_clean.py. The forecast
+made on date D is compared with the 30d sales report of the snapshot taken about
+BACKTEST_HORIZON_DAYS later.
+
+Scores, computed over the last axis so many forecasts of the same SKUs can be scored at once:
+    'mae'   mean absolute error in units
+    'wape'  sum of absolute errors / sum of actual units
+    'bias'  sum of errors / sum of actual units (above 0: forecast too high)
+WAPE and bias are NaN where nothing was sold.
+"""
+
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from utils.forecast_models import recent_months
+
+SNAPSHOT_DATE_FORMAT = '%Y-%m-%d'
+
+# The forecast is for the next month: it is compared with the snapshot taken this many days
+# later, or the one closest to it if it is at most BACKTEST_TOLERANCE_DAYS off
+BACKTEST_HORIZON_DAYS = 30
+BACKTEST_TOLERANCE_DAYS = 7
+
+SCORE_COLUMNS = ['mae', 'wape', 'bias']
+
+# Largest number of (weight combination x SKU) cells computed at once by grid_search_wma
+GRID_CHUNK_CELLS = 1_000_000
+
+
+def list_snapshots(history_dir):
+    """
+    Return [(date, path), ...] of the snapshot folders of `history_dir`, oldest first.
+    Folders not named by date are skipped.
+    """
+    try:
+        names = os.listdir(history_dir)
+    except FileNotFoundError:
+        print(f"Directory '{history_dir}' not found.")
+        raise FileNotFoundError(f"Directory '{history_dir}' not found.")
+
+    snapshots = []
+    for name in names:
+        path = os.path.join(history_dir, name)
+        if not os.path.isdir(path):
+            continue
+        try:
+            date = datetime.strptime(name, SNAPSHOT_DATE_FORMAT).date()
+        except ValueError:
+            continue
+        snapshots.append((date, path))
+    return sorted(snapshots)
+
+
+def pair_snapshots(dates, horizon_days=BACKTEST_HORIZON_DAYS, tolerance_days=BACKTEST_TOLERANCE_DAYS):
+    """
+    Pair every snapshot date with the later one whose 30d report covers the month after it.
+
+    Args:
+        dates (list): Snapshot dates, oldest first.
+
+    Returns:
+        list: [(index of the forecast snapshot, index of the actual sales snapshot), ...].
+              Snapshots without a match (e.g. the most recent ones) are left out.
+    """
+    pairs = []
+    for forecast_index, date in enumerate(dates):
+        best = None
+        for actual_index in range(forecast_index + 1, len(dates)):
+            offset = abs((dates[actual_index] - date).days - horizon_days)
+            if offset <= tolerance_days and (best is None or offset < best[1]):
+                best = (actual_index, offset)
+        if best is not None:
+            pairs.append((forecast_index, best[0]))
+    return pairs
+
+
+def score_forecasts(forecast, actual):
+    """
+    Score forecasts against the actual sales.
+
+    Args:
+        forecast (np.ndarray): Forecasts, shape (..., SKUs).
+        actual (np.ndarray): Actual sales, shape (SKUs,) or the shape of `forecast`.
+
+    Returns:
+        dict: {'mae', 'wape', 'bias'}, arrays of shape forecast.shape[:-1] (floats for 1-d input).
+    """
+    error = forecast - actual
+    absolute_sum = np.abs(error).sum(axis=-1)
+    actual_sum = np.broadcast_to(actual, error.shape).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sold = actual_sum > 0
+        return {
+            'mae': absolute_sum / error.shape[-1],
+            'wape': np.where(sold, absolute_sum / actual_sum, np.nan)[()],
+            'bias': np.where(sold, error.sum(axis=-1) / actual_sum, np.nan)[()],
+        }
+
+
+def score_by_key(keys, forecast, actual):
+    """
+    Score the forecasts per key (e.g. per SKU over all snapshots).
+
+    Returns:
+        pd.DataFrame: Indexed by key, columns 'forecasts' (number of forecasts scored),
+                      'forecast units', 'actual units' and SCORE_COLUMNS.
+    """
+    codes, uniques = pd.factorize(pd.Index(keys))
+    count = np.bincount(codes, minlength=len(uniques))
+    error = forecast - actual
+    absolute_sum = np.bincount(codes, weights=np.abs(error), minlength=len(uniques))
+    error_sum = np.bincount(codes, weights=error, minlength=len(uniques))
+    actual_sum = np.bincount(codes, weights=actual, minlength=len(uniques))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sold = actual_sum > 0
+        return pd.DataFrame({
+            'forecasts': count,
+            'forecast units': np.bincount(codes, weights=forecast, minlength=len(uniques)),
+            'actual units': actual_sum,
+            'mae': absolute_sum / count,
+            'wape': np.where(sold, absolute_sum / actual_sum, np.nan),
+            'bias': np.where(sold, error_sum / actual_sum, np.nan),
+        }, index=uniques)
+
+
+def weight_grid(values):
+    """
+    Return the WMA weight combinations (w1, w2, w3) with every weight taken from `values`, as an
+    array of shape (combinations, 3). Combinations that only differ by a factor (e.g. (2, 2, 2)
+    and (1, 1, 1)) give the same forecast, only the first one is kept; all zero weights are left out.
+    """
+    weights = np.array([combination for combination in itertools.product(values, repeat=3)
+                        if sum(combination) > 0], dtype=float)
+    shares = np.round(weights / weights.sum(axis=1, keepdims=True), 12)
+    _, first = np.unique(shares, axis=0, return_index=True)
+    return weights[np.sort(first)]
+
+
+def grid_search_wma(period_sales, actual, weights, floors, epsilon=1e-6, minimum=0.01,
+                    chunk_cells=GRID_CHUNK_CELLS, max_workers=None):
+    """
+    Score the WMA forecast with the minimum forecast floor for every combination of weights and
+    floor fraction at once (same forecast as wma_forecast and apply_forecast_floor).
+
+    The weights are one (combinations, 3) matrix: the forecasts of a chunk of SKUs for all of them
+    are a single matrix product with the (3, SKUs) recent months. The floor only changes the SKUs
+    whose forecast is about 0, so its effect for every floor fraction is a second matrix product
+    of those SKUs with the errors of the floored forecasts. Chunks of SKUs are scored in a thread pool.
+
+    Args:
+        period_sales (np.ndarray): Sales of the SKUs, shape (SKUs, 5), columns in FORECAST_PERIODS order.
+        actual (np.ndarray): Sales of the SKUs in the month that followed.
+        weights (np.ndarray): Weight combinations (w1, w2, w3), shape (combinations, 3).
+        floors (np.ndarray): Floor fractions (MIN_FORECAST_FLOOR_FRACTION values), 0 disables the floor.
+
+    Returns:
+        dict: {'mae', 'wape', 'bias'}, arrays of shape (combinations, floor fractions).
+    """
+    weights = np.asarray(weights, dtype=float)
+    floors = np.asarray(floors, dtype=float)
+    weight_sums = weights.sum(axis=1, keepdims=True)
+    if (weight_sums <= 0).any():
+        raise ValueError("Sum of WMA weights must be positive for every combination.")
+    shares = weights / weight_sums
+    rows_per_chunk = max(1, chunk_cells // len(shares))
+
+    def score_chunk(start):
+        chunk_sales = period_sales[start:start + rows_per_chunk]
+        chunk_actual = actual[start:start + rows_per_chunk]
+        months = np.stack(recent_months(chunk_sales))                     # (3, SKUs)
+        forecast = shares @ months                                         # (combinations, SKUs)
+        absolute_sums = np.abs(forecast - chunk_actual).sum(axis=1)
+        error_sums = shares @ months.sum(axis=1) - chunk_actual.sum()
+
+        # Only SKUs with sales in 2 years and a month without sales can get a forecast of about 0
+        sales_2yr = chunk_sales[:, 4]
+        candidates = np.flatnonzero((sales_2yr > 0) & (months.min(axis=0) <= epsilon))
+        floored = (forecast[:, candidates] <= epsilon).astype(float)
+        error = forecast[:, candidates] - chunk_actual[candidates]
+        floor_values = np.maximum(np.clip(sales_2yr[candidates] / 24.0, 0, None)[:, None] * floors, minimum)
+        floor_error = floor_values - chunk_actual[candidates][:, None]    # (candidates, floor fractions)
+
+        # Errors without the floor, with the floored SKUs swapped for their floor errors
+        floored_absolute = (floored @ np.abs(floor_error)) - (np.abs(error) * floored).sum(axis=1)[:, None]
+        floored_error = (floored @ floor_error) - (error * floored).sum(axis=1)[:, None]
+        # A floor fraction of 0 leaves the forecast as it is
+        floored_absolute[:, floors <= 0] = 0
+        floored_error[:, floors <= 0] = 0
+        return absolute_sums[:, None] + floored_absolute, error_sums[:, None] + floored_error
+
+    starts = range(0, len(period_sales), rows_per_chunk)
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        results = list(executor.map(score_chunk, starts))
+    absolute_sum = sum(result[0] for result in results)
+    error_sum = sum(result[1] for result in results)
+    actual_sum = actual.sum()
+    return {
+        'mae': absolute_sum / len(period_sales),
+        'wape': absolute_sum / actual_sum if actual_sum > 0 else np.full(absolute_sum.shape, np.nan),
+        'bias': error_sum / actual_sum if actual_sum > 0 else np.full(error_sum.shape, np.nan),
+    }
@@ -0,0 +1,153 @@
+"""
+Utility module turning the point forecast into a demand distribution per SKU and reading
+quantiles (P50, P90, the service level) from it.
+
+Next month's demand of a SKU is modelled as negative binomial (Poisson with a gamma distributed
+rate) with the forecast as mean. The variance is the squared forecast times the squared
+coefficient of variation of the last three months around the 12 month average, and at least the
+mean (plain Poisson). Quantiles are computed
+    'analytic'     exactly, walking the probability mass function of all SKUs at once
+    'monte_carlo'  from (SKUs x samples) arrays of draws, a chunk of SKUs at a time so memory
+                   stays bounded
+    'normal'       with the normal approximation, mean + z * standard deviation
+"""
+
+import math
+from statistics import NormalDist
+import numpy as np
+from utils.forecast_models import recent_months
+
+QUANTILE_METHODS = ['analytic', 'monte_carlo', 'normal']
+
+# Gamma shapes above this are treated as Poisson (variance equal to the mean)
+POISSON_SHAPE = 1e6
+
+# Values of k added per step when summing the probability mass function ('analytic'): the
+# first step adds 4, every next step twice as many up to PMF_BLOCK
+PMF_BLOCK = 256
+
+# Largest number of SKU x sample cells drawn at once (about 16 bytes each)
+QUANTILE_CHUNK_CELLS = 4_000_000
+
+
+def demand_variance(period_sales, mean):
+    """
+    Variance of next month's demand per SKU.
+
+    Args:
+        period_sales (np.ndarray): Sales of the SKUs, shape (SKUs, 5), columns in FORECAST_PERIODS order.
+        mean (np.ndarray): Forecast per SKU.
+    """
+    m1, m2, m3 = recent_months(period_sales)
+    level = period_sales[:, 3] / 12
+    deviations = ((m1 - level) ** 2 + (m2 - level) ** 2 + (m3 - level) ** 2) / 3
+    cv2 = np.divide(deviations, level ** 2, out=np.zeros_like(level), where=level > 0)
+    return np.maximum(mean, cv2 * mean ** 2)
+
+
+def demand_quantiles(mean, variance, levels, method='analytic', samples=500, seed=0,
+                     chunk_cells=QUANTILE_CHUNK_CELLS):
+    """
+    Quantiles of next month's demand per SKU.
+
+    Args:
+        mean (np.ndarray): Forecast per SKU.
+        variance (np.ndarray): Demand variance per SKU (see demand_variance).
+        levels (list): Probabilities of the quantiles, e.g. [0.5, 0.9].
+        method (str): One of QUANTILE_METHODS.
+        samples (int): Monte Carlo samples per SKU.
+        seed (int): Seed of the Monte Carlo draws, fixed so runs are repeatable.
+        chunk_cells (int): Largest number of SKU x sample cells drawn at once.
+
+    Returns:
+        np.ndarray: Quantiles, shape (SKUs, len(levels)). SKUs with a forecast of 0 get 0.
+    """
+    if method not in QUANTILE_METHODS:
+        raise ValueError(f"Unknown quantile method '{method}'. Use one of {QUANTILE_METHODS}.")
+    levels = np.asarray(levels, dtype=float)
+    quantiles = np.zeros((len(mean), len(levels)))
+    active = np.flatnonzero(mean > 0)
+    if len(active) == 0:
+        return quantiles
+
+    if method == 'analytic':
+        quantiles[active] = _negative_binomial_quantiles(mean[active], variance[active], levels)
+        return quantiles
+
+    if method == 'normal':
+        z = np.array([NormalDist().inv_cdf(level) for level in levels])
+        spread = np.sqrt(variance[active])[:, None] * z
+        quantiles[active] = np.clip(mean[active][:, None] + spread, 0, None)
+        return quantiles
+
+    rng = np.random.default_rng(seed)
+    rows_per_chunk = max(1, chunk_cells // samples)
+    for start in range(0, len(active), rows_per_chunk):
+        rows = active[start:start + rows_per_chunk]
+        chunk_mean = mean[rows][:, None]
+        shape, poisson = _gamma_shape(chunk_mean, variance[rows][:, None])
+        shape = np.where(poisson, 1.0, shape)
+        rate = rng.standard_gamma(np.broadcast_to(shape, (len(rows), samples))) * (chunk_mean / shape)
+        rate = np.where(poisson, chunk_mean, rate)
+        demand = rng.poisson(rate)
+        quantiles[rows] = np.quantile(demand, levels, axis=1, method='inverted_cdf').T
+    return quantiles
+
+
+def _gamma_shape(mean, variance):
+    """Shape of the gamma distributed Poisson rate, and where the demand is plain Poisson."""
+    shape = mean ** 2 / np.maximum(variance - mean, 1e-12 * mean)
+    return shape, shape > POISSON_SHAPE
+
+
+def _negative_binomial_quantiles(mean, variance, levels):
+    """
+    Smallest k with P(demand <= k) >= level, for every SKU and level. The mass function is
+    summed from a few standard deviations below the mean, a growing block of k values at a time
+    for all SKUs together; SKUs leave the loop once their highest level is reached.
+    """
+    shape, poisson = _gamma_shape(mean, variance)
+    # Placeholder parameters on the Poisson rows keep the negative binomial terms finite
+    shape = np.where(poisson, 1.0, shape)
+    success = np.where(poisson, 0.5, mean / variance)
+
+    # Mass below `start` is negligible (more than 8 standard deviations under the mean)
+    start = np.floor(np.maximum(0, mean - 8 * np.sqrt(variance)))
+    lgamma = np.vectorize(math.lgamma, otypes=[float])
+    log_pmf = np.where(
+        poisson,
+        -mean + start * np.log(mean) - lgamma(start + 1),
+        lgamma(start + shape) - lgamma(shape) - lgamma(start + 1)
+        + shape * np.log(success) + start * np.log1p(-success),
+    )
+
+    quantiles = np.zeros((len(mean), len(levels)))
+    rows = np.arange(len(mean))
+    pending = np.ones((len(mean), len(levels)), dtype=bool)
+    # The first block is k = start alone
+    block_size = 2
+    block_k = start[:, None]
+    block_pmf = np.exp(log_pmf)[:, None]
+    cdf_before = np.zeros(len(mean))
+    while True:
+        block_cdf = cdf_before[:, None] + np.cumsum(block_pmf, axis=1)
+        # Guard against rounding: far in the tail every level counts as reached
+        tail = block_k > (mean + 50 * np.sqrt(variance) + 50)[:, None]
+        for level_index, level in enumerate(levels):
+            reached = (block_cdf >= level - 1e-12) | tail
+            found = pending[:, level_index] & reached.any(axis=1)
+            quantiles[rows[found], level_index] = block_k[found, reached[found].argmax(axis=1)]
+            pending[found, level_index] = False
+
+        keep = pending.any(axis=1)
+        if not keep.any():
+            return quantiles
+        rows, pending, mean, variance = rows[keep], pending[keep], mean[keep], variance[keep]
+        shape, success, poisson = shape[keep], success[keep], poisson[keep]
+        last_k, last_pmf, cdf_before = block_k[keep, -1], block_pmf[keep, -1], block_cdf[keep, -1]
+
+        block_size = min(2 * block_size, PMF_BLOCK)
+        block_k = last_k[:, None] + np.arange(1, block_size + 1)
+        ratio = np.where(poisson[:, None], mean[:, None] / block_k,
+                         (block_k - 1 + shape[:, None]) / block_k * (1 - success[:, None]))
+        block_pmf = last_pmf[:, None] * np.cumprod(ratio, axis=1)
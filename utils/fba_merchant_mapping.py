@@ -5,26 +5,39 @@ corresponding Merchant SKUs based on the same ASIN.
 """
 
 import json
+import numpy as np
 import pandas as pd
 import os
-from .listing_classifier import classify_listings, get_inconsistent_skus
+from .listing_classifier import classify_listings
+from .sku_codes import SKU_ID, ASIN_ID, sku_isin, ids_mask
 
-def create_fba_merchant_mapping(all_listings_df, fba_inventory_df):
+def build_fba_merchant_graph(all_listings_df, fba_inventory_df, classification=None, fba_channel='AMAZON_NA'):
     """
-    Creates a mapping between FBA SKUs and Merchant SKUs based on ASIN.
+    Builds the FBA to Merchant SKU mapping (same ASIN) as a bipartite graph in CSR form.
     
-    The function identifies FBA SKUs using the classifier and creates mapping
-    based on the all_listings_report data.
+    FBA SKU i is linked to the merchant SKUs
+    merchant_skus[indices[indptr[i]:indptr[i + 1]]], in the order they appear in the
+    all listings report. Rollups over the merchant SKUs of every FBA SKU become segment
+    sums on arrays (see merchant_segment_sum) instead of splitting comma-joined strings.
     
     Args:
         all_listings_df (pandas.DataFrame): DataFrame containing the all_listings_report
                                            with columns: 'seller-sku', 'asin1'
         fba_inventory_df (pandas.DataFrame): DataFrame containing the FBA inventory report,
                                            used only for classification
+        classification (dict, optional): Result of classify_listings for these reports.
+        fba_channel (str): Fulfillment channel of FBA listings, used when classifying here.
     
     Returns:
-        dict: A dictionary mapping FBA SKUs to lists of corresponding Merchant SKUs
-              {FBA_SKU: [MERCHANT_SKU1, MERCHANT_SKU2, ...]}
+        dict: {
+            'fba_skus': pd.Index of the FBA SKUs that have an ASIN,
+            'merchant_skus': pd.Index of the merchant SKUs that have an ASIN,
+            'indptr': np.ndarray (int64) of length len(fba_skus) + 1,
+            'indices': np.ndarray (int32) of merchant SKU ids,
+            'fba_sku_to_asin': dict {FBA_SKU: lower case ASIN},
+            'merchant_sku_ids': np.ndarray (int32) of run-wide SKU ids of merchant_skus,
+                                only when the report carries SKU ids (see utils/sku_codes.py),
+        }
     """
     # Convert column names to lowercase if they aren't already
     all_listings_df.columns = all_listings_df.columns.str.lower()
@@ -39,59 +52,140 @@ def create_fba_merchant_mapping(all_listings_df, fba_inventory_df):
         if col not in all_listings_df.columns:
             raise KeyError(f"Required column '{col}' not found in all_listings_report DataFrame")
     
-    # Sanitize data - strip whitespace from all text fields
-    for col in [all_sku_col, all_asin_col]:
-        if all_listings_df[col].dtype == 'object':  # Check if column is string type
-            all_listings_df[col] = all_listings_df[col].fillna('').str.strip()
-    
-    # Use the classifier to get FBA and Merchant SKUs
-    classification = classify_listings(all_listings_df, fba_inventory_df)
-    fba_skus = classification['fba_skus']
-    merchant_skus = classification['merchant_skus']
-    
-    # Check for inconsistencies
-    inconsistent_skus = get_inconsistent_skus(all_listings_df, fba_inventory_df)
-    
-    # Create a dictionary mapping FBA SKUs to their ASINs using all_listings_df
-    fba_sku_to_asin = {}
-    fba_listings = all_listings_df[all_listings_df[all_sku_col].isin(fba_skus)]
-    for _, row in fba_listings.iterrows():
-        sku = row[all_sku_col]
-        asin = row[all_asin_col]
-        if isinstance(asin, str) and asin.strip():
-            fba_sku_to_asin[sku] = asin.lower()
+    # Use the classifier to get FBA and Merchant SKUs (as id masks when the report carries SKU ids).
+    # It also strips the SKU column in place.
+    if classification is None:
+        classification = classify_listings(all_listings_df, fba_inventory_df, fba_channel)
+    
+    # Sanitize data - strip whitespace from the ASIN field
+    if all_listings_df[all_asin_col].dtype == 'object':  # Check if column is string type
+        all_listings_df[all_asin_col] = all_listings_df[all_asin_col].fillna('').str.strip()
+    
+    fba_skus = classification.get('fba_mask', classification['fba_skus'])
+    merchant_skus = classification.get('merchant_mask', classification['merchant_skus'])
+    
+    # Only listings with an ASIN can be linked
+    asins = all_listings_df[all_asin_col]
+    has_asin = asins.map(lambda asin: isinstance(asin, str)) & (asins.astype(str).str.strip() != '')
+    listings = pd.DataFrame({
+        'sku': classification['skus'].values,
+        'asin': asins.where(has_asin, '').astype(str).str.lower().values,
+        'has_asin': has_asin.values,
+    })
+    # Join on the interned ASIN ids when the report carries them
+    if ASIN_ID in all_listings_df.columns:
+        listings['asin_key'] = all_listings_df[ASIN_ID].values
+    else:
+        listings['asin_key'] = listings['asin']
+    if SKU_ID in all_listings_df.columns:
+        listings[SKU_ID] = all_listings_df[SKU_ID].values
+    
+    # FBA SKU -> ASIN: ordered by first appearance, the last row of a duplicated SKU wins
+    fba_listings = listings[sku_isin(listings, 'sku', fba_skus) & listings['has_asin']]
+    fba_nodes = fba_listings.groupby('sku', sort=False)[['asin', 'asin_key']].last()
+    fba_sku_to_asin = fba_nodes['asin']
+    
+    # Merchant listings (every row, so a duplicated merchant listing is linked twice as before)
+    merchant_listings = listings[sku_isin(listings, 'sku', merchant_skus) & listings['has_asin']]
+    merchant_codes, merchant_index = pd.factorize(merchant_listings['sku'])
+    
+    # Link FBA SKUs to merchant rows on the ASIN, keeping the report order of the merchant rows
+    fba_nodes = pd.DataFrame({'fba_id': np.arange(len(fba_nodes)), 'asin_key': fba_nodes['asin_key'].values})
+    merchant_nodes = pd.DataFrame({
+        'merchant_id': merchant_codes.astype(np.int32),
+        'asin_key': merchant_listings['asin_key'].values,
+        'row': np.arange(len(merchant_listings)),
+    })
+    edges = fba_nodes.merge(merchant_nodes, on='asin_key').sort_values(['fba_id', 'row'])
+    
+    graph = {}
+    if SKU_ID in listings.columns:
+        # Run-wide SKU id of every merchant SKU of the graph
+        graph['merchant_sku_ids'] = np.zeros(len(merchant_index), dtype=np.int32)
+        graph['merchant_sku_ids'][merchant_codes] = merchant_listings[SKU_ID].values
+    
+    counts = np.bincount(edges['fba_id'].values.astype(np.int64), minlength=len(fba_sku_to_asin))
+    indptr = np.zeros(len(fba_sku_to_asin) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    
+    graph.update({
+        'fba_skus': pd.Index(fba_sku_to_asin.index),
+        'merchant_skus': pd.Index(merchant_index),
+        'indptr': indptr,
+        'indices': edges['merchant_id'].values.astype(np.int32),
+        'fba_sku_to_asin': fba_sku_to_asin.to_dict(),
+    })
+    return graph
+
+def fba_merchant_lists(graph):
+    """
+    Returns the merchant SKUs of every FBA SKU of the graph as lists, in graph order.
+    """
+    merchant_skus = graph['merchant_skus'][graph['indices']].tolist()
+    indptr = graph['indptr']
+    return [merchant_skus[indptr[i]:indptr[i + 1]] for i in range(len(graph['fba_skus']))]
+
+def render_merchant_skus(graph, fba_skus, separator=', '):
+    """
+    Renders the M_SKU strings ("a, b") of the given FBA SKUs. SKUs not in the graph get ''.
+    """
+    rendered = pd.Series([separator.join(m_skus) for m_skus in fba_merchant_lists(graph)],
+                         index=graph['fba_skus'], dtype=object)
+    return rendered.reindex(pd.Index(fba_skus)).fillna('').values
+
+def mapped_merchant_skus(graph, as_mask=False):
+    """
+    Returns the set of merchant SKUs linked to at least one FBA SKU,
+    or with as_mask=True a boolean mask over the SKU dictionary (needs 'merchant_sku_ids').
+    """
+    linked = np.unique(graph['indices'])
+    if as_mask:
+        return ids_mask(graph['merchant_sku_ids'][linked])
+    return set(graph['merchant_skus'][linked])
+
+def merchant_segment_sum(graph, merchant_values):
+    """
+    Sums a value over the merchant SKUs of every FBA SKU.
+    
+    Args:
+        graph (dict): Graph built by build_fba_merchant_graph.
+        merchant_values (np.ndarray): One value per merchant SKU id (graph['merchant_skus'] order).
+    
+    Returns:
+        np.ndarray: One sum per FBA SKU (graph['fba_skus'] order), 0 for FBA SKUs without merchant SKUs.
+    """
+    segment_ids = np.repeat(np.arange(len(graph['fba_skus'])), np.diff(graph['indptr']))
+    return np.bincount(segment_ids, weights=np.asarray(merchant_values, dtype=float)[graph['indices']],
+                       minlength=len(graph['fba_skus']))
+
+def create_fba_merchant_mapping(all_listings_df, fba_inventory_df, graph=None, asin_json_path='fba_sku_to_asin.json'):
+    """
+    Creates a mapping between FBA SKUs and Merchant SKUs based on ASIN.
+    
+    The function identifies FBA SKUs using the classifier and creates mapping
+    based on the all_listings_report data.
+    
+    Args:
+        all_listings_df (pandas.DataFrame): DataFrame containing the all_listings_report
+                                           with columns: 'seller-sku', 'asin1'
+        fba_inventory_df (pandas.DataFrame): DataFrame containing the FBA inventory report,
+                                           used only for classification
+        graph (dict, optional): Graph already built by build_fba_merchant_graph for these reports.
+        asin_json_path (str): File the FBA SKU to ASIN mapping is saved to.
+    
+    Returns:
+        dict: A dictionary mapping FBA SKUs to lists of corresponding Merchant SKUs
+              {FBA_SKU: [MERCHANT_SKU1, MERCHANT_SKU2, ...]}
+    """
+    if graph is None:
+        graph = build_fba_merchant_graph(all_listings_df, fba_inventory_df)
 
     # Save the fba_sku_to_asin mapping to a file
-    with open('fba_sku_to_asin.json', 'w') as f:
-        json.dump(fba_sku_to_asin, f)
-    
-    # Get merchant listings using the classification results
-    merchant_listings = all_listings_df[all_listings_df[all_sku_col].isin(merchant_skus)]
-    
-    # Create ASIN to Merchant SKU mapping for faster lookups
-    asin_to_merchant = {}
-    for _, row in merchant_listings.iterrows():
-        asin = row[all_asin_col]
-        sku = row[all_sku_col]
-        # Skip empty values
-        if not isinstance(asin, str) or not asin:
-            continue
-        asin_lower = asin.lower()
-        if asin_lower in asin_to_merchant:
-            asin_to_merchant[asin_lower].append(sku)
-        else:
-            asin_to_merchant[asin_lower] = [sku]
+    with open(asin_json_path, 'w') as f:
+        json.dump(graph['fba_sku_to_asin'], f)
     
     # Create the FBA to merchant mapping
-    fba_merchant_mapping = {}
-    for fba_sku, asin in fba_sku_to_asin.items():
-        if asin in asin_to_merchant:
-            fba_merchant_mapping[fba_sku] = asin_to_merchant[asin]
-        else:
-            fba_merchant_mapping[fba_sku] = []
-    
-    # Save mapping results to file for testing
-    # save_mapping_results(fba_merchant_mapping, fba_skus, merchant_skus, inconsistent_skus, all_listings_df)
+    fba_merchant_mapping = dict(zip(graph['fba_skus'], fba_merchant_lists(graph)))
     
     return fba_merchant_mapping
 
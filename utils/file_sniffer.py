@@ -0,0 +1,176 @@
+"""
+Utility module for detecting how an Amazon export has to be parsed.
+A small prefix of the file is read once to pick the text encoding, the column separator
+and the compression and to get the header line, so the report itself is parsed a single
+time. Decisions are cached per file (path, size and modification time) for the rest of the run.
+"""
+
+import codecs
+import csv
+import gzip
+import os
+import threading
+import zipfile
+
+# Separator used when the header line does not make the choice obvious
+DEFAULT_SEPARATORS = {
+    '.csv': ',',
+    '.txt': '\t',
+    '.tsv': '\t',
+}
+
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.zip': 'zip',
+}
+
+# Encoding used when the prefix is not valid UTF-8 (Amazon exports from older Seller Central pages)
+FALLBACK_ENCODING = 'ISO-8859-1'
+
+# Number of (decompressed) bytes inspected at the start of each file
+SNIFF_PREFIX_SIZE = 64 * 1024
+
+_sniff_cache = {}
+_sniff_cache_lock = threading.Lock()
+
+
+def _cache_key(file_path, skip_lines):
+    stat = os.stat(file_path)
+    return (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns, skip_lines)
+
+
+def _split_compression(file_path):
+    """
+    Return (compression, inner file name) for a path, e.g. ('gzip', 'report.txt') for 'report.txt.gz'.
+    For zip archives the inner name is the single file stored in the archive.
+    """
+    base_name, extension = os.path.splitext(os.path.basename(file_path))
+    compression = COMPRESSION_EXTENSIONS.get(extension.lower())
+    if compression == 'zip':
+        with zipfile.ZipFile(file_path) as archive:
+            members = [name for name in archive.namelist() if not name.endswith('/')]
+        if len(members) != 1:
+            raise ValueError(f"Zip file '{file_path}' must contain exactly one report, found {len(members)}")
+        return compression, os.path.basename(members[0])
+    if compression == 'gzip':
+        return compression, base_name
+    return None, os.path.basename(file_path)
+
+
+def _read_prefix(file_path, compression, size=SNIFF_PREFIX_SIZE):
+    """Read up to `size` bytes of the (decompressed) file content."""
+    if compression == 'gzip':
+        with gzip.open(file_path, 'rb') as f:
+            return f.read(size)
+    if compression == 'zip':
+        with zipfile.ZipFile(file_path) as archive:
+            member = [name for name in archive.namelist() if not name.endswith('/')][0]
+            with archive.open(member) as f:
+                return f.read(size)
+    with open(file_path, 'rb') as f:
+        return f.read(size)
+
+
+def _detect_encoding(prefix):
+    if prefix.startswith(codecs.BOM_UTF16_LE) or prefix.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    try:
+        # final=False: a multi-byte character cut at the end of the prefix is not an error
+        codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+
+
+def _header_line(prefix, encoding, skip_lines):
+    """Return the decoded header line (the line after the skipped ones), or None."""
+    lines = prefix.decode(encoding, errors='replace').splitlines()
+    if len(lines) <= skip_lines:
+        return None
+    return lines[skip_lines].lstrip('\ufeff')
+
+
+def _detect_separator(header, default_separator):
+    if header is None:
+        return default_separator
+    tab_count = header.count('\t')
+    comma_count = header.count(',')
+    if tab_count == comma_count:
+        return default_separator
+    return '\t' if tab_count > comma_count else ','
+
+
+def _split_header(header, separator):
+    if header is None:
+        return []
+    return next(csv.reader([header], delimiter=separator), [])
+
+
+def _sniff(file_path, skip_lines):
+    """Sniff a file (using the cache) and return the cache entry: {'format': ..., 'header': ...}."""
+    key = _cache_key(file_path, skip_lines)
+    with _sniff_cache_lock:
+        if key in _sniff_cache:
+            return _sniff_cache[key]
+
+    compression, inner_name = _split_compression(file_path)
+    inner_extension = os.path.splitext(inner_name)[1].lower()
+    if inner_extension not in DEFAULT_SEPARATORS:
+        raise ValueError(f"Unsupported file extension '{inner_extension}' in file '{file_path}'")
+
+    prefix = _read_prefix(file_path, compression)
+    encoding = _detect_encoding(prefix)
+    header = _header_line(prefix, encoding, skip_lines)
+    separator = _detect_separator(header, DEFAULT_SEPARATORS[inner_extension])
+    entry = {
+        'format': {
+            'encoding': encoding,
+            'sep': separator,
+            'compression': compression,
+        },
+        'header': _split_header(header, separator),
+    }
+
+    with _sniff_cache_lock:
+        _sniff_cache[key] = entry
+    return entry
+
+
+def sniff_file(file_path, skip_lines=0):
+    """
+    Detect how to parse a report file.
+
+    Args:
+        file_path (str): Path of a .csv/.txt/.tsv export, optionally compressed as .gz or .zip.
+        skip_lines (int): Number of lines before the header line.
+
+    Returns:
+        dict: pd.read_csv keyword arguments: 'encoding', 'sep' and 'compression'.
+
+    Raises:
+        ValueError: If the file extension is not supported.
+    """
+    return dict(_sniff(file_path, skip_lines)['format'])
+
+
+def read_header(file_path, skip_lines=0):
+    """
+    Return the column names of a report file as written in its header line,
+    without parsing the rest of the file.
+    """
+    return list(_sniff(file_path, skip_lines)['header'])
+
+
+def use_fallback_encoding(file_path, skip_lines=0):
+    """
+    Record that a file is not UTF-8 after all (invalid bytes after the sniffed prefix)
+    and return the updated parse arguments.
+    """
+    entry = _sniff(file_path, skip_lines)
+    entry = {
+        'format': dict(entry['format'], encoding=FALLBACK_ENCODING),
+        'header': entry['header'],
+    }
+    with _sniff_cache_lock:
+        _sniff_cache[_cache_key(file_path, skip_lines)] = entry
+    return dict(entry['format'])
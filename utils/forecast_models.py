@@ -0,0 +1,184 @@
+"""
+Utility module with the forecasting models, computed for all SKUs at once.
+Every model reads the cumulative sales windows of the SKUs as one float array of shape
+(number of SKUs, 5), columns in FORECAST_PERIODS order, and returns the forecast of the next
+month for every SKU as a float array. Loops run over months, never over SKUs.
+
+The exports only carry cumulative windows (last 30/60/90 days, 12 months, 2 years), so the
+monthly history used by the time series models is rebuilt from them: the last three months
+exactly, months 4-12 and 13-24 as an even share of their window.
+"""
+
+import numpy as np
+
+FORECAST_PERIODS = ['30d', '60d', '90d', '12m', '2yr']
+FORECAST_MODELS = ['wma', 'ses', 'croston', 'sba', 'seasonal']
+
+# Demand classes of classify_demand (Syntetos-Boylan), index = class code
+DEMAND_CLASSES = ['smooth', 'erratic', 'intermittent', 'lumpy', 'no_demand']
+ADI_CUTOFF = 1.32   # average months between demands
+CV2_CUTOFF = 0.49   # squared coefficient of variation of the demand sizes
+
+HISTORY_MONTHS = 24
+
+
+def recent_months(period_sales):
+    """Return (m1, m2, m3): sales of the last, the second and the third last month."""
+    m1 = period_sales[:, 0]
+    m2 = np.clip(period_sales[:, 1] - period_sales[:, 0], 0, None)
+    m3 = np.clip(period_sales[:, 2] - period_sales[:, 1], 0, None)
+    return m1, m2, m3
+
+
+def monthly_sales_matrix(period_sales):
+    """Return the monthly sales history, shape (number of SKUs, 24), oldest month first."""
+    m1, m2, m3 = recent_months(period_sales)
+    rest_of_year = np.clip(period_sales[:, 3] - period_sales[:, 2], 0, None) / 9
+    year_before = np.clip(period_sales[:, 4] - period_sales[:, 3], 0, None) / 12
+
+    # Column-major: the models read one month of all SKUs at a time
+    monthly = np.empty((len(period_sales), HISTORY_MONTHS), order='F')
+    monthly[:, :12] = year_before[:, None]
+    monthly[:, 12:21] = rest_of_year[:, None]
+    monthly[:, 21] = m3
+    monthly[:, 22] = m2
+    monthly[:, 23] = m1
+    return monthly
+
+
+def wma_forecast(period_sales, weights):
+    """
+    Weighted moving average of the last three months.
+
+    Args:
+        weights (tuple): (w1, w2, w3) weights of the last, second and third last month.
+    """
+    w1, w2, w3 = weights
+    weight_sum = w1 + w2 + w3
+    if weight_sum <= 0:
+        raise ValueError(f"Sum of WMA weights ({weight_sum}) must be positive.")
+    m1, m2, m3 = recent_months(period_sales)
+    return (w3 * m3 + w2 * m2 + w1 * m1) / weight_sum
+
+
+def _constant_runs(monthly):
+    """
+    Split the months into runs of equal columns (the same value for every SKU over the run).
+    Returns [(first month, number of months), ...]; the rebuilt history has five runs.
+    """
+    runs = []
+    start = 0
+    for month in range(1, monthly.shape[1] + 1):
+        if month == monthly.shape[1] or not np.array_equal(monthly[:, month], monthly[:, start]):
+            runs.append((start, month - start))
+            start = month
+    return runs
+
+
+def ses_forecast(monthly, alpha):
+    """Simple exponential smoothing over the monthly history, started at the oldest month."""
+    level = monthly[:, 0].copy()
+    for start, length in _constant_runs(monthly):
+        # `length` smoothing steps towards the same value at once
+        steps = length - 1 if start == 0 else length
+        value = monthly[:, start]
+        level = value + (1 - alpha) ** steps * (level - value)
+    return level
+
+
+def croston_forecast(monthly, alpha, sba=False):
+    """
+    Croston's method for intermittent demand: demand sizes and the months between demands are
+    smoothed separately and the forecast is size / interval. With `sba` the Syntetos-Boylan
+    correction (1 - alpha / 2) removes the method's upward bias. SKUs without demand forecast 0.
+    """
+    count = len(monthly)
+    size = np.zeros(count)
+    interval = np.ones(count)
+    since_demand = np.ones(count)
+    started = np.zeros(count, dtype=bool)
+    for start, length in _constant_runs(monthly):
+        demand = monthly[:, start]
+        has_demand = demand > 0
+        first = has_demand & ~started
+        # Demand sizes: `length` steps towards the same size, SKUs starting now begin at it
+        np.copyto(size, demand + (1 - alpha) ** length * (size - demand), where=has_demand)
+        np.copyto(size, demand, where=first)
+        # Intervals: the first month of the run ends the gap since the previous demand,
+        # the other months of the run are 1 month apart
+        np.copyto(interval, interval + alpha * (since_demand - interval), where=has_demand)
+        np.copyto(interval, since_demand, where=first)
+        np.copyto(interval, 1 + (1 - alpha) ** (length - 1) * (interval - 1), where=has_demand)
+        started |= has_demand
+        since_demand += length
+        np.copyto(since_demand, 1.0, where=has_demand)
+
+    forecast = np.divide(size, interval, out=np.zeros(count), where=started)
+    if sba:
+        forecast *= 1 - alpha / 2
+    return forecast
+
+
+def seasonal_forecast(period_sales, index_limits=(0.5, 2.0)):
+    """
+    Average month of the last 12 months scaled by the year-over-year index (last 12 months over
+    the 12 months before), clipped to `index_limits`. SKUs without sales the year before use 1.
+    """
+    last_year = period_sales[:, 3]
+    year_before = np.clip(period_sales[:, 4] - last_year, 0, None)
+    index = np.ones(len(period_sales))
+    has_history = year_before > 0
+    index[has_history] = last_year[has_history] / year_before[has_history]
+    index = np.clip(index, index_limits[0], index_limits[1])
+    return last_year / 12 * index
+
+
+def classify_demand(period_sales):
+    """
+    Classify the demand of the last 12 months by average demand interval (ADI) and squared
+    coefficient of variation of the demand sizes (CV2).
+    Months 4-12 are only known in total; each unit sold counts as at most one month with demand.
+
+    Returns:
+        np.ndarray: int8 class codes, indexes into DEMAND_CLASSES.
+    """
+    m1, m2, m3 = recent_months(period_sales)
+    rest = np.clip(period_sales[:, 3] - period_sales[:, 2], 0, None)
+    rest_months = np.minimum(9, np.ceil(rest))
+    rest_size = np.divide(rest, rest_months, out=np.zeros_like(rest), where=rest_months > 0)
+
+    demand_months = (m1 > 0).astype(float) + (m2 > 0) + (m3 > 0) + rest_months
+    total = m1 + m2 + m3 + rest
+    squares = m1 ** 2 + m2 ** 2 + m3 ** 2 + rest_months * rest_size ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adi = 12 / demand_months
+        mean_size = total / demand_months
+        cv2 = (squares / demand_months - mean_size ** 2) / mean_size ** 2
+
+    has_demand = demand_months > 0
+    frequent = adi < ADI_CUTOFF
+    stable = cv2 < CV2_CUTOFF
+    classes = np.full(len(period_sales), DEMAND_CLASSES.index('no_demand'), dtype=np.int8)
+    classes[has_demand & frequent & stable] = DEMAND_CLASSES.index('smooth')
+    classes[has_demand & frequent & ~stable] = DEMAND_CLASSES.index('erratic')
+    classes[has_demand & ~frequent & stable] = DEMAND_CLASSES.index('intermittent')
+    classes[has_demand & ~frequent & ~stable] = DEMAND_CLASSES.index('lumpy')
+    return classes
+
+
+def apply_forecast_floor(forecast, period_sales, fraction, epsilon=1e-6, minimum=0.01):
+    """
+    Replace forecasts of (about) zero by `fraction` of the average monthly sales over 2 years
+    (at least `minimum`) for SKUs that sold in the last 2 years.
+
+    Returns:
+        tuple: (forecast with the floor applied, bool mask of the floored SKUs)
+    """
+    forecast = forecast.copy()
+    if fraction <= 0:
+        return forecast, np.zeros(len(forecast), dtype=bool)
+    sales_2yr = period_sales[:, 4]
+    apply_floor = (forecast <= epsilon) & (sales_2yr > 0)
+    floor_values = np.clip(sales_2yr / 24.0 * fraction, 0, None)
+    forecast[apply_floor] = np.maximum(floor_values[apply_floor], minimum)
+    return forecast, apply_floor
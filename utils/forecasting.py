@@ -1,6 +1,13 @@
+import os
 import pandas as pd
 import numpy as np
 import traceback # For detailed error logging
+from utils.helpers import a_ph, read_csv_cached
+from utils.sales_cube import build_sales_cube, sales_cube_matrix
+from utils.forecast_models import (FORECAST_PERIODS, FORECAST_MODELS, DEMAND_CLASSES, monthly_sales_matrix,
+                                   wma_forecast, ses_forecast, croston_forecast, seasonal_forecast,
+                                   classify_demand, apply_forecast_floor)
+from utils.demand_quantiles import QUANTILE_METHODS, demand_variance, demand_quantiles
 
 # --- Configurable Weights for WMA ---
 # These weights determine the influence of different sales periods on the forecast.
@@ -10,6 +17,7 @@ import traceback # For detailed error logging
 # M3: Sales from 61-90 days ago.
 # Consider adjusting these weights based on how responsive you want the forecast to be
 # versus how much stability you prefer. Higher M1 weight = more responsive to recent trends.
+# The values below are defaults, 'data/forecast_config.csv' overrides them.
 WMA_WEIGHT_M1 = 3 # Weight for the last 30 days (most recent)
 WMA_WEIGHT_M2 = 2 # Weight for the period 30-60 days ago
 WMA_WEIGHT_M3 = 1 # Weight for the period 60-90 days ago
@@ -28,40 +36,264 @@ if WEIGHT_SUM <= 0:
 MIN_FORECAST_FLOOR_FRACTION = 0.05 # e.g., 0.05 means 5% of average monthly sales over 2 years
 # ------------------------------------
 
-def _clean_sales_data(df, sku_col, units_col, period_suffix):
-    """Internal helper to clean and prepare sales data for a period."""
-    if df is None or df.empty:
-        print(f"Warning: DataFrame for period {period_suffix} is None or empty.")
-        # Return an empty DataFrame with the expected column, indexed by sku_col if possible
-        # If sku_col itself is missing, we can't set it as index.
-        cols = [f'{units_col}_{period_suffix}']
-        idx = pd.Index([], name=sku_col) # Empty index with the correct name
-        return pd.DataFrame(columns=cols, index=idx)
-
-
-    if sku_col not in df.columns or units_col not in df.columns:
-         print(f"Warning: Missing '{sku_col}' or '{units_col}' in DataFrame for period {period_suffix}. Returning empty.")
-         # Return an empty DataFrame with the expected column, indexed by sku_col if possible
-         cols = [f'{units_col}_{period_suffix}']
-         idx_name = sku_col if sku_col in df.columns else None # Use sku_col name if it exists
-         idx = pd.Index([], name=idx_name)
-         return pd.DataFrame(columns=cols, index=idx)
-
-    df_clean = df[[sku_col, units_col]].copy()
-    # Ensure units_col is treated as string before replacing commas
-    df_clean[units_col] = df_clean[units_col].astype(str).str.replace(',', '', regex=False)
-    # Convert to numeric, coercing errors, then fill NaNs with 0
-    df_clean[units_col] = pd.to_numeric(df_clean[units_col], errors='coerce').fillna(0).astype(float)
-    df_clean = df_clean.rename(columns={units_col: f'{units_col}_{period_suffix}'})
-
-    # Aggregate duplicates *before* setting the index
-    df_agg = df_clean.groupby(sku_col).sum() # This returns a DataFrame with sku_col as the index
-    return df_agg
-
-def generate_wma_forecast(all_listings_df, df_30, df_60, df_90, df_12m, df_2yr, sku_col_listings, sku_col_sales, units_col):
+# --- Sales Aggregation Rule ---
+# How duplicate SKU rows of a sales report are combined for the forecast (see utils/sales_cube.py).
+# 'sum_units' sums UNITS_ORDERED over all rows of the SKU, B2B units excluded.
+FORECAST_SALES_RULE = 'sum_units'
+# ------------------------------------
+
+# --- Forecast Models ---
+# FORECAST_MODEL selects the model of the run (see utils/forecast_models.py):
+#   'wma'       weighted moving average of the last 3 months (weights above)
+#   'ses'       simple exponential smoothing of the monthly history (SES_ALPHA)
+#   'croston'   Croston's method for intermittent demand (CROSTON_ALPHA)
+#   'sba'       Croston with the Syntetos-Boylan bias correction
+#   'seasonal'  12 month average scaled by the year-over-year index (SEASONAL_INDEX_MIN/MAX)
+#   'by_class'  model per demand class of the SKU, see MODEL_BY_CLASS
+# The minimum forecast floor above is applied to the result of every model.
+# Every setting can be overridden in 'data/forecast_config.csv' (columns 'setting', 'value').
+FORECAST_MODEL = 'wma'
+MODEL_BY_CLASS_NAME = 'by_class'
+MODEL_BY_CLASS = {
+    'smooth': 'wma',
+    'erratic': 'ses',
+    'intermittent': 'sba',
+    'lumpy': 'sba',
+    'no_demand': 'wma',
+}
+SES_ALPHA = 0.3
+CROSTON_ALPHA = 0.1
+SEASONAL_INDEX_MIN = 0.5
+SEASONAL_INDEX_MAX = 2.0
+FORECAST_CONFIG_PATH = '/data/forecast_config.csv'
+# ------------------------------------
+
+# --- Demand Quantiles ---
+# P50/P90 of next month's demand and the shipment that covers it with SERVICE_LEVEL probability
+# (see utils/demand_quantiles.py). QUANTILE_METHOD is 'analytic', 'monte_carlo' or 'normal';
+# QUANTILE_SAMPLES and QUANTILE_SEED are used by 'monte_carlo' only.
+SERVICE_LEVEL = 0.95
+QUANTILE_METHOD = 'analytic'
+QUANTILE_SAMPLES = 500
+QUANTILE_SEED = 0
+# ------------------------------------
+
+
+def _default_forecast_config():
+    config = {
+        'MODEL': FORECAST_MODEL,
+        'WMA_WEIGHT_M1': WMA_WEIGHT_M1,
+        'WMA_WEIGHT_M2': WMA_WEIGHT_M2,
+        'WMA_WEIGHT_M3': WMA_WEIGHT_M3,
+        'MIN_FORECAST_FLOOR_FRACTION': MIN_FORECAST_FLOOR_FRACTION,
+        'SES_ALPHA': SES_ALPHA,
+        'CROSTON_ALPHA': CROSTON_ALPHA,
+        'SEASONAL_INDEX_MIN': SEASONAL_INDEX_MIN,
+        'SEASONAL_INDEX_MAX': SEASONAL_INDEX_MAX,
+        'SERVICE_LEVEL': SERVICE_LEVEL,
+        'QUANTILE_METHOD': QUANTILE_METHOD,
+        'QUANTILE_SAMPLES': QUANTILE_SAMPLES,
+        'QUANTILE_SEED': QUANTILE_SEED,
+    }
+    for demand_class, model in MODEL_BY_CLASS.items():
+        config[f'MODEL_{demand_class.upper()}'] = model
+    return config
+
+
+def _check_model(name, model, allow_by_class=False):
+    allowed = FORECAST_MODELS + ([MODEL_BY_CLASS_NAME] if allow_by_class else [])
+    if model not in allowed:
+        print(f"Invalid forecast model '{model}' for '{name}'. Allowed values are {allowed}.")
+        raise ValueError(f"Invalid forecast model '{model}' for '{name}'. Allowed values are {allowed}.")
+
+
+def check_forecast_config(config):
+    """Raise ValueError if a forecast setting is out of range."""
+    _check_model('MODEL', config['MODEL'], allow_by_class=True)
+    for demand_class in DEMAND_CLASSES:
+        _check_model(f'MODEL_{demand_class.upper()}', config[f'MODEL_{demand_class.upper()}'])
+    weight_sum = config['WMA_WEIGHT_M1'] + config['WMA_WEIGHT_M2'] + config['WMA_WEIGHT_M3']
+    problems = []
+    if weight_sum <= 0:
+        problems.append(f"Sum of WMA weights ({weight_sum}) must be positive.")
+    for name in ['SES_ALPHA', 'CROSTON_ALPHA']:
+        if not 0 < config[name] <= 1:
+            problems.append(f"{name} ({config[name]}) must be in (0, 1].")
+    if not 0 < config['SEASONAL_INDEX_MIN'] <= config['SEASONAL_INDEX_MAX']:
+        problems.append("SEASONAL_INDEX_MIN must be positive and not above SEASONAL_INDEX_MAX.")
+    if not 0 < config['SERVICE_LEVEL'] < 1:
+        problems.append(f"SERVICE_LEVEL ({config['SERVICE_LEVEL']}) must be between 0 and 1.")
+    if config['QUANTILE_METHOD'] not in QUANTILE_METHODS:
+        problems.append(f"QUANTILE_METHOD must be one of {QUANTILE_METHODS}.")
+    if config['QUANTILE_SAMPLES'] < 1:
+        problems.append("QUANTILE_SAMPLES must be at least 1.")
+    if problems:
+        print("Invalid forecast settings: " + ' '.join(problems))
+        raise ValueError("Invalid forecast settings: " + ' '.join(problems))
+
+
+def _read_forecast_config(path):
+    config = _default_forecast_config()
+    settings = pd.read_csv(path, dtype=str, index_col='setting')['value']
+    for name, value in settings.items():
+        name = str(name).strip()
+        if name not in config:
+            print(f"Unknown forecast setting '{name}' in '{path}'. Known settings are {list(config)}.")
+            raise ValueError(f"Unknown forecast setting '{name}' in '{path}'.")
+        if pd.isna(value):
+            continue
+        value = str(value).strip()
+        if isinstance(config[name], str):
+            config[name] = value
+        else:
+            try:
+                config[name] = float(value)
+            except ValueError:
+                print(f"Forecast setting '{name}' in '{path}' must be a number, got '{value}'.")
+                raise
+    check_forecast_config(config)
+    return config
+
+
+def load_forecast_config():
+    """
+    Return the forecast settings: the defaults of this module overridden by
+    'data/forecast_config.csv' (if it exists). The file is read again only when it changed.
+    """
+    if not os.path.exists(a_ph(FORECAST_CONFIG_PATH)):
+        return _default_forecast_config()
+    return dict(read_csv_cached(FORECAST_CONFIG_PATH, _read_forecast_config))
+
+
+def save_forecast_config(settings):
+    """
+    Write the given settings ({name: value}) to 'data/forecast_config.csv', keeping the other
+    settings of the file. Raises ValueError (nothing is written) if a setting is unknown or out of range.
     """
-    Generates a Weighted Moving Average (WMA) forecast for the next month.
-    Includes a minimum forecast floor for items with historical sales but zero WMA.
+    config = load_forecast_config()
+    unknown = [name for name in settings if name not in config]
+    if unknown:
+        print(f"Unknown forecast setting(s) {unknown}. Known settings are {list(config)}.")
+        raise ValueError(f"Unknown forecast setting(s) {unknown}.")
+    config.update(settings)
+    check_forecast_config(config)
+
+    path = a_ph(FORECAST_CONFIG_PATH)
+    if os.path.exists(path):
+        rows = pd.read_csv(path, dtype=str)
+    else:
+        rows = pd.DataFrame(columns=['setting', 'value'])
+    for name, value in settings.items():
+        value = f'{value:g}' if isinstance(value, (int, float)) else str(value)
+        if (rows['setting'] == name).any():
+            rows.loc[rows['setting'] == name, 'value'] = value
+        else:
+            rows.loc[len(rows)] = [name, value]
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    rows.to_csv(temp_path, index=False)
+    os.replace(temp_path, path)
+
+
+def _model_forecast(model, period_sales, config):
+    if model == 'wma':
+        weights = (config['WMA_WEIGHT_M1'], config['WMA_WEIGHT_M2'], config['WMA_WEIGHT_M3'])
+        return wma_forecast(period_sales, weights)
+    if model == 'ses':
+        return ses_forecast(monthly_sales_matrix(period_sales), config['SES_ALPHA'])
+    if model in ('croston', 'sba'):
+        return croston_forecast(monthly_sales_matrix(period_sales), config['CROSTON_ALPHA'], sba=model == 'sba')
+    if model == 'seasonal':
+        return seasonal_forecast(period_sales, (config['SEASONAL_INDEX_MIN'], config['SEASONAL_INDEX_MAX']))
+    raise ValueError(f"Unknown forecast model '{model}'. Allowed values are {FORECAST_MODELS}.")
+
+
+def compute_forecast(period_sales, model=None, config=None):
+    """
+    Forecast the next month for every SKU, before the minimum floor and rounding.
+
+    Args:
+        period_sales (np.ndarray): Sales of the SKUs, shape (SKUs, 5), columns in FORECAST_PERIODS order.
+        model (str, optional): One of FORECAST_MODELS or 'by_class', config['MODEL'] by default.
+        config (dict, optional): Forecast settings, load_forecast_config() by default.
+
+    Returns:
+        np.ndarray: Forecast per SKU.
+    """
+    config = config or load_forecast_config()
+    model = model or config['MODEL']
+    _check_model('model', model, allow_by_class=True)
+    if model != MODEL_BY_CLASS_NAME:
+        return _model_forecast(model, period_sales, config)
+
+    demand_classes = classify_demand(period_sales)
+    forecast = np.zeros(len(period_sales))
+    for code, demand_class in enumerate(DEMAND_CLASSES):
+        rows = demand_classes == code
+        if rows.any():
+            class_model = config[f'MODEL_{demand_class.upper()}']
+            forecast[rows] = _model_forecast(class_model, period_sales[rows], config)
+            print(f"{rows.sum()} SKUs in demand class '{demand_class}' forecast with '{class_model}'.")
+    return forecast
+
+
+def forecast_skus(skus, sales_cube, model=None, config=None):
+    """
+    Forecast the next month of the given SKUs from the sales cube, minimum floor applied, not rounded.
+
+    Returns:
+        tuple: (sales of the SKUs, shape (SKUs, 5) in FORECAST_PERIODS order,
+                forecast per SKU, bool array of the SKUs the floor was applied to)
+    """
+    config = config or load_forecast_config()
+    period_sales = sales_cube_matrix(sales_cube, skus, FORECAST_SALES_RULE, FORECAST_PERIODS)
+    forecast, floored = forecast_period_sales(period_sales, model, config)
+    return period_sales, forecast, floored
+
+
+def forecast_period_sales(period_sales, model=None, config=None):
+    """
+    Forecast the next month from the sales windows of the SKUs, minimum floor applied, not rounded.
+
+    Returns:
+        tuple: (forecast per SKU, bool array of the SKUs the floor was applied to)
+    """
+    config = config or load_forecast_config()
+    forecast = compute_forecast(period_sales, model, config)
+    return apply_forecast_floor(forecast, period_sales, config['MIN_FORECAST_FLOOR_FRACTION'])
+
+
+def service_level_label(config=None):
+    """Name of the service level quantile, e.g. 'p95' for SERVICE_LEVEL 0.95."""
+    config = config or load_forecast_config()
+    return f"p{config['SERVICE_LEVEL'] * 100:g}"
+
+
+def generate_demand_quantiles(all_listings_df, sku_col_listings, sales_cube, model=None):
+    """
+    Quantiles of next month's demand for every SKU of the all listings report, from the same
+    forecast as generate_wma_forecast.
+
+    Returns:
+        pd.DataFrame: Indexed by SKU, columns 'p50', 'p90' and the service level quantile
+                      (see service_level_label).
+    """
+    config = load_forecast_config()
+    all_skus = all_listings_df[sku_col_listings].dropna().unique()
+    period_sales, forecast, _ = forecast_skus(all_skus, sales_cube, model, config)
+    levels = [0.5, 0.9, config['SERVICE_LEVEL']]
+    quantiles = demand_quantiles(forecast, demand_variance(period_sales, forecast), levels,
+                                 method=config['QUANTILE_METHOD'],
+                                 samples=int(config['QUANTILE_SAMPLES']), seed=int(config['QUANTILE_SEED']))
+    return pd.DataFrame(quantiles, index=pd.Index(all_skus, name=sku_col_listings),
+                        columns=['p50', 'p90', service_level_label(config)])
+
+
+def generate_wma_forecast(all_listings_df, df_30, df_60, df_90, df_12m, df_2yr, sku_col_listings, sku_col_sales, units_col, sales_cube=None, model=None):
+    """
+    Generates the forecast for the next month, a Weighted Moving Average (WMA) unless another
+    model is selected (see FORECAST_MODEL).
+    Includes a minimum forecast floor for items with historical sales but zero forecast.
 
     Uses all_listings_df to get the full list of SKUs, ensuring forecasts
     are generated even for items with zero sales in the recent periods.
@@ -76,6 +308,9 @@ def generate_wma_forecast(all_listings_df, df_30, df_60, df_90, df_12m, df_2yr,
         sku_col_listings (str): Name of the SKU column in all_listings_df.
         sku_col_sales (str): Name of the SKU column in the sales DataFrames.
         units_col (str): Name of the 'units ordered' column in sales DataFrames.
+        sales_cube (dict, optional): Sales cube already built from the same reports
+            (see utils/sales_cube.py). Built from df_30..df_2yr when not given.
+        model (str, optional): Forecast model of the run, the configured FORECAST_MODEL by default.
 
     Returns:
         dict: A dictionary mapping SKU (from sku_col_listings) to its forecast value.
@@ -96,7 +331,7 @@ def generate_wma_forecast(all_listings_df, df_30, df_60, df_90, df_12m, df_2yr,
          print("Warning: All sales DataFrames (30d, 60d, 90d, 12m, 2yr) are None. Forecast will be zero for all items.")
          # Proceed, but expect zero forecast.
 
-    # Weights are checked globally at the start of the script.
+    # Forecast settings are checked when they are loaded (load_forecast_config).
 
     try:
         # 1. Get the full list of unique SKUs from the all_listings report
@@ -107,104 +342,28 @@ def generate_wma_forecast(all_listings_df, df_30, df_60, df_90, df_12m, df_2yr,
              return {}
         print(f"Found {len(all_skus)} unique SKUs in all_listings_df.")
 
-        # Create a base DataFrame indexed by all unique SKUs
-        forecast_base = pd.DataFrame(index=pd.Index(all_skus, name=sku_col_listings))
-
-        # 2. Clean and prepare sales data for each period
-        # Pass the correct SKU column name for sales data
-        sales_30 = _clean_sales_data(df_30, sku_col_sales, units_col, '30d')
-        sales_60 = _clean_sales_data(df_60, sku_col_sales, units_col, '60d')
-        sales_90 = _clean_sales_data(df_90, sku_col_sales, units_col, '90d')
-        sales_12m = _clean_sales_data(df_12m, sku_col_sales, units_col, '12m')
-        sales_2yr = _clean_sales_data(df_2yr, sku_col_sales, units_col, '2yr')
-
-        # Check if cleaning resulted in non-empty DataFrames before joining
-        # Include 12m and 2yr in the list of DFs to join
-        valid_sales_dfs = [df for df in [sales_90, sales_60, sales_30, sales_12m, sales_2yr] if isinstance(df, pd.DataFrame) and not df.empty]
-
-        # 3. Combine sales data with the forecast base
-        # Use left join to keep all SKUs from forecast_base, fill missing sales with 0
-        if valid_sales_dfs:
-            combined_sales = forecast_base.join(valid_sales_dfs, how='left')
-        else:
-            # If no valid sales data, create DataFrame with 0s for expected columns
-            combined_sales = forecast_base.copy()
-            # Include 12m and 2yr columns
-            for period in ['90d', '60d', '30d', '12m', '2yr']:
-                col_name = f'{units_col}_{period}'
-                if col_name not in combined_sales.columns:
-                    combined_sales[col_name] = 0.0 # Ensure float type
-
-        combined_sales = combined_sales.fillna(0) # Fill any NaNs resulting from join
-
-        # Check if combined_sales is empty or lost its index
-        if combined_sales.empty:
-             print("Error: Combined sales data is empty after joining and cleaning.")
-             return {}
-        if combined_sales.index.name != sku_col_listings:
-             print(f"Error: Index name mismatch after join. Expected '{sku_col_listings}', got '{combined_sales.index.name}'.")
-             # Attempt to reset index if it helps, or return error
-             # combined_sales = combined_sales.reset_index().set_index(sku_col_listings) # Risky if index name is wrong
-             return {}
-
-
-        # 4. Calculate approximate monthly sales (M1, M2, M3)
-        units_30d_col = f'{units_col}_30d'
-        units_60d_col = f'{units_col}_60d'
-        units_90d_col = f'{units_col}_90d'
-        # Add columns for 12m and 2yr sales
-        units_12m_col = f'{units_col}_12m'
-        units_2yr_col = f'{units_col}_2yr'
-
-        # Ensure columns exist, default to 0 Series if not
-        s_30 = combined_sales[units_30d_col] if units_30d_col in combined_sales else pd.Series(0.0, index=combined_sales.index)
-        s_60 = combined_sales[units_60d_col] if units_60d_col in combined_sales else pd.Series(0.0, index=combined_sales.index)
-        s_90 = combined_sales[units_90d_col] if units_90d_col in combined_sales else pd.Series(0.0, index=combined_sales.index)
-        # Get 12m and 2yr sales Series
-        s_12m = combined_sales[units_12m_col] if units_12m_col in combined_sales else pd.Series(0.0, index=combined_sales.index)
-        s_2yr = combined_sales[units_2yr_col] if units_2yr_col in combined_sales else pd.Series(0.0, index=combined_sales.index)
-
-        # M1: Sales in the last 30 days
-        m1 = s_30
-        # M2: Sales in the period 31-60 days ago
-        m2_calc = s_60 - s_30
-        # M3: Sales in the period 61-90 days ago
-        m3_calc = s_90 - s_60
-
-        # Ensure calculated monthly sales are not negative
-        m2 = m2_calc.clip(lower=0)
-        m3 = m3_calc.clip(lower=0)
-
-        # 5. Calculate WMA using configured weights
-        # WEIGHT_SUM is pre-calculated and checked globally
-        wma_values = (WMA_WEIGHT_M3 * m3 + WMA_WEIGHT_M2 * m2 + WMA_WEIGHT_M1 * m1) / WEIGHT_SUM
-
-        # 6. Calculate Minimum Forecast Floor (if enabled)
-        final_forecast = wma_values.copy() # Start with WMA values
-        if MIN_FORECAST_FLOOR_FRACTION > 0:
-            # Calculate average monthly sales over 2 years (avoid division by zero)
-            # Use s_2yr directly (total sales over 2 years)
-            avg_monthly_2yr = s_2yr / 24.0
-            # Calculate the floor value
-            floor_values = (avg_monthly_2yr * MIN_FORECAST_FLOOR_FRACTION).clip(lower=0) # Ensure floor is not negative
-
-            # Apply the floor where WMA is zero (or very close to zero) but 2yr sales exist
-            # Using a small epsilon to handle potential floating point inaccuracies
-            epsilon = 1e-6
-            apply_floor_mask = (wma_values <= epsilon) & (s_2yr > 0)
-            # Ensure the floor is at least 0.01 to avoid rounding to zero
-            final_forecast[apply_floor_mask] = np.maximum(floor_values[apply_floor_mask], 0.01)
-
-            # Optional: Print how many SKUs had the floor applied
-            num_floored = apply_floor_mask.sum()
-            if num_floored > 0:
-                print(f"Applied minimum forecast floor to {num_floored} SKUs.")
-
-        # 7. Round the final forecast
-        final_forecast_rounded = final_forecast.round(2) # Round to 2 decimal places
-
-        # 8. Convert the resulting Series (indexed by SKU) to a dictionary
-        forecast_dict = final_forecast_rounded.to_dict()
+        # 2. Get the sales of each period from the sales cube, duplicates combined with FORECAST_SALES_RULE
+        if sales_cube is None:
+            sales_cube = build_sales_cube(
+                {'30d': df_30, '60d': df_60, '90d': df_90, '12m': df_12m, '2yr': df_2yr},
+                sku_col=sku_col_sales,
+                units_col=units_col,
+                units_b2b_col=None,
+            )
+
+        # 3. Forecast with the selected model, sales aligned with the SKUs (no sales count as 0),
+        #    and apply the minimum forecast floor (if enabled)
+        _, final_forecast, apply_floor_mask = forecast_skus(all_skus, sales_cube, model)
+        # Optional: Print how many SKUs had the floor applied
+        num_floored = apply_floor_mask.sum()
+        if num_floored > 0:
+            print(f"Applied minimum forecast floor to {num_floored} SKUs.")
+
+        # 4. Round the final forecast
+        final_forecast_rounded = np.round(final_forecast, 2) # Round to 2 decimal places
+
+        # 5. Map each SKU to its forecast
+        forecast_dict = dict(zip(all_skus, final_forecast_rounded.tolist()))
 
         print(f"WMA forecast generated successfully for {len(forecast_dict)} SKUs.")
         return forecast_dict
@@ -1,27 +1,148 @@
+import hashlib
 import os
+import threading
 import pandas as pd
 
 def a_ph(relative_path):
-    
+
     root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    
+
     # Join the root path with the relative path, removing any leading '/'
     return os.path.join(root_path, relative_path.lstrip('/'))
 
 
-def retrieve_BS_sku_mapping(region = "US", statuses_allowed=['Active', 'Inactive','Incomplete']):
+MAPPING_REGIONS = ["PL", "FR", "SE", "US", "NL", "UK", "MX", "CA", "BE", "ES", "IT", "DE"]
 
-    allowed_values = ["PL", "FR", "SE", "US", "NL", "UK", "MX", "CA", "BE", "ES", "IT", "DE"]
-    if region not in allowed_values:
-        raise ValueError(f"Invalid region '{region}'. Allowed values are {allowed_values}.")
-    
-    status_column = f'status_{region}'
-    fulfillment = f'fulfillment_{region}'
+# Regions served by the North American FBA network; the others are fulfilled by Amazon EU
+NA_REGIONS = ["US", "CA", "MX"]
+
+
+def fba_channel_for_region(region):
+    """Return the all listings 'fulfillment-channel' value of FBA listings in the region."""
+    return 'AMAZON_NA' if region in NA_REGIONS else 'AMAZON_EU'
+
+SKU_MAPPING_PATH = '/data/amazon/amz_sku_mapping.csv'
+
+# Columns of the SKU mapping read by the pipeline, plus status_<REGION> and fulfillment_<REGION> per region
+SKU_MAPPING_KEY_COLUMNS = ['seller_sku', 'B_SKU', 'BS_SKU']
+
+
+def sku_mapping_columns(regions=None):
+    """Return the SKU mapping columns needed for the regions (all MAPPING_REGIONS by default)."""
+    regions = MAPPING_REGIONS if regions is None else list(regions)
+    invalid_regions = [region for region in regions if region not in MAPPING_REGIONS]
+    if invalid_regions:
+        raise ValueError(f"Invalid region(s) {invalid_regions}. Allowed values are {MAPPING_REGIONS}.")
+    return (SKU_MAPPING_KEY_COLUMNS
+            + [f'status_{region}' for region in regions]
+            + [f'fulfillment_{region}' for region in regions])
+
+# --- SKU Mapping Store ---
+# The mapping CSV is parsed once and reused until the file changes (size, modification time,
+# then content hash). With SKU_MAPPING_PERSIST the parsed table is also kept as a pickle in
+# 'data/cache' so the next run starts without parsing the CSV.
+SKU_MAPPING_PERSIST = True
+SKU_MAPPING_STORE_PATH = '/data/cache/amz_sku_mapping.pkl'
+# ------------------------------------
+
+_mapping_store = {'signature': None, 'table': None, 'mappings': {}}
+_mapping_store_lock = threading.RLock()
+
+
+def _file_signature(file_path):
+    stat = os.stat(file_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _file_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_persisted_mapping(signature, csv_path):
+    """Return the persisted table if it was built from the same file, else None."""
+    store_path = a_ph(SKU_MAPPING_STORE_PATH)
+    if not SKU_MAPPING_PERSIST or not os.path.exists(store_path):
+        return None, None
+    try:
+        persisted = pd.read_pickle(store_path)
+    except Exception as e:
+        print(f"Could not read the stored SKU mapping '{store_path}': {e}")
+        return None, None
+    if persisted.get('signature') == signature:
+        return persisted['table'], persisted['hash']
+    # Same content with a new modification time (e.g. downloaded again)
+    content_hash = _file_hash(csv_path)
+    if persisted.get('hash') == content_hash:
+        return persisted['table'], content_hash
+    return None, content_hash
+
+
+def _persist_mapping(table, signature, content_hash):
+    store_path = a_ph(SKU_MAPPING_STORE_PATH)
+    temp_path = f"{store_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        pd.to_pickle({'signature': signature, 'hash': content_hash, 'table': table}, temp_path)
+        os.replace(temp_path, store_path)
+    except Exception as e:
+        print(f"Could not store the SKU mapping in '{store_path}': {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
 
 
+def load_sku_mapping_table():
+    """
+    Return the SKU mapping table ('data/amazon/amz_sku_mapping.csv', all columns as str).
+    The file is parsed again only when it changed since the last call.
+    """
+    csv_path = a_ph(SKU_MAPPING_PATH)
+    signature = _file_signature(csv_path)
+    with _mapping_store_lock:
+        if _mapping_store['signature'] == signature:
+            return _mapping_store['table']
+
+        table, content_hash = _load_persisted_mapping(signature, csv_path)
+        if table is None:
+            table = pd.read_csv(csv_path, dtype=str)
+            if SKU_MAPPING_PERSIST:
+                _persist_mapping(table, signature, content_hash or _file_hash(csv_path))
+        elif SKU_MAPPING_PERSIST and content_hash is not None:
+            # Record the new modification time so the next run skips hashing
+            _persist_mapping(table, signature, content_hash)
+
+        _mapping_store['signature'] = signature
+        _mapping_store['table'] = table
+        _mapping_store['mappings'] = {}
+        return table
+
+
+def clear_sku_mapping_store():
+    """Forget the parsed mapping table and the mappings derived from it (not the stored copy)."""
+    with _mapping_store_lock:
+        _mapping_store['signature'] = None
+        _mapping_store['table'] = None
+        _mapping_store['mappings'] = {}
+
+
+def _cached_mapping(kind, region, statuses_allowed, build):
+    if region not in MAPPING_REGIONS:
+        raise ValueError(f"Invalid region '{region}'. Allowed values are {MAPPING_REGIONS}.")
+    with _mapping_store_lock:
+        source_df = load_sku_mapping_table()
+        key = (kind, region, tuple(statuses_allowed))
+        if key not in _mapping_store['mappings']:
+            _mapping_store['mappings'][key] = build(source_df, region, statuses_allowed)
+        return _mapping_store['mappings'][key]
+
+
+def _build_BS_sku_mapping(source_df, region, statuses_allowed):
+    status_column = f'status_{region}'
+    fulfillment = f'fulfillment_{region}'
 
-    source_df = pd.read_csv(a_ph('/data/amazon/amz_sku_mapping.csv'), dtype=str)
-    
     # filter the empty status columns
     source_df = source_df[source_df[status_column].notna()]
     source_df = source_df[source_df[status_column] != '']
@@ -33,21 +154,12 @@ def retrieve_BS_sku_mapping(region = "US", statuses_allowed=['Active', 'Inactive
     source_df = source_df[source_df[fulfillment] == 'DEFAULT']
 
     # to dict map
-    amazon_sku_to_BS_sku = dict(zip(source_df['seller_sku'], source_df['BS_SKU']))
-    
-    return amazon_sku_to_BS_sku
+    return dict(zip(source_df['seller_sku'], source_df['BS_SKU']))
 
-def retrieve_B_sku_mapping(region = "US", statuses_allowed=['Active', 'Inactive','Incomplete']):
 
-    allowed_values = ["PL", "FR", "SE", "US", "NL", "UK", "MX", "CA", "BE", "ES", "IT", "DE"]
-    if region not in allowed_values:
-        raise ValueError(f"Invalid region '{region}'. Allowed values are {allowed_values}.")
-    
+def _build_B_sku_mapping(source_df, region, statuses_allowed):
     status_column = f'status_{region}'
-    fulfillment = f'fulfillment_{region}'
 
-    source_df = pd.read_csv(a_ph('/data/amazon/amz_sku_mapping.csv'), dtype=str)
-    
     # filter the empty status columns
     source_df = source_df[source_df[status_column].notna()]
     source_df = source_df[source_df[status_column] != '']
@@ -57,6 +169,34 @@ def retrieve_B_sku_mapping(region = "US", statuses_allowed=['Active', 'Inactive'
     source_df = source_df[source_df['B_SKU'] != '']
 
     # to dict map
-    amazon_sku_to_B_sku = dict(zip(source_df['seller_sku'], source_df['B_SKU']))
-    
-    return amazon_sku_to_B_sku
\ No newline at end of file
+    return dict(zip(source_df['seller_sku'], source_df['B_SKU']))
+
+
+def retrieve_BS_sku_mapping(region = "US", statuses_allowed=['Active', 'Inactive','Incomplete']):
+    """
+    Return {seller_sku: BS_SKU} for the region. The result is shared between callers, do not modify it.
+    """
+    return _cached_mapping('BS', region, statuses_allowed, _build_BS_sku_mapping)
+
+def retrieve_B_sku_mapping(region = "US", statuses_allowed=['Active', 'Inactive','Incomplete']):
+    """
+    Return {seller_sku: B_SKU} for the region. The result is shared between callers, do not modify it.
+    """
+    return _cached_mapping('B', region, statuses_allowed, _build_B_sku_mapping)
+
+
+_file_cache = {}
+
+def read_csv_cached(relative_path, loader):
+    """
+    Return loader(path) for a file under the project root, computed again only when the file
+    changed (size or modification time).
+    """
+    path = a_ph(relative_path)
+    signature = _file_signature(path)
+    cached = _file_cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    value = loader(path)
+    _file_cache[path] = (signature, value)
+    return value
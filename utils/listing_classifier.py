@@ -4,13 +4,76 @@ This module contains functions to separate Amazon listings into FBA and Merchant
 based on data from multiple reports.
 """
 
-def classify_listings(all_listings_df, fba_inventory_df=None):
+import hashlib
+import weakref
+import numpy as np
+import pandas as pd
+from .sku_codes import SKU_ID, has_sku_ids, ids_mask, decode_skus, sku_dictionary_size
+
+# Classification results memoized per (all listings, FBA inventory) DataFrame pair and FBA channel.
+# An entry is dropped when either DataFrame is garbage collected.
+_classification_cache = {}
+
+# Columns the classification reads, fingerprinted to catch reports edited in place
+_LISTINGS_COLUMNS = ['seller-sku', 'fulfillment-channel', SKU_ID]
+_INVENTORY_COLUMNS = ['sku', SKU_ID]
+
+def _cache_key(all_listings_df, fba_inventory_df, fba_channel):
+    return (id(all_listings_df), id(fba_inventory_df), fba_channel)
+
+def _cached_classification(all_listings_df, fba_inventory_df, fba_channel):
+    entry = _classification_cache.get(_cache_key(all_listings_df, fba_inventory_df, fba_channel))
+    if entry is None:
+        return None
+    listings_ref, inventory_ref, fingerprint, classification = entry
+    # The ids of collected DataFrames can be reused; also catch reports that changed
+    if listings_ref() is not all_listings_df:
+        return None
+    if fba_inventory_df is not None and inventory_ref() is not fba_inventory_df:
+        return None
+    if fingerprint != _fingerprint(all_listings_df, fba_inventory_df):
+        return None
+    return classification
+
+def _store_classification(all_listings_df, fba_inventory_df, fba_channel, classification):
+    key = _cache_key(all_listings_df, fba_inventory_df, fba_channel)
+    if key not in _classification_cache:
+        for df in (all_listings_df, fba_inventory_df):
+            if df is not None:
+                weakref.finalize(df, _classification_cache.pop, key, None)
+    _classification_cache[key] = (
+        weakref.ref(all_listings_df),
+        None if fba_inventory_df is None else weakref.ref(fba_inventory_df),
+        _fingerprint(all_listings_df, fba_inventory_df),
+        classification,
+    )
+
+def _columns_hash(df, columns):
+    columns = [col for col in columns if col in df.columns]
+    if not columns:
+        return (len(df), ())
+    row_hashes = pd.util.hash_pandas_object(df[columns], index=False).values
+    return (len(df), tuple(columns), hashlib.blake2b(row_hashes.tobytes(), digest_size=16).digest())
+
+def _fingerprint(all_listings_df, fba_inventory_df):
+    return (_columns_hash(all_listings_df, _LISTINGS_COLUMNS),
+            None if fba_inventory_df is None else _columns_hash(fba_inventory_df, _INVENTORY_COLUMNS))
+
+def clear_classification_cache():
+    """Forget all memoized classifications."""
+    _classification_cache.clear()
+
+def classify_listings(all_listings_df, fba_inventory_df=None, fba_channel='AMAZON_NA'):
     """
     Classifies listings as either FBA or Merchant based on multiple data sources.
     
+    The result is computed once per pair of report DataFrames and shared by every caller
+    (template build, FBA/Merchant mapping, inconsistency check); treat it as read-only.
+    
     Classification logic:
     1. All SKUs from FBA inventory report are considered FBA
-    2. SKUs from All Listings with fulfillment-channel=AMAZON_NA are added to FBA set
+    2. SKUs from All Listings with fulfillment-channel=fba_channel (AMAZON_NA, or AMAZON_EU
+       for European marketplaces) are added to FBA set
     3. Remaining SKUs from All Listings are classified as Merchant
     
     Args:
@@ -18,17 +81,34 @@ def classify_listings(all_listings_df, fba_inventory_df=None):
                                            with columns: 'seller-sku', 'fulfillment-channel'
         fba_inventory_df (pandas.DataFrame, optional): DataFrame containing the FBA inventory 
                                                       report with column: 'sku'
+        fba_channel (str): Fulfillment channel of FBA listings in the marketplace.
                                                       
     Returns:
-        dict: A dictionary with two keys:
+        dict: A dictionary with the keys:
               - 'fba_skus': set of SKUs classified as FBA
               - 'merchant_skus': set of SKUs classified as Merchant
+              - 'inconsistent_skus': set of fba_channel SKUs missing from the FBA inventory
+                (None without an FBA inventory report)
+              - 'skus': the normalized (stripped) SKU column of all_listings_df
+              - 'is_amazon_na': boolean array, True for listing rows with fulfillment-channel=fba_channel
+              - 'fba_mask', 'merchant_mask': the FBA and merchant sets as boolean masks over the
+                SKU dictionary (see utils/sku_codes.py), only when the reports carry SKU ids
     
     Example:
         >>> classification = classify_listings(all_listings_df, fba_inventory_df)
         >>> print(f"FBA count: {len(classification['fba_skus'])}")
         >>> print(f"Merchant count: {len(classification['merchant_skus'])}")
     """
+    classification = _cached_classification(all_listings_df, fba_inventory_df, fba_channel)
+    if classification is not None:
+        return classification
+
+    classification = _classify(all_listings_df, fba_inventory_df, fba_channel)
+    _store_classification(all_listings_df, fba_inventory_df, fba_channel, classification)
+    return classification
+
+def _classify(all_listings_df, fba_inventory_df, fba_channel):
+    """Computes the classify_listings result in one pass over the reports."""
     # Convert column names to lowercase if they aren't already
     all_listings_df.columns = all_listings_df.columns.str.lower()
     
@@ -49,13 +129,6 @@ def classify_listings(all_listings_df, fba_inventory_df=None):
     if all_listings_df[all_sku_col].dtype == 'object':  # Check if column is string type
         all_listings_df[all_sku_col] = all_listings_df[all_sku_col].fillna('').str.strip()
     
-    # Get all unique SKUs from all_listings_df
-    all_skus = set(all_listings_df[all_sku_col].unique())
-    
-    # Initialize the FBA SKUs set
-    fba_skus = set()
-    
-    # Step 1: Add SKUs from FBA inventory report if provided
     if fba_inventory_df is not None:
         fba_inventory_df.columns = fba_inventory_df.columns.str.lower()
         fba_sku_col = 'sku'
@@ -66,32 +139,78 @@ def classify_listings(all_listings_df, fba_inventory_df=None):
         # Sanitize data
         if fba_inventory_df[fba_sku_col].dtype == 'object':
             fba_inventory_df[fba_sku_col] = fba_inventory_df[fba_sku_col].fillna('').str.strip()
-            
-        # Add all SKUs from FBA inventory to the fba_skus set
-        fba_skus.update(fba_inventory_df[fba_sku_col].unique())
-    
-    # Step 2: Add SKUs from all_listings with fulfillment-channel = AMAZON_NA
+
+    # Normalized columns shared by every step below
+    skus = all_listings_df[all_sku_col]
     if has_channel_col:
-        amazon_na_skus = all_listings_df[
-            all_listings_df[all_channel_col].str.upper() == 'AMAZON_NA'
-        ][all_sku_col].unique()
+        is_amazon_na = (all_listings_df[all_channel_col].str.upper() == fba_channel).values
+    else:
+        is_amazon_na = np.zeros(len(all_listings_df), dtype=bool)
+
+    if has_sku_ids(all_listings_df, fba_inventory_df):
+        classification = _classify_listing_ids(all_listings_df, fba_inventory_df, is_amazon_na)
+    else:
+        # Get all unique SKUs from all_listings_df
+        all_skus = set(skus.unique())
         
-        fba_skus.update(amazon_na_skus)
-    
-    # Step 3: Get merchant SKUs by subtracting FBA SKUs from all SKUs
-    merchant_skus = all_skus - fba_skus
-    
-    # Return dictionary with both sets
+        # Step 1: Add SKUs from FBA inventory report if provided
+        inventory_skus = set()
+        if fba_inventory_df is not None:
+            inventory_skus = set(fba_inventory_df[fba_sku_col].unique())
+        
+        # Step 2: Add SKUs from all_listings with fulfillment-channel = fba_channel
+        amazon_na_skus = set(skus[is_amazon_na].unique())
+        fba_skus = inventory_skus | amazon_na_skus
+        
+        # Step 3: Get merchant SKUs by subtracting FBA SKUs from all SKUs
+        merchant_skus = all_skus - fba_skus
+        
+        classification = {
+            'fba_skus': fba_skus,
+            'merchant_skus': merchant_skus,
+            'inconsistent_skus': amazon_na_skus - inventory_skus if fba_inventory_df is not None else None,
+        }
+
+    classification['skus'] = skus
+    classification['is_amazon_na'] = is_amazon_na
+    return classification
+
+def _classify_listing_ids(all_listings_df, fba_inventory_df, is_amazon_na):
+    """
+    classify_listings on the SKU ids: the same steps as boolean masks over the SKU dictionary.
+    """
+    listing_ids = all_listings_df[SKU_ID].values
+    size = sku_dictionary_size()
+
+    # Step 1: SKUs from FBA inventory report
+    in_inventory = np.zeros(size, dtype=bool)
+    if fba_inventory_df is not None:
+        in_inventory[fba_inventory_df[SKU_ID].values] = True
+
+    # Step 2: SKUs from all_listings with fulfillment-channel = fba_channel
+    amazon_na_mask = ids_mask(listing_ids[is_amazon_na], size)
+    fba_mask = in_inventory | amazon_na_mask
+
+    # Step 3: Merchant SKUs are the listed SKUs that are not FBA
+    merchant_mask = ids_mask(listing_ids, size) & ~fba_mask
+
+    inconsistent_skus = None
+    if fba_inventory_df is not None:
+        inconsistent_skus = set(decode_skus(np.flatnonzero(amazon_na_mask & ~in_inventory)))
+
     return {
-        'fba_skus': fba_skus,
-        'merchant_skus': merchant_skus
+        'fba_skus': set(decode_skus(np.flatnonzero(fba_mask))),
+        'merchant_skus': set(decode_skus(np.flatnonzero(merchant_mask))),
+        'inconsistent_skus': inconsistent_skus,
+        'fba_mask': fba_mask,
+        'merchant_mask': merchant_mask,
     }
 
-def get_inconsistent_skus(all_listings_df, fba_inventory_df):
+def get_inconsistent_skus(all_listings_df, fba_inventory_df, fba_channel='AMAZON_NA'):
     """
     Identifies SKUs with potential inconsistencies between reports.
     
-    Finds SKUs that are marked as AMAZON_NA in all_listings_df but 
+    Finds SKUs that are marked as fba_channel (AMAZON_NA by default) in all_listings_df but 
     are not present in the fba_inventory_df.
     
     Args:
@@ -126,20 +245,5 @@ def get_inconsistent_skus(all_listings_df, fba_inventory_df):
     if fba_sku_col not in fba_inventory_df.columns:
         raise KeyError(f"Required column '{fba_sku_col}' not found in FBA inventory DataFrame")
     
-    # Sanitize data
-    if all_listings_df[all_sku_col].dtype == 'object':
-        all_listings_df[all_sku_col] = all_listings_df[all_sku_col].fillna('').str.strip()
-        
-    if fba_inventory_df[fba_sku_col].dtype == 'object':
-        fba_inventory_df[fba_sku_col] = fba_inventory_df[fba_sku_col].fillna('').str.strip()
-    
-    # Get set of SKUs from FBA inventory
-    fba_skus = set(fba_inventory_df[fba_sku_col].unique())
-    
-    # Find SKUs marked as AMAZON_NA but not in FBA inventory
-    amazon_na_skus = set(all_listings_df[
-        all_listings_df[all_channel_col].str.upper() == 'AMAZON_NA'
-    ][all_sku_col].unique())
-    
-    # Return the inconsistencies
-    return amazon_na_skus - fba_skus 
\ No newline at end of file
+    # Shared with classify_listings: computed once per pair of reports
+    return classify_listings(all_listings_df, fba_inventory_df, fba_channel)['inconsistent_skus']
@@ -0,0 +1,146 @@
+"""
+Utility module for checking the Amazon exports before any heavy work is done.
+Only the header line of every export is read, so a wrong column name in 'data/config.csv'
+or a report dropped into the wrong folder is reported in milliseconds instead of after
+all reports were parsed and the SKU mapping was downloaded.
+"""
+
+import os
+from utils.file_sniffer import read_header
+from utils.report_schema import SALES_FOLDERS, WEEKLY_FOLDERS, required_columns
+from utils.helpers import MAPPING_REGIONS
+
+IGNORED_FILES = ['.gitkeep', '.DS_Store']
+
+# Lines above the header of the weekly shipment exports
+WEEKLY_SKIP_LINES = 7
+
+# Readable names of the single-folder reports, used in messages
+REPORT_KIND_NAMES = {
+    'all_listings_report': 'all listings',
+    'FBA_Inventory': 'FBA inventory',
+    'restock_report': 'restock inventory',
+}
+
+
+def list_report_files(directory):
+    """Return the report files of an export folder (placeholder files excluded)."""
+    return [f for f in os.listdir(directory)
+            if os.path.isfile(os.path.join(directory, f)) and f not in IGNORED_FILES]
+
+
+def _report_kinds(report_schemas):
+    """
+    Group the report folders by the kind of export they hold.
+    Returns {kind: (folders, required columns, lines above the header)}
+    """
+    kinds = {}
+    for folder, schema in report_schemas.items():
+        if folder in SALES_FOLDERS:
+            kind = 'sales'
+        elif folder in WEEKLY_FOLDERS:
+            kind = 'weekly shipments'
+        else:
+            kind = REPORT_KIND_NAMES.get(folder, folder)
+        skip_lines = WEEKLY_SKIP_LINES if folder in WEEKLY_FOLDERS else 0
+        folders, _, _ = kinds.get(kind, ([], None, None))
+        kinds[kind] = (folders + [folder], set(required_columns(folder, schema)), skip_lines)
+    return kinds
+
+
+def detect_report_kind(file_path, report_schemas):
+    """
+    Detect which kind of export a file is from its header signature.
+
+    Returns:
+        tuple: (kind, folders the file belongs in), or (None, []) if no signature matches.
+    """
+    for kind, (folders, required_columns, skip_lines) in _report_kinds(report_schemas).items():
+        try:
+            header = {column.lower() for column in read_header(file_path, skip_lines)}
+        except Exception:
+            continue
+        if required_columns <= header:
+            return kind, folders
+    return None, []
+
+
+def check_report_file(file_path, folder, report_schemas, report_constants):
+    """
+    Check the header of one export against the columns its folder requires.
+
+    Returns:
+        str: Description of the problem, or None if the file is fine.
+    """
+    skip_lines = WEEKLY_SKIP_LINES if folder in WEEKLY_FOLDERS else 0
+    try:
+        header = {column.lower() for column in read_header(file_path, skip_lines)}
+    except Exception as e:
+        return f"Could not read the header of '{file_path}': {e}"
+
+    missing_columns = [column for column in required_columns(folder, report_schemas[folder])
+                       if column not in header]
+    if not missing_columns:
+        return None
+
+    kind, folders = detect_report_kind(file_path, report_schemas)
+    if kind is not None and folder not in folders:
+        destination = ' or '.join(f"'{name}'" for name in folders)
+        return f"'{file_path}' looks like a {kind} report, not a '{folder}' report. Move it to the {destination} folder."
+
+    missing = ', '.join(f"'{column}' ({report_constants[folder][column]})" for column in missing_columns)
+    return (f"'{file_path}' is missing the column(s) {missing}. "
+            f"Check the file or the matching constant(s) in './data/config.csv'.")
+
+
+def preflight_exports(directory, report_schemas, report_constants, region_exports_root=None):
+    """
+    Check every export folder of `directory` using only the header line of each file.
+
+    Args:
+        directory (str): The 'amazon exports' directory.
+        report_schemas (dict): {folder: {column: type}} as built by build_report_schemas.
+        report_constants (dict): {folder: {column: constant name}} as built by build_report_constants.
+        region_exports_root (str, optional): Folder of the multi-region exports, suggested for
+            region folders found in `directory`.
+
+    Returns:
+        list: Descriptions of all problems found (empty if the exports look fine).
+    """
+    if not os.path.isdir(directory):
+        return [f"Directory '{directory}' not found."]
+
+    problems = []
+    for name in sorted(os.listdir(directory)):
+        if not os.path.isdir(os.path.join(directory, name)) or name in report_schemas:
+            continue
+        if name in MAPPING_REGIONS and region_exports_root is not None:
+            problems.append(f"Folder '{os.path.join(directory, name)}' looks like the exports of region {name}. "
+                            f"Move it to '{os.path.join(region_exports_root, name)}' for a multi-region run.")
+        else:
+            problems.append(f"Unexpected folder '{os.path.join(directory, name)}'. "
+                            f"Only the report folders {list(report_schemas)} belong in '{directory}'.")
+
+    for folder in report_schemas:
+        folder_path = os.path.join(directory, folder)
+        if not os.path.isdir(folder_path):
+            # The weekly shipment columns are left empty without their folders, the other reports are required
+            if folder not in WEEKLY_FOLDERS:
+                problems.append(f"Folder '{folder_path}' not found. Create it and put the {folder} export in it.")
+            continue
+        files = sorted(list_report_files(folder_path))
+
+        if folder not in WEEKLY_FOLDERS:
+            if not files:
+                problems.append(f"No valid files found in directory '{folder_path}'")
+                continue
+            if len(files) > 1:
+                problems.append(f"More than one valid file found in directory '{folder_path}'")
+                continue
+
+        for file in files:
+            problem = check_report_file(os.path.join(folder_path, file), folder, report_schemas, report_constants)
+            if problem:
+                problems.append(problem)
+
+    return problems
@@ -0,0 +1,134 @@
+"""
+Utility module for caching parsed Amazon exports between runs.
+Each parsed report is stored under a key derived from the content of its source files
+and the schema used to read them, so an unchanged export is never parsed twice while
+any change to the file or to its columns in 'data/config.csv' produces a new entry.
+Entries are written as Parquet when pyarrow is installed and as pickle otherwise.
+"""
+
+import hashlib
+import os
+import pandas as pd
+from utils.helpers import a_ph
+
+try:
+    import pyarrow  # noqa: F401 - only needed by DataFrame.to_parquet/read_parquet
+    CACHE_FORMAT = 'parquet'
+except ImportError:
+    CACHE_FORMAT = 'pkl'
+
+CACHE_DIR = a_ph('/data/cache')
+
+# Total size of the cache folder; the least recently used entries are removed above it
+MAX_CACHE_SIZE_BYTES = 1024 * 1024 * 1024  # 1 GB
+
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_content_hash(file_path):
+    """Return the SHA-256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def compute_cache_key(file_paths, *parts):
+    """
+    Build the cache key for a report made of one or more files.
+
+    Args:
+        file_paths (list): Source files of the report. Their content and extension are part of the key,
+                           their names and order are not.
+        *parts: Anything else that changes how the files are parsed (schema, skipped lines, versions).
+
+    Returns:
+        str: Hex digest usable as a file name.
+    """
+    file_keys = sorted(f"{os.path.splitext(path)[1].lower()}:{file_content_hash(path)}" for path in file_paths)
+    digest = hashlib.sha256()
+    for item in file_keys + [repr(part) for part in parts]:
+        digest.update(item.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _cache_path(key, cache_dir):
+    return os.path.join(cache_dir, f"{key}.{CACHE_FORMAT}")
+
+
+def load_cached_report(key, cache_dir=CACHE_DIR):
+    """
+    Return the cached DataFrame for a key, or None if there is no usable entry.
+    """
+    path = _cache_path(key, cache_dir)
+    if not os.path.exists(path):
+        return None
+    try:
+        if CACHE_FORMAT == 'parquet':
+            df = pd.read_parquet(path)
+        else:
+            df = pd.read_pickle(path)
+    except Exception as e:
+        print(f"Ignoring unreadable cache entry '{path}': {e}")
+        return None
+    # Mark the entry as recently used for the eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return df
+
+
+def store_cached_report(key, df, cache_dir=CACHE_DIR, max_size_bytes=MAX_CACHE_SIZE_BYTES):
+    """
+    Store a parsed DataFrame under a key and evict old entries if the cache grew too large.
+    Failing to write the cache never fails the run.
+    """
+    path = _cache_path(key, cache_dir)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        if CACHE_FORMAT == 'parquet':
+            df.to_parquet(temp_path)
+        else:
+            df.to_pickle(temp_path)
+        # Atomic on the same filesystem, so parallel readers never see a partial file
+        os.replace(temp_path, path)
+    except Exception as e:
+        print(f"Could not write cache entry for '{key}': {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    evict_cache(cache_dir, max_size_bytes)
+
+
+def evict_cache(cache_dir=CACHE_DIR, max_size_bytes=MAX_CACHE_SIZE_BYTES):
+    """
+    Remove the least recently used cache entries until the folder fits in max_size_bytes.
+    """
+    try:
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if os.path.isfile(path) and not name.endswith('.tmp'):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+    except FileNotFoundError:
+        return
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size_bytes:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """Remove every cache entry."""
+    evict_cache(cache_dir, max_size_bytes=0)
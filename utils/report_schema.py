@@ -0,0 +1,153 @@
+"""
+Utility module describing which columns the pipeline reads from each Amazon export.
+The schemas are built from 'data/config.csv' so that the reader can load only the
+columns it needs (usecols) and parse each of them with a known type instead of
+letting pandas infer dtypes for every column of every report.
+"""
+
+import pandas as pd
+
+# Column types understood by apply_schema_dtypes
+SKU_TYPE = 'sku'      # kept as string, never inferred as a number
+STR_TYPE = 'str'      # free text
+INT_TYPE = 'int'      # unit counts, thousands separators stripped, missing values become 0
+FLOAT_TYPE = 'float'  # prices, thousands separators stripped, missing values stay NaN
+
+SALES_FOLDERS = ['30d', '60d', '90d', '12m', '2yr']
+WEEKLY_FOLDERS = ['1_W', '2_W', '3_W', '4_W']
+
+# Bump when reports are parsed or aggregated differently, so cached parsed reports are rebuilt
+SCHEMA_VERSION = 3
+
+
+# Columns read from each kind of report: (constant name in config.csv, default column name, type)
+_ALL_LISTINGS_COLUMNS = [
+    ('SELLER_SKU', None, SKU_TYPE),
+    ('ASIN1', 'asin1', STR_TYPE),
+    ('ITEM_NAME', 'item-name', STR_TYPE),
+    ('STATUS', 'status', STR_TYPE),
+    ('FULFILLMENT_CHANNEL', 'fulfillment-channel', STR_TYPE),
+    ('PRICE', None, FLOAT_TYPE),
+]
+# Not used by the pipeline, only copied to 'results/potential_not_mapped_borders.csv' which is
+# opened by hand. Loaded when the report has them, never required.
+_ALL_LISTINGS_OUTPUT_COLUMNS = ['item-description', 'listing-id', 'quantity', 'open-date']
+_FBA_INVENTORY_COLUMNS = [
+    ('SKU', None, SKU_TYPE),
+    ('AVAILABLE', None, INT_TYPE),
+    ('INBOUND_QUANTITY', None, INT_TYPE),
+]
+_RESTOCK_COLUMNS = [
+    ('MERCHANT_SKU', None, SKU_TYPE),
+    ('AVAILABLE', None, INT_TYPE),
+    ('INBOUND', None, INT_TYPE),
+]
+_SALES_COLUMNS = [
+    ('SKU', None, SKU_TYPE),
+    ('UNITS_ORDERED', None, INT_TYPE),
+    ('UNITS_ORDERED_B2B', None, INT_TYPE),
+]
+_WEEKLY_COLUMNS = [
+    ('MERCHANT_SKU_W', None, SKU_TYPE),
+    ('SHIPPED_W', None, INT_TYPE),
+]
+
+
+def _report_columns():
+    """Return {report folder name: [(constant name, default column name, type), ...]}"""
+    report_columns = {
+        'all_listings_report': _ALL_LISTINGS_COLUMNS,
+        'FBA_Inventory': _FBA_INVENTORY_COLUMNS,
+        'restock_report': _RESTOCK_COLUMNS,
+    }
+    for folder in SALES_FOLDERS:
+        report_columns[folder] = _SALES_COLUMNS
+    for folder in WEEKLY_FOLDERS:
+        report_columns[folder] = _WEEKLY_COLUMNS
+    return report_columns
+
+
+def _output_columns():
+    """Return {report folder name: [optional column name, ...]}"""
+    return {'all_listings_report': _ALL_LISTINGS_OUTPUT_COLUMNS}
+
+
+def _column_name(config, const_name, default=None):
+    value = config.get(const_name, default)
+    if value is None or pd.isna(value):
+        raise KeyError(f"Missing constant '{const_name}' in config file")
+    return str(value).lower()
+
+
+def build_report_schemas(config):
+    """
+    Build the per-report schema registry from the config mapping.
+
+    Args:
+        config (dict): Mapping of 'const name' to 'column name' as read from 'data/config.csv'.
+
+    Returns:
+        dict: {report folder name: {lower case column name: column type}}, the optional
+              output columns of a report (see required_columns) last.
+    """
+    schemas = {
+        folder: {_column_name(config, const_name, default): column_type
+                 for const_name, default, column_type in columns}
+        for folder, columns in _report_columns().items()
+    }
+    for folder, columns in _output_columns().items():
+        for column in columns:
+            schemas[folder].setdefault(column, STR_TYPE)
+    return schemas
+
+
+def required_columns(folder, schema):
+    """Return the columns of a report schema that every export of `folder` must have."""
+    optional = set(_output_columns().get(folder, []))
+    return [column for column in schema if column not in optional]
+
+
+def build_report_constants(config):
+    """
+    Build the mapping from each report's columns back to their config constant,
+    used to tell the user which row of 'data/config.csv' to fix.
+
+    Returns:
+        dict: {report folder name: {lower case column name: constant name}}
+    """
+    return {
+        folder: {_column_name(config, const_name, default): const_name
+                 for const_name, default, _ in columns}
+        for folder, columns in _report_columns().items()
+    }
+
+
+def schema_usecols(schema):
+    """
+    Return a usecols callable for pd.read_csv that keeps the schema columns.
+    Header names are compared case-insensitively because the reader lowercases them afterwards.
+    """
+    wanted = set(schema)
+    return lambda column: str(column).lower() in wanted
+
+
+def apply_schema_dtypes(df, schema):
+    """
+    Convert the columns of a DataFrame (with lower case headers, read with dtype=str)
+    to the types declared in the schema. Columns missing from the DataFrame are ignored
+    so the usual "column not found" errors are raised by the code that needs them.
+    """
+    for column, column_type in schema.items():
+        if column not in df.columns:
+            continue
+        if column_type in (INT_TYPE, FLOAT_TYPE):
+            values = df[column]
+            if not pd.api.types.is_numeric_dtype(values):
+                values = pd.to_numeric(values.astype(str).str.replace(',', '', regex=False), errors='coerce')
+            if column_type == INT_TYPE:
+                values = values.fillna(0)
+                # Keep fractional values (should not happen for unit counts) instead of truncating them
+                if (values % 1 == 0).all():
+                    values = values.astype('int64')
+            df[column] = values
+    return df
@@ -0,0 +1,124 @@
+"""
+Utility module holding the sales of every SKU for all sales periods in one place.
+The sales reports are reduced once per run into NumPy arrays (SKU x period) of summed units,
+summed B2B units and the largest single-row total, and every consumer (template sales columns,
+merchant rollups, forecast) reads the aggregate it needs from there.
+
+How duplicate SKU rows of a report are combined is chosen by name when reading:
+    'max_total'  largest UNITS_ORDERED + UNITS_ORDERED_B2B of a single row (template sales columns)
+    'sum_total'  sum of UNITS_ORDERED + UNITS_ORDERED_B2B over all rows
+    'sum_units'  sum of UNITS_ORDERED over all rows, B2B excluded (forecast)
+"""
+
+import numpy as np
+import pandas as pd
+from utils.report_schema import SALES_FOLDERS
+
+SALES_RULES = ['max_total', 'sum_total', 'sum_units']
+
+
+def _numeric(values):
+    if not pd.api.types.is_numeric_dtype(values):
+        values = pd.to_numeric(values.astype(str).str.replace(',', '', regex=False), errors='coerce')
+    return values.fillna(0).astype(float)
+
+
+def _reduce_period(df, period, sku_col, units_col, units_b2b_col, max_total_col):
+    """Return one row per SKU with summed units, summed B2B units and the largest row total."""
+    for col in [sku_col, units_col, units_b2b_col]:
+        if col is not None and col not in df.columns:
+            raise KeyError(f"Column '{col}' not found in the {period} sales report.")
+
+    units = _numeric(df[units_col])
+    units_b2b = _numeric(df[units_b2b_col]) if units_b2b_col is not None else units * 0
+    if max_total_col is not None and max_total_col in df.columns:
+        # Reports reduced while reading carry the per-SKU maximum already
+        max_total = _numeric(df[max_total_col])
+    else:
+        max_total = units + units_b2b
+
+    rows = pd.DataFrame({'sku': df[sku_col].values, 'units': units.values,
+                         'units_b2b': units_b2b.values, 'max_total': max_total.values})
+    return rows.groupby('sku', sort=False).agg({'units': 'sum', 'units_b2b': 'sum', 'max_total': 'max'})
+
+
+def build_sales_cube(sales_dfs, sku_col, units_col, units_b2b_col, max_total_col=None, periods=None):
+    """
+    Build the sales cube from the sales reports.
+
+    Args:
+        sales_dfs (dict): {period: sales report DataFrame}. Missing or empty periods count as no sales.
+        sku_col (str): Name of the SKU column in the sales reports.
+        units_col (str): Name of the 'units ordered' column.
+        units_b2b_col (str): Name of the 'units ordered - B2B' column, None to count no B2B units.
+        max_total_col (str, optional): Column holding the per-SKU largest row total in reports
+            that were already reduced while reading.
+        periods (list, optional): Periods of the cube, SALES_FOLDERS by default.
+
+    Returns:
+        dict: 'skus' (pd.Index), 'periods' (list), the float arrays 'units', 'units_b2b' and
+              'max_total' and the bool array 'present' (SKU listed in the period's report),
+              all of shape (number of SKUs, number of periods).
+
+    Raises:
+        KeyError: If a sales report lacks one of the required columns.
+    """
+    periods = list(periods or SALES_FOLDERS)
+    reduced = {}
+    for period in periods:
+        df = sales_dfs.get(period)
+        if df is None or df.empty:
+            print(f"Warning: DataFrame for period {period} is None or empty.")
+            continue
+        reduced[period] = _reduce_period(df, period, sku_col, units_col, units_b2b_col, max_total_col)
+
+    skus = pd.Index([], dtype=object)
+    for period_df in reduced.values():
+        skus = skus.append(period_df.index)
+    skus = skus.dropna().unique()
+
+    cube = {'skus': skus, 'periods': periods}
+    for measure in ['units', 'units_b2b', 'max_total']:
+        cube[measure] = np.zeros((len(skus), len(periods)))
+    cube['present'] = np.zeros((len(skus), len(periods)), dtype=bool)
+    for period, period_df in reduced.items():
+        period_df = period_df[period_df.index.notna()]
+        rows = skus.get_indexer(period_df.index)
+        column = periods.index(period)
+        for measure in ['units', 'units_b2b', 'max_total']:
+            cube[measure][rows, column] = period_df[measure].values
+        cube['present'][rows, column] = True
+    return cube
+
+
+def sales_cube_period(cube, period, rule):
+    """
+    Return the sales of one period as a Series indexed by SKU, combining duplicate rows with `rule`.
+    SKUs that are not listed in the period's report are NaN.
+    """
+    if rule not in SALES_RULES:
+        raise ValueError(f"Unknown sales aggregation rule '{rule}'. Use one of {SALES_RULES}.")
+    column = cube['periods'].index(period)
+    if rule == 'max_total':
+        values = cube['max_total'][:, column]
+    elif rule == 'sum_total':
+        values = cube['units'][:, column] + cube['units_b2b'][:, column]
+    else:
+        values = cube['units'][:, column]
+    values = np.where(cube['present'][:, column], values, np.nan)
+    return pd.Series(values, index=cube['skus'])
+
+
+def sales_cube_matrix(cube, skus, rule, periods=None):
+    """
+    Return the sales of the given SKUs as a float array of shape (len(skus), len(periods)),
+    duplicate rows combined with `rule`. SKUs that are not listed in a period count as 0.
+    """
+    periods = list(periods or cube['periods'])
+    rows = cube['skus'].get_indexer(pd.Index(skus))
+    found = rows >= 0
+    matrix = np.zeros((len(rows), len(periods)))
+    for column, period in enumerate(periods):
+        values = sales_cube_period(cube, period, rule).values[rows[found]]
+        matrix[found, column] = np.nan_to_num(values, nan=0.0)
+    return matrix
@@ -0,0 +1,141 @@
+"""
+Utility module for the what-if scenarios of the recommended shipment (scenarios.py).
+A scenario changes some of
+    'coverage'                      months of forecast the shipment has to cover (1.5: 6 weeks)
+    'wma_weight_m1'..'m3'           WMA weights: the scenario is forecast with WMA and these weights
+    'min_forecast_floor_fraction'   minimum forecast floor
+    'count_1w'                      1 if a 1_w shipment greater than INBOUND counts as in transit
+and leaves the others at the forecast settings of 'data/forecast_config.csv'. Scenarios without
+weights keep the forecast model of the run (MODEL or --forecast-model), so a scenario that changes
+nothing reproduces the report.
+
+All scenarios are computed in one pass: their parameters are stacked into arrays and broadcast
+over the template rows, giving (scenarios, rows) arrays of forecasts and shipments.
+"""
+
+import numpy as np
+import pandas as pd
+from utils.forecast_models import recent_months
+
+SCENARIO_COLUMNS = ['name', 'coverage', 'wma_weight_m1', 'wma_weight_m2', 'wma_weight_m3',
+                    'min_forecast_floor_fraction', 'count_1w']
+WEIGHT_COLUMNS = ['wma_weight_m1', 'wma_weight_m2', 'wma_weight_m3']
+SCENARIOS_PATH = '/data/scenarios.csv'
+
+
+def scenario_defaults(config):
+    """Parameters of a scenario that changes nothing, from the forecast settings."""
+    return {
+        'coverage': 1.0,
+        'wma_weight_m1': config['WMA_WEIGHT_M1'],
+        'wma_weight_m2': config['WMA_WEIGHT_M2'],
+        'wma_weight_m3': config['WMA_WEIGHT_M3'],
+        'min_forecast_floor_fraction': config['MIN_FORECAST_FLOOR_FRACTION'],
+        'count_1w': 1.0,
+    }
+
+
+def build_scenarios(scenarios, config):
+    """
+    Complete and check the scenarios.
+
+    Args:
+        scenarios (list | pd.DataFrame): One dict (or row) per scenario with a 'name' and any of the
+            parameters; missing or empty parameters take the values of scenario_defaults.
+        config (dict): Forecast settings (see load_forecast_config).
+
+    Returns:
+        pd.DataFrame: One row per scenario, columns SCENARIO_COLUMNS (parameters as floats) and
+                      'wma', True for the scenarios that set any of the weights.
+    """
+    scenarios = pd.DataFrame(scenarios)
+    if 'name' not in scenarios.columns or scenarios['name'].isna().any():
+        print("Every scenario needs a 'name'.")
+        raise ValueError("Every scenario needs a 'name'.")
+    unknown = [col for col in scenarios.columns if col not in SCENARIO_COLUMNS]
+    if unknown:
+        print(f"Unknown scenario parameter(s) {unknown}. Known parameters are {SCENARIO_COLUMNS[1:]}.")
+        raise ValueError(f"Unknown scenario parameter(s) {unknown}.")
+    scenarios['name'] = scenarios['name'].astype(str).str.strip()
+    if scenarios['name'].duplicated().any():
+        print(f"Scenario names must be unique, found {scenarios['name'][scenarios['name'].duplicated()].tolist()}.")
+        raise ValueError("Scenario names must be unique.")
+
+    weight_columns = [col for col in WEIGHT_COLUMNS if col in scenarios.columns]
+    scenarios['wma'] = scenarios[weight_columns].notna().any(axis=1) if weight_columns else False
+
+    for col, default in scenario_defaults(config).items():
+        if col not in scenarios.columns:
+            scenarios[col] = default
+            continue
+        try:
+            scenarios[col] = pd.to_numeric(scenarios[col]).astype(float).fillna(default)
+        except (ValueError, TypeError) as e:
+            print(f"Scenario parameter '{col}' must be a number: {e}")
+            raise
+
+    problems = []
+    weights = scenarios[WEIGHT_COLUMNS]
+    if ((weights < 0).any(axis=1) | (weights.sum(axis=1) <= 0)).any():
+        problems.append("WMA weights must not be negative and their sum must be positive.")
+    if (scenarios['coverage'] < 0).any():
+        problems.append("'coverage' must not be negative.")
+    if (scenarios['min_forecast_floor_fraction'] < 0).any():
+        problems.append("'min_forecast_floor_fraction' must not be negative.")
+    if not scenarios['count_1w'].isin([0, 1]).all():
+        problems.append("'count_1w' must be 0 or 1.")
+    if problems:
+        print("Invalid scenarios: " + ' '.join(problems))
+        raise ValueError("Invalid scenarios: " + ' '.join(problems))
+    return scenarios[SCENARIO_COLUMNS + ['wma']].reset_index(drop=True)
+
+
+def scenario_forecasts(period_sales, scenarios, model_forecast=None, epsilon=1e-6, minimum=0.01):
+    """
+    Forecast with the minimum floor of every scenario, rounded to 2 decimals like the report's
+    forecast (same as compute_forecast, apply_forecast_floor and generate_wma_forecast).
+    Scenarios that set weights are forecast with WMA, the others use `model_forecast`.
+
+    Args:
+        period_sales (np.ndarray): Sales of the rows, shape (rows, 5), columns in FORECAST_PERIODS order.
+        scenarios (pd.DataFrame): Scenarios from build_scenarios.
+        model_forecast (np.ndarray, optional): Forecast of the run's model per row, before the floor.
+            Needed if a scenario does not set weights.
+
+    Returns:
+        np.ndarray: Forecasts, shape (scenarios, rows).
+    """
+    weights = scenarios[WEIGHT_COLUMNS].to_numpy()
+    shares = weights / weights.sum(axis=1, keepdims=True)
+    forecast = shares @ np.stack(recent_months(period_sales))
+    uses_model = ~scenarios['wma'].to_numpy(dtype=bool)
+    if uses_model.any():
+        if model_forecast is None:
+            raise ValueError("model_forecast is needed for scenarios without WMA weights.")
+        forecast[uses_model] = model_forecast
+
+    floors = scenarios['min_forecast_floor_fraction'].to_numpy()[:, None]
+    sales_2yr = period_sales[:, 4]
+    apply_floor = (forecast <= epsilon) & (sales_2yr > 0) & (floors > 0)
+    floor_values = np.maximum(np.clip(sales_2yr / 24.0, 0, None) * floors, minimum)
+    return np.round(np.where(apply_floor, floor_values, forecast), 2)
+
+
+def scenario_shipments(forecast, scenarios, stock, extra_1w):
+    """
+    Recommended shipment of every scenario, max(0, coverage * forecast - stock), where the stock
+    includes the 1_w shipment in the scenarios that count it.
+
+    Args:
+        forecast (np.ndarray): Forecasts from scenario_forecasts, shape (scenarios, rows).
+        scenarios (pd.DataFrame): Scenarios from build_scenarios.
+        stock (np.ndarray): INV + INBOUND per row.
+        extra_1w (np.ndarray): 1_w shipment counted on top of INBOUND per row (0 where it is not).
+
+    Returns:
+        np.ndarray: Shipments, shape (scenarios, rows).
+    """
+    coverage = scenarios['coverage'].to_numpy()[:, None]
+    count_1w = scenarios['count_1w'].to_numpy()[:, None]
+    shortfall = coverage * forecast - (stock + count_1w * extra_1w)
+    return np.round(np.maximum(shortfall, 0), 2)
@@ -0,0 +1,124 @@
+"""
+Utility module interning SKUs and ASINs into run-wide int32 ids.
+Every distinct normalized key (SKUs stripped, ASINs stripped and lower case) gets an id the
+first time it is seen and keeps it for the rest of the run, so reports interned separately
+can be joined and filtered on integer columns: membership tests become lookups in a boolean
+array indexed by id instead of hashing strings again for every `.isin`.
+
+main.py adds the SKU_ID / ASIN_ID columns to the reports right after ingestion. Functions that
+receive reports without these columns keep working on the strings.
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+
+# Columns added to the reports by add_key_ids
+SKU_ID = '_sku_id'
+ASIN_ID = '_asin_id'
+
+_dictionaries = {
+    'sku': pd.Index([], dtype=object),
+    'asin': pd.Index([], dtype=object),
+}
+_dictionaries_lock = threading.Lock()
+
+
+def normalize_skus(values):
+    """Normalized SKU keys: text stripped of surrounding whitespace, missing values as ''."""
+    return pd.Series(values, dtype=object).fillna('').astype(str).str.strip()
+
+
+def normalize_asins(values):
+    """Normalized ASIN keys: stripped and lower case, missing values as ''."""
+    return normalize_skus(values).str.lower()
+
+
+def _intern(kind, keys):
+    codes, uniques = pd.factorize(keys)
+    with _dictionaries_lock:
+        dictionary = _dictionaries[kind]
+        ids = dictionary.get_indexer(uniques)
+        new_keys = uniques[ids == -1]
+        if len(new_keys):
+            ids[ids == -1] = np.arange(len(dictionary), len(dictionary) + len(new_keys))
+            _dictionaries[kind] = dictionary.append(pd.Index(new_keys, dtype=object))
+    return ids.astype(np.int32)[codes]
+
+
+def intern_skus(values):
+    """Return the int32 ids of the (normalized) SKUs, adding unseen ones to the dictionary."""
+    return _intern('sku', normalize_skus(values).values)
+
+
+def intern_asins(values):
+    """Return the int32 ids of the (normalized) ASINs, adding unseen ones to the dictionary."""
+    return _intern('asin', normalize_asins(values).values)
+
+
+def sku_dictionary_size():
+    return len(_dictionaries['sku'])
+
+
+def asin_dictionary_size():
+    return len(_dictionaries['asin'])
+
+
+def decode_skus(ids):
+    """Return the normalized SKU strings of the given ids."""
+    return _dictionaries['sku'][np.asarray(ids, dtype=np.int64)]
+
+
+def add_key_ids(df, sku_col, asin_col=None):
+    """
+    Add the SKU_ID (and ASIN_ID) columns to a report, in place.
+    Reports without the key column are left unchanged.
+    """
+    if df is None or sku_col not in df.columns:
+        return df
+    df[SKU_ID] = intern_skus(df[sku_col].values)
+    if asin_col is not None and asin_col in df.columns:
+        df[ASIN_ID] = intern_asins(df[asin_col].values)
+    return df
+
+
+def drop_key_ids(df):
+    """Return the report without the id columns (for files written for the user)."""
+    return df.drop(columns=[col for col in [SKU_ID, ASIN_ID] if col in df.columns])
+
+
+def has_sku_ids(*dfs):
+    """True if every given report (None is skipped) carries the SKU_ID column."""
+    return all(df is None or SKU_ID in df.columns for df in dfs)
+
+
+def ids_mask(ids, size=None):
+    """Boolean array over the SKU dictionary, True at the given ids."""
+    mask = np.zeros(sku_dictionary_size() if size is None else size, dtype=bool)
+    mask[np.asarray(ids, dtype=np.int64)] = True
+    return mask
+
+
+def mask_lookup(mask, ids):
+    """mask[ids] for a mask built before more keys were interned (unknown ids are False)."""
+    ids = np.asarray(ids, dtype=np.int64)
+    found = np.zeros(len(ids), dtype=bool)
+    known = ids < len(mask)
+    found[known] = mask[ids[known]]
+    return found
+
+
+def sku_isin(df, sku_col, skus):
+    """
+    `df[sku_col].isin(skus)` where `skus` is either a set of SKU strings or a boolean mask
+    over the SKU dictionary (as returned by ids_mask). Masks are looked up by the SKU_ID column.
+    """
+    if isinstance(skus, np.ndarray):
+        if SKU_ID not in df.columns:
+            return df[sku_col].isin(set(decode_skus(np.flatnonzero(skus))))
+        ids = df[SKU_ID].values
+        found = mask_lookup(skus, ids)
+        # Like isin on the normalized strings, a value that was not stripped yet does not match
+        found[found] = df[sku_col].values[found] == decode_skus(ids[found]).values
+        return pd.Series(found, index=df.index)
+    return df[sku_col].isin(skus)
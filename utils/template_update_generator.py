@@ -1,11 +1,14 @@
+import numpy as np
 import pandas as pd
-from utils.helpers import a_ph, retrieve_B_sku_mapping, retrieve_BS_sku_mapping
+from utils.helpers import a_ph, retrieve_B_sku_mapping, retrieve_BS_sku_mapping, read_csv_cached, fba_channel_for_region
 from utils.update_resources import update_resources
-from utils.fba_merchant_mapping import create_fba_merchant_mapping
+from utils.fba_merchant_mapping import build_fba_merchant_graph, create_fba_merchant_mapping, render_merchant_skus, mapped_merchant_skus
 from utils.listing_classifier import classify_listings
+from utils.sku_codes import sku_isin, drop_key_ids, mask_lookup, decode_skus
 
 
-def preper_new_template_csv(all_listings_report, fba_inventory_report):
+def preper_new_template_csv(all_listings_report, fba_inventory_report, region="US", file_suffix='', update_mapping=True,
+                            mapping_fetch=None):
     """
     Prepare a new template CSV file based on the all listings report.
     This function updates SKU mappings, creates a new template, and identifies potential unmapped borders.
@@ -13,24 +16,42 @@ def preper_new_template_csv(all_listings_report, fba_inventory_report):
     Args:
         all_listings_report (pd.DataFrame): The all listings report data.
         fba_inventory_report (pd.DataFrame): The FBA inventory report data.
+        region (str): Marketplace region of the reports (selects the SKU mapping columns and FBA channel).
+        file_suffix (str): Added to the names of the written files, e.g. '_UK' for 'data/template_UK.csv'.
+        update_mapping (bool): Download the SKU mapping first. False when it was already downloaded
+                               for this run (multi-region mode).
+        mapping_fetch (Future, optional): Download already started with start_update_resources;
+                                          waited for instead of downloading again.
     
+    Returns:
+        dict: The FBA to Merchant SKU graph used to build the template (see build_fba_merchant_graph).
+
     Raises:
         Exception: If any step in the process fails.
     """
  
     # Step 1: Update SKU mapping data
-    try:
-        print("Retrieving current SKU mapping data")
-        update_resources()
-        print("SKU mapping data successfully updated")
-    except Exception as e:
-        print(f"Error retrieving current SKU mapping data: {e}")
-        raise 
+    if mapping_fetch is not None:
+        try:
+            print("Waiting for the SKU mapping data")
+            mapping_fetch.result()
+            print("SKU mapping data successfully updated")
+        except Exception as e:
+            print(f"Error retrieving current SKU mapping data: {e}")
+            raise
+    elif update_mapping:
+        try:
+            print("Retrieving current SKU mapping data")
+            update_resources(regions=[region])
+            print("SKU mapping data successfully updated")
+        except Exception as e:
+            print(f"Error retrieving current SKU mapping data: {e}")
+            raise 
 
     # Step 2: Create new template CSV
     try:
         print("Creating new template CSV")
-        create_new_template_csv(all_listings_report, fba_inventory_report)
+        fba_merchant_graph = create_new_template_csv(all_listings_report, fba_inventory_report, region, file_suffix)
         print("New template CSV successfully created")
     except Exception as e:
         print(f"Error creating new template CSV: {e}")
@@ -39,7 +60,7 @@ def preper_new_template_csv(all_listings_report, fba_inventory_report):
     # Step 3: Identify potential unmapped borders
     try:    
         print("Checking for potential unmapped borders")
-        potential_not_mapped_borders = get_potential_not_mapped_borders(all_listings_report)
+        potential_not_mapped_borders = get_potential_not_mapped_borders(all_listings_report, region)
         
         if len(potential_not_mapped_borders) == 0:
             print("No potential unmapped borders found")
@@ -48,7 +69,7 @@ def preper_new_template_csv(all_listings_report, fba_inventory_report):
             num_unmapped = len(potential_not_mapped_borders)
             print(f"Found {num_unmapped} potential unmapped borders")
             
-            output_path = a_ph('/results/potential_not_mapped_borders.csv')
+            output_path = a_ph(f'/results/potential_not_mapped_borders{file_suffix}.csv')
             potential_not_mapped_borders.to_csv(output_path, index=False)
             print(f"Potential unmapped borders saved to: {output_path}")
             print("Please review and update the SKU mapping for listings in the CSV file")
@@ -57,15 +78,21 @@ def preper_new_template_csv(all_listings_report, fba_inventory_report):
         raise e
 
     print("New template CSV preparation completed successfully")
+    return fba_merchant_graph
 
 
-def create_new_template_csv(all_listings_report, fba_inventory_report):
+def create_new_template_csv(all_listings_report, fba_inventory_report, region="US", file_suffix=''):
     """
     Create a new template CSV file based on the all listings report and FBA inventory report.
     
     Args:
         all_listings_report (pd.DataFrame): The all listings report data.
         fba_inventory_report (pd.DataFrame): The FBA inventory report data.
+        region (str): Marketplace region of the reports.
+        file_suffix (str): Added to the names of the written files.
+
+    Returns:
+        dict: The FBA to Merchant SKU graph (see build_fba_merchant_graph).
     """
     # Define the initial columns for the template
     initial_columns = ['Title', 'ASIN', 'WMA forecast', 'Rec Ship', 'SHP', 'N_Price', 'Price', '1_W', '2_W', '3_W', '4_W', 'Inbound', 'Inv', '30', '60', '90', '12m', '2yr', 'M_30', 'M_12m', 'Parts_num', 'FBA_SKU', 'M_SKU', 'Status']
@@ -74,37 +101,41 @@ def create_new_template_csv(all_listings_report, fba_inventory_report):
     new_template_df = pd.DataFrame(columns=initial_columns)
     
     # Get all borders listings without filtering by fulfillment channel
-    borders_listings = get_borders_listings_from_all_listings_report(all_listings_report)
+    borders_listings = get_borders_listings_from_all_listings_report(all_listings_report, region)
     
-    # Classify listings as FBA or Merchant
-    classification = classify_listings(all_listings_report, fba_inventory_report)
-    fba_skus = classification['fba_skus']
-    merchant_skus = classification['merchant_skus']
+    # Classify listings as FBA or Merchant (computed once, shared with the FBA/Merchant mapping)
+    classification = classify_listings(all_listings_report, fba_inventory_report, fba_channel_for_region(region))
+    # Id masks when the reports carry SKU ids (see utils/sku_codes.py), sets of SKUs otherwise
+    fba_skus = classification.get('fba_mask', classification['fba_skus'])
+    merchant_skus = classification.get('merchant_mask', classification['merchant_skus'])
     
     # Create FBA to Merchant SKU mapping
-    fba_merchant_mapping = create_fba_merchant_mapping(all_listings_report, fba_inventory_report)
+    fba_merchant_graph = build_fba_merchant_graph(all_listings_report, fba_inventory_report, classification=classification)
+    fba_merchant_mapping = create_fba_merchant_mapping(all_listings_report, fba_inventory_report, graph=fba_merchant_graph,
+                                                       asin_json_path=f'fba_sku_to_asin{file_suffix}.json')
     
     # PART 1: Add FBA listings to template
-    fba_template = add_fba_listings_to_template(borders_listings, fba_skus, fba_merchant_mapping, initial_columns)
+    fba_template = add_fba_listings_to_template(borders_listings, fba_skus, fba_merchant_graph, initial_columns)
     
     # PART 2: Add standalone FBM listings to template
-    template_with_fbm = add_fbm_listings_to_template(borders_listings, merchant_skus, fba_template, fba_merchant_mapping)
+    template_with_fbm = add_fbm_listings_to_template(borders_listings, merchant_skus, fba_template, fba_merchant_graph)
     
     # PART 3: Add Parts_num mapping after both FBA and FBM listings are added
-    final_template = add_parts_num_mapping(template_with_fbm, fba_merchant_mapping)
+    final_template = add_parts_num_mapping(template_with_fbm, fba_merchant_mapping, region)
     
     # Save the updated template to a CSV file
-    final_template.to_csv(a_ph('/data/template.csv'), index=False)
+    final_template.to_csv(a_ph(f'/data/template{file_suffix}.csv'), index=False)
+    return fba_merchant_graph
 
 
-def add_fba_listings_to_template(borders_listings, fba_skus, fba_merchant_mapping, initial_columns):
+def add_fba_listings_to_template(borders_listings, fba_skus, fba_merchant_graph, initial_columns):
     """
     Add FBA listings to the template.
     
     Args:
         borders_listings (pd.DataFrame): The borders listings data.
-        fba_skus (set): Set of SKUs classified as FBA.
-        fba_merchant_mapping (dict): Mapping of FBA SKUs to Merchant SKUs.
+        fba_skus (set | np.ndarray): SKUs classified as FBA, as a set or an id mask.
+        fba_merchant_graph (dict): FBA to Merchant SKU graph (see build_fba_merchant_graph).
         initial_columns (list): List of columns for the template.
         
     Returns:
@@ -115,7 +146,7 @@ def add_fba_listings_to_template(borders_listings, fba_skus, fba_merchant_mappin
     
     # Filter borders_listings to only include FBA SKUs
     if 'SKU' in borders_listings.columns:
-        fba_borders = borders_listings[borders_listings['SKU'].isin(fba_skus)].copy()
+        fba_borders = borders_listings[sku_isin(borders_listings, 'SKU', fba_skus)].copy()
         
         # Fill fba_template with data from fba_borders for the required columns
         for col in ['Title', 'ASIN', 'Parts_num', 'Status']:
@@ -125,39 +156,39 @@ def add_fba_listings_to_template(borders_listings, fba_skus, fba_merchant_mappin
         # Map the SKU column to FBA_SKU
         fba_template['FBA_SKU'] = fba_borders['SKU']
         
-        # Add M_SKU column with merchant SKUs from the mapping
-        fba_template['M_SKU'] = fba_template['FBA_SKU'].apply(
-            lambda fba_sku: ', '.join(fba_merchant_mapping.get(fba_sku, [])) if fba_sku in fba_merchant_mapping else ''
-        )
+        # Add M_SKU column with merchant SKUs from the graph
+        fba_template['M_SKU'] = render_merchant_skus(fba_merchant_graph, fba_template['FBA_SKU'])
     
     return fba_template
 
 
-def add_fbm_listings_to_template(borders_listings, merchant_skus, fba_template, fba_merchant_mapping):
+def add_fbm_listings_to_template(borders_listings, merchant_skus, fba_template, fba_merchant_graph):
     """
     Add standalone FBM (Merchant) listings to the template.
     These are border listings that only exist as merchant fulfilled, without FBA counterparts.
     
     Args:
         borders_listings (pd.DataFrame): The borders listings data
-        merchant_skus (set): Set of SKUs classified as Merchant
+        merchant_skus (set | np.ndarray): SKUs classified as Merchant, as a set or an id mask
         fba_template (pd.DataFrame): Template with FBA listings already added
-        fba_merchant_mapping (dict): Mapping of FBA SKUs to Merchant SKUs
+        fba_merchant_graph (dict): FBA to Merchant SKU graph (see build_fba_merchant_graph)
         
     Returns:
         pd.DataFrame: Template with both FBA and standalone FBM listings
     """
     # Get all merchant SKUs that are mapped to FBA SKUs
-    mapped_merchant_skus = set()
-    for fba_sku, m_skus in fba_merchant_mapping.items():
-        mapped_merchant_skus.update(m_skus)
-    
     # Get standalone merchant SKUs (those not mapped to any FBA SKU)
-    standalone_merchant_skus = merchant_skus - mapped_merchant_skus
+    if isinstance(merchant_skus, np.ndarray) and 'merchant_sku_ids' in fba_merchant_graph:
+        linked_merchant_skus = mapped_merchant_skus(fba_merchant_graph, as_mask=True)
+        standalone_merchant_skus = merchant_skus & ~mask_lookup(linked_merchant_skus, np.arange(len(merchant_skus)))
+    else:
+        if isinstance(merchant_skus, np.ndarray):
+            merchant_skus = set(decode_skus(np.flatnonzero(merchant_skus)))
+        standalone_merchant_skus = merchant_skus - mapped_merchant_skus(fba_merchant_graph)
     
     # Filter borders_listings to get only standalone merchant listings
     standalone_merchant_borders = borders_listings[
-        borders_listings['SKU'].isin(standalone_merchant_skus)
+        sku_isin(borders_listings, 'SKU', standalone_merchant_skus)
     ].copy()
     
     # If no standalone merchant listings found, return the original template
@@ -184,7 +215,7 @@ def add_fbm_listings_to_template(borders_listings, merchant_skus, fba_template,
     return final_template
 
 
-def add_parts_num_mapping(template_df, fba_merchant_mapping):
+def add_parts_num_mapping(template_df, fba_merchant_mapping, region="US"):
     """
     Add Parts_num mapping to the template after both FBA and FBM listings are added.
     Maps Parts_num based on either FBA SKU or its corresponding merchant SKUs.
@@ -192,41 +223,37 @@ def add_parts_num_mapping(template_df, fba_merchant_mapping):
     Args:
         template_df (pd.DataFrame): Template with both FBA and merchant SKUs
         fba_merchant_mapping (dict): Mapping between FBA and merchant SKUs
+        region (str): Marketplace region of the B_SKU mapping
         
     Returns:
         pd.DataFrame: Template with Parts_num mapping added
     """
-    amazon_sku_to_B_sku = retrieve_B_sku_mapping()
+    amazon_sku_to_B_sku = pd.Series(retrieve_B_sku_mapping(region), dtype=object)
     
     # Create a copy to avoid modifying the original
     result_df = template_df.copy()
+    row_index = pd.RangeIndex(len(result_df))
     
-    # Iterate through each row in the template
-    for idx, row in result_df.iterrows():
-        fba_sku = row['FBA_SKU']
-        merchant_skus = row['M_SKU'].split(', ') if row['M_SKU'] else []
-        
-        # First try to map using FBA SKU
-        if fba_sku in amazon_sku_to_B_sku:
-            result_df.at[idx, 'Parts_num'] = amazon_sku_to_B_sku[fba_sku]
-            continue
-            
-        # If no FBA mapping, try merchant SKUs
-        mapped = False
-        for m_sku in merchant_skus:
-            if m_sku and m_sku in amazon_sku_to_B_sku:
-                result_df.at[idx, 'Parts_num'] = amazon_sku_to_B_sku[m_sku]
-                mapped = True
-                break
-                
-        # If no mapping found at all
-        if not mapped:
-            result_df.at[idx, 'Parts_num'] = "UNMAPPED_BORDER"
+    # First try to map using FBA SKU
+    fba_skus = pd.Series(result_df['FBA_SKU'].values, index=row_index)
+    parts_num = fba_skus.map(amazon_sku_to_B_sku)
+    
+    # If no FBA mapping, try merchant SKUs: the first mapped one of each row wins
+    unresolved = parts_num.isna()
+    merchant_skus = pd.Series(result_df['M_SKU'].values, index=row_index)[unresolved].fillna('').astype(str)
+    merchant_skus = merchant_skus.str.split(', ').explode()
+    merchant_skus = merchant_skus[merchant_skus != '']
+    merchant_parts_num = merchant_skus.map(amazon_sku_to_B_sku).dropna()
+    first_hits = merchant_parts_num.groupby(level=0, sort=False).first()
+    parts_num[first_hits.index] = first_hits
+    
+    # If no mapping found at all
+    result_df['Parts_num'] = parts_num.fillna("UNMAPPED_BORDER").values
     
     return result_df
 
 
-def get_borders_listings_from_all_listings_report(all_listings_report_df):
+def get_borders_listings_from_all_listings_report(all_listings_report_df, region="US"):
     """
     Filter and process the all listings report to get borders listings.
     This function includes both mapped borders and listings with 'Border' in the title,
@@ -241,7 +268,7 @@ def get_borders_listings_from_all_listings_report(all_listings_report_df):
     status_col = config.get('STATUS', 'status').lower()
 
     # Get the B_SKU mapping
-    amazon_sku_to_B_sku = retrieve_B_sku_mapping()
+    amazon_sku_to_B_sku = retrieve_B_sku_mapping(region)
 
     # Filter the inventory report to include:
     # 1. Items that are in the B_SKU mapping
@@ -268,13 +295,13 @@ def get_borders_listings_from_all_listings_report(all_listings_report_df):
     return filtered_df
 
 
-def get_potential_not_mapped_borders(all_listings_report_df):
+def get_potential_not_mapped_borders(all_listings_report_df, region="US"):
     """
     Get listings that potentially could be not mapped borders.
     """
     config = read_config()
-    amazon_sku_to_BS_sku = retrieve_BS_sku_mapping()
-    amazon_sku_to_B_sku = retrieve_B_sku_mapping()
+    amazon_sku_to_BS_sku = retrieve_BS_sku_mapping(region)
+    amazon_sku_to_B_sku = retrieve_B_sku_mapping(region)
     
     # Get the column names from config
     seller_sku_col = config.get('SELLER_SKU', 'seller-sku').lower()
@@ -288,21 +315,22 @@ def get_potential_not_mapped_borders(all_listings_report_df):
             all_listings_report_df[title_col].str.contains('Border', case=False, na=False) |
             (all_listings_report_df[price_col].astype(float).between(6, 20))
         ) &
-        (all_listings_report_df[fulfillment_col] == 'AMAZON_NA') &
+        (all_listings_report_df[fulfillment_col] == fba_channel_for_region(region)) &
         (~all_listings_report_df[seller_sku_col].isin(amazon_sku_to_BS_sku.keys())) &
         (~all_listings_report_df[seller_sku_col].isin(amazon_sku_to_B_sku.keys()))
     ]
-    return filtered_df
+    return drop_key_ids(filtered_df)
 
 
 def read_config():
     """
     Read the configuration file and return it as a dictionary.
+    The file is parsed again only when it changed since the last call.
     """
     config_file_path = a_ph('/data/config.csv')
     try:
-        config_df = pd.read_csv(config_file_path, index_col='const name')
-        return config_df['column name'].to_dict()
+        config = read_csv_cached('/data/config.csv', _load_config)
+        return dict(config)
     except FileNotFoundError:
         print(f"Config file not found at '{config_file_path}'.")
         raise
@@ -311,8 +339,6 @@ def read_config():
         raise
 
 
-    
-
-
-
-
+def _load_config(config_file_path):
+    config_df = pd.read_csv(config_file_path, index_col='const name')
+    return config_df['column name'].to_dict()
@@ -1,50 +1,320 @@
 import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
 import os
 import json
+import re
+import time
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from google.oauth2.service_account import Credentials
+from google.auth.exceptions import TransportError
+from google.auth.transport.requests import AuthorizedSession
+from gspread.utils import numericise_all, rowcol_to_a1
 from dotenv import load_dotenv
-from utils.helpers import a_ph
+from utils.helpers import a_ph, SKU_MAPPING_PATH, load_sku_mapping_table, sku_mapping_columns
 
 
 
 
 amz_sku_mapping_worksheet_name = "amazon_sku_mapping"
 
-
-
-def update_resources():
+SKU_MAPPING_SHEET_ID = "1ZMzIMn7CzV_tUJSfXguHYLh3fkkgHVh_0u2NBWCzEAQ"
+
+# --- Google Sheet Sync ---
+# The mapping sheet is downloaded only when its modification time on Google Drive changed since
+# the last download, and only the columns the run needs (see sku_mapping_columns in
+# utils/helpers.py), in one batched request. Within SKU_MAPPING_SYNC_TTL seconds of the last check the local copy is used
+# without asking Google at all. When Google can not be reached the last downloaded copy is used.
+# The API addresses can be overridden with the SHEETS_API_URL / DRIVE_API_URL environment
+# variables (e.g. to point the sync at a local stand-in server).
+SKU_MAPPING_SYNC_TTL = 15 * 60
+SKU_MAPPING_META_PATH = '/data/amazon/amz_sku_mapping.meta.json'
+SHEETS_API_URL = "https://sheets.googleapis.com/v4"
+DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+GOOGLE_API_TIMEOUT = 30
+# ------------------------------------
+
+GOOGLE_API_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
+
+
+class MappingSourceUnavailable(Exception):
+    """Google could not be reached (network error, timeout or a server side error)."""
+
+
+def update_resources(force=False, session=None, regions=None):
+    """
+    Bring 'data/amazon/amz_sku_mapping.csv' up to date with the Google Sheet.
+
+    Args:
+        force (bool): Download the sheet even if the local copy looks current.
+        session (requests.Session, optional): Session used for the API calls, an authorized
+            session from the service account credentials by default.
+        regions (list, optional): Regions whose mapping columns are needed, all by default.
+    """
     # print("Updating resources")
-    update_from_google_sheet()
+    update_from_google_sheet(force, session, regions)
     # print("Resources updated ")
 
-def update_from_google_sheet():
-   
+def start_update_resources(force=False, session=None, regions=None):
+    """
+    Start update_resources() in a background thread, so the download overlaps with other work
+    (e.g. parsing the exports). The downloaded table is parsed in the same thread.
+
+    Returns:
+        concurrent.futures.Future: result() waits for the download and re-raises its error.
+    """
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sku-mapping')
+    future = executor.submit(_update_and_load_sku_mapping, force, session, regions)
+    # The thread finishes the task, the executor takes no more work
+    executor.shutdown(wait=False)
+    return future
+
+def _update_and_load_sku_mapping(force, session, regions):
+    update_resources(force, session, regions)
+    load_sku_mapping_table()
+
+def update_from_google_sheet(force=False, session=None, regions=None):
+
     try:
-        workbook = get_workbook()    
-        
-        update_amz_sku_mapping(workbook)
-     
-    except Exception as e: 
+        sync_amz_sku_mapping(force=force, session=session, regions=regions)
+
+    except Exception as e:
         print(f"Error in updating resources from google sheet {e}")
         raise e
 
 
+def sync_amz_sku_mapping(sheet_id=SKU_MAPPING_SHEET_ID, force=False, session=None, regions=None):
+    """
+    Download the SKU mapping sheet if it changed since the last download.
+    Only the columns needed for `regions` (see sku_mapping_columns) are downloaded, together with
+    the columns already in the local copy, so runs for different regions do not undo each other.
+
+    Returns:
+        str: 'fresh' (checked less than SKU_MAPPING_SYNC_TTL ago), 'unchanged', 'downloaded'
+             or 'offline' (Google unreachable, last downloaded copy kept).
+
+    Raises:
+        MappingSourceUnavailable: If Google can not be reached and there is no usable local copy.
+    """
+    required_columns = sku_mapping_columns(regions)
+    csv_path = a_ph(SKU_MAPPING_PATH)
+    local_columns = _csv_columns(csv_path)
+    has_columns = local_columns is not None and set(required_columns) <= set(local_columns)
+    meta = _read_sync_meta()
+    local_ok = (has_columns
+                and meta.get('sheet_id') == sheet_id
+                and meta.get('worksheet') == amz_sku_mapping_worksheet_name
+                and meta.get('csv_signature') == list(_csv_signature(csv_path)))
+
+    if not force and local_ok and time.time() - meta.get('checked_at', 0) < SKU_MAPPING_SYNC_TTL:
+        print("SKU mapping was checked recently, using the local copy")
+        return 'fresh'
 
-
-def update_amz_sku_mapping(workbook):
-    mapping_df = pd.DataFrame(get_worksheet_df_by_name(workbook, amz_sku_mapping_worksheet_name).get_all_records())
-    mapping_df.to_csv(os.path.join(a_ph('/data/amazon'), 'amz_sku_mapping.csv'), index=False)
+    try:
+        if session is None:
+            session = get_authorized_session()
+        modified_time = get_sheet_modified_time(session, sheet_id)
+        if not force and local_ok and modified_time is not None and modified_time == meta.get('modified_time'):
+            meta['checked_at'] = time.time()
+            _write_sync_meta(meta)
+            print("SKU mapping sheet unchanged since the last download")
+            return 'unchanged'
+
+        columns = required_columns + [column for column in local_columns or [] if column not in required_columns]
+        update_amz_sku_mapping(session, sheet_id, columns, required_columns)
+    except MappingSourceUnavailable as e:
+        if not has_columns:
+            raise
+        print(f"Could not reach Google ({e}), using the last downloaded SKU mapping")
+        return 'offline'
+
+    _write_sync_meta({
+        'sheet_id': sheet_id,
+        'worksheet': amz_sku_mapping_worksheet_name,
+        'modified_time': modified_time,
+        'checked_at': time.time(),
+        'csv_signature': list(_csv_signature(csv_path)),
+    })
+    return 'downloaded'
+
+
+def update_amz_sku_mapping(session, sheet_id=SKU_MAPPING_SHEET_ID, columns=None, required_columns=None):
+    """
+    Download the mapping worksheet columns (all SKU mapping columns by default) to
+    'data/amazon/amz_sku_mapping.csv'. Columns in `required_columns` must exist in the sheet,
+    the others are skipped when they are gone.
+    """
+    columns = columns or sku_mapping_columns()
+    required_columns = columns if required_columns is None else required_columns
+    mapping_columns = get_worksheet_columns(session, sheet_id, amz_sku_mapping_worksheet_name,
+                                            columns, required_columns)
+    mapping_df = pd.DataFrame(mapping_columns)
+    csv_text = mapping_df.to_csv(index=False)
+
+    csv_path = a_ph(SKU_MAPPING_PATH)
+    # UTF-8 like pd.read_csv reads it back, whatever the locale encoding is (cp1252 on Windows)
+    if os.path.exists(csv_path):
+        try:
+            with open(csv_path, 'r', encoding='utf-8', newline='') as f:
+                unchanged = f.read() == csv_text
+        except UnicodeDecodeError:
+            # Written with another encoding: replace it
+            unchanged = False
+        if unchanged:
+            # Same content: keep the file (and its modification time) as it is
+            print("Retrieved amazon - blue system mapping (no changes)")
+            return
+    temp_path = f"{csv_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(csv_text)
+    os.replace(temp_path, csv_path)
     print("Retrieved amazon - blue system mapping")
 
 
+def get_sheet_modified_time(session, sheet_id):
+    """
+    Return the 'modifiedTime' of the sheet on Google Drive, or None if Drive does not tell
+    (e.g. the Drive API is not enabled for the service account), in which case the sheet is
+    downloaded every time the TTL runs out.
+    """
+    url = f"{_api_url('DRIVE_API_URL', DRIVE_API_URL)}/files/{sheet_id}"
+    response = _get(session, url, params={'fields': 'modifiedTime', 'supportsAllDrives': 'true'})
+    if response.status_code != 200:
+        print(f"Could not read the modification time of the SKU mapping sheet (HTTP {response.status_code})")
+        return None
+    return response.json().get('modifiedTime')
+
+
+def get_worksheet_header(session, sheet_id, worksheet_name):
+    """Return the first row of a worksheet."""
+    response = _get_values(session, sheet_id, worksheet_name, f"'{worksheet_name}'!1:1")
+    values = response.json().get('values', [[]])
+    return values[0] if values else []
+
+
+def get_worksheet_columns(session, sheet_id, worksheet_name, columns, required_columns=None):
+    """
+    Download the named columns of a worksheet in one batched request.
+
+    Args:
+        columns (list): Header names of the columns to download.
+        required_columns (list, optional): Columns that must exist (all of `columns` by default).
+
+    Returns:
+        dict: {header: list of values} in worksheet column order, with the values converted like
+              gspread's get_all_records (numbers as int/float, blank cells as '').
+
+    Raises:
+        ValueError: If a required column is missing or appears more than once in the header.
+    """
+    required_columns = columns if required_columns is None else required_columns
+    header = get_worksheet_header(session, sheet_id, worksheet_name)
+    missing_columns = [column for column in required_columns if column not in header]
+    duplicated_columns = [column for column in columns if header.count(column) > 1]
+    if missing_columns or duplicated_columns:
+        message = (f"Worksheet {worksheet_name}: missing column(s) {missing_columns}, "
+                   f"duplicated column(s) {duplicated_columns}")
+        print(message)
+        raise ValueError(message)
+
+    positions = sorted(header.index(column) + 1 for column in columns if column in header)
+    ranges = []
+    for position in positions:
+        letter = re.sub(r'\d', '', rowcol_to_a1(1, position))
+        ranges.append(f"'{worksheet_name}'!{letter}:{letter}")
+    response = _get_values(session, sheet_id, worksheet_name, None,
+                           params={'ranges': ranges, 'majorDimension': 'COLUMNS'})
+    value_ranges = response.json().get('valueRanges', [])
+    if len(value_ranges) != len(ranges):
+        raise RuntimeError(f"Expected {len(ranges)} column ranges from worksheet {worksheet_name}, got {len(value_ranges)}")
+
+    fetched = {}
+    for position, value_range in zip(positions, value_ranges):
+        values = value_range.get('values', [[]])
+        values = values[0] if values else []
+        column = header[position - 1]
+        if not values or values[0] != column:
+            # The sheet was edited between reading the header and the columns
+            raise RuntimeError(f"Column '{column}' of worksheet {worksheet_name} moved while downloading, try again")
+        fetched[column] = values[1:]
+
+    # Columns end at their last non-empty cell, pad them to the same length
+    row_count = max((len(values) for values in fetched.values()), default=0)
+    return {column: numericise_all(values + [''] * (row_count - len(values)))
+            for column, values in fetched.items()}
+
+
+def _get_values(session, sheet_id, worksheet_name, sheet_range, params=None):
+    base_url = f"{_api_url('SHEETS_API_URL', SHEETS_API_URL)}/spreadsheets/{sheet_id}"
+    if sheet_range is None:
+        url = f"{base_url}/values:batchGet"
+    else:
+        url = f"{base_url}/values/{quote(sheet_range, safe='')}"
+    response = _get(session, url, params=params)
+    if response.status_code == 400:
+        print(f"Worksheet {worksheet_name} not found in the google sheet")
+        raise ValueError(f"Worksheet {worksheet_name} not found in the google sheet")
+    if response.status_code != 200:
+        raise RuntimeError(f"Reading worksheet {worksheet_name} failed with HTTP {response.status_code}: {response.text[:200]}")
+    return response
+
+
+def get_authorized_session():
+    session = AuthorizedSession(get_sheets_api_credentials())
+    return session
+
+
+def _get(session, url, params=None):
+    try:
+        response = session.get(url, params=params, timeout=GOOGLE_API_TIMEOUT)
+    except (requests.ConnectionError, requests.Timeout, TransportError) as e:
+        raise MappingSourceUnavailable(str(e)) from e
+    if response.status_code == 429 or response.status_code >= 500:
+        raise MappingSourceUnavailable(f"HTTP {response.status_code} from {url}")
+    return response
+
+
+def _api_url(env_name, default):
+    load_dotenv(override=False)
+    return os.getenv(env_name, default).rstrip('/')
+
+
+def _csv_columns(csv_path):
+    """Header of the local mapping copy, None if there is none."""
+    if not os.path.exists(csv_path):
+        return None
+    try:
+        return list(pd.read_csv(csv_path, nrows=0).columns)
+    except Exception:
+        return None
+
+
+def _csv_signature(csv_path):
+    stat = os.stat(csv_path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _read_sync_meta():
+    meta_path = a_ph(SKU_MAPPING_META_PATH)
+    if not os.path.exists(meta_path):
+        return {}
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read '{meta_path}', the SKU mapping will be downloaded again: {e}")
+        return {}
+
 
-def get_workbook(sheet_id = "1ZMzIMn7CzV_tUJSfXguHYLh3fkkgHVh_0u2NBWCzEAQ"):
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = get_sheets_api_credentials()
-    client = gspread.authorize(creds)
-    workbook = client.open_by_key(sheet_id)
-    return workbook
+def _write_sync_meta(meta):
+    meta_path = a_ph(SKU_MAPPING_META_PATH)
+    temp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(temp_path, meta_path)
 
 
 def get_sheets_api_credentials():
@@ -56,7 +326,7 @@ def get_sheets_api_credentials():
         "type": "service_account",
         "project_id": "w4l-inventory-update",
         "private_key_id": os.getenv("GOOGLE_PRIVATE_KEY_ID"),
-        "private_key": os.getenv("GOOGLE_PRIVATE_KEY"),   
+        "private_key": os.getenv("GOOGLE_PRIVATE_KEY"),
         "client_email": os.getenv("GOOGLE_CLIENT_EMAIL"),
         "client_id": os.getenv("GOOGLE_CLIENT_ID"),
         "auth_uri": "https://accounts.google.com/o/oauth2/auth",
@@ -68,7 +338,7 @@ def get_sheets_api_credentials():
 
     # Create a temporary file to store the credentials
     temp_cred_file = a_ph('temp_credentials.json')
-    # if temp_cred_file exists, delete it first 
+    # if temp_cred_file exists, delete it first
     if os.path.exists(temp_cred_file):
         os.remove(temp_cred_file)
         print("Deleted the existing temp_cred_file")
@@ -79,9 +349,7 @@ def get_sheets_api_credentials():
 
 
     # Get the credentials from the temporary file
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    
-    creds = Credentials.from_service_account_file(temp_cred_file, scopes=scopes)
+    creds = Credentials.from_service_account_file(temp_cred_file, scopes=GOOGLE_API_SCOPES)
 
     # Remove the temporary file
     os.remove(temp_cred_file)
@@ -91,25 +359,13 @@ def get_sheets_api_credentials():
 
 
 
-def get_worksheet_df_by_name(workbook,worksheet_name):
-
-    worksheet_list = map(lambda x: x.title, workbook.worksheets())
-    if worksheet_name not in worksheet_list:
-        print(f"Worksheet {worksheet_name} not found in the google sheet")
-        raise ValueError(f"Worksheet {worksheet_name} not found in the google sheet")
-    # get the worksheet to df 
-    return workbook.worksheet(worksheet_name)
-
-
-
-
 
 
 
 
 
 
-# test run 
+# test run
 def test():
     update_resources()
 